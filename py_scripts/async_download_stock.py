@@ -3,13 +3,11 @@ import asyncio
 from functools import partial
 import argparse
 
-import pandas as pd
-from twstock import Stock
-import math
 import random
-import requests
-from requests.exceptions import ConnectionError as RequestsConnectionError
-import socket
+
+from run_stats import count
+
+# pandas / twstock 在用到的 function 裡才 import，`-h` 或被 pipeline import 時不用付啟動成本
 
 def clean_directory(save_dir):
     save_dir = os.path.expanduser(save_dir)
@@ -79,6 +77,9 @@ async def download_single_ticker(ticker: str, is_listed: bool, start_y: int, sta
     Download historical data for a single ticker asynchronously.
     We wrap the synchronous twstock API with asyncio.to_thread to avoid blocking.
     """
+    import pandas as pd
+    from twstock import Stock
+
     async with sem:
         print(f'Downloading data for {ticker}...')
 
@@ -92,11 +93,13 @@ async def download_single_ticker(ticker: str, is_listed: bool, start_y: int, sta
             async def fetch_func():
                 # This function itself needs to be awaitable if we want to call it with 'await'.
                 # We'll wrap the synchronous call in asyncio.to_thread:
+                count('twstock_fetch')
                 data = await asyncio.to_thread(stock.fetch_from, start_y, start_m)
                 return data
             if not single_ticker:
                 data = await fetch_data_with_retry(fetch_func, max_retries=5, base_delay=1.0)
             else:
+                count('twstock_fetch')
                 data = await asyncio.to_thread(stock.fetch_from, start_y, start_m)
 
             # The actual data fetch is also synchronous, so run in a thread:
@@ -169,6 +172,8 @@ async def async_download_data(
     1. Reads the CSV file for tickers.
     2. Spawns tasks to download each ticker concurrently (limited by a semaphore).
     """
+    import pandas as pd
+
     list_path = os.path.expanduser(list_path)
     save_dir = os.path.expanduser(save_dir)
 
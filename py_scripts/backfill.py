@@ -0,0 +1,398 @@
+import os
+import time
+import shutil
+import sqlite3
+import asyncio
+import argparse
+from datetime import datetime
+
+import pandas as pd
+
+import daily_asyc_brokerdata as crawler
+from branch_store import BRANCH_COLUMNS, append_branch_rows, branch_lock, branch_path, first_line, parse_numbers
+
+DATA_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data'
+BACKFILL_DIR = f'{DATA_DIR}/backfill'
+DB_FILE = 'queue.db'
+
+DAILY_MAX_DAYS = 10       # daily crawl 最多幫一個分點補幾天，超過就進 backfill queue
+BATCH_DAYS = 20           # 每個 job 每批抓幾天，一批做完才記錄進度
+BACKFILL_CONCURRENCY = 2  # 同時抓幾個分點 (daily 是 BROKER_CONCURRENCY)
+MAX_RPS = 2.0             # backfill 自己的 request 速率上限
+NICE = 10
+MAX_DATE_ATTEMPTS = 3     # 一天抓不到 (或沒有主 table) 最多重抓幾次，之後 job 標成 failed
+
+# -------------------------------------------------------------------
+# Backfill queue (SQLite)
+#   kind='append':  分點檔沒有或缺太多天 (新加的分點)，補到 end 後 daily 再接手；
+#                   job 還沒做完時 daily 會跳過這個分點，分點檔才會維持依日期排序
+#   kind='prepend': 補 start ~ 分點檔第一天之前的歷史 (例如 2023 年以前)，daily 照常跑
+#   抓到的資料先寫到 staging/<job_id>/，job 做完才在 branch_lock 裡合併進分點檔
+#   cursor 是最後一個抓完的日期，中斷後從 cursor 之後繼續
+#   抓不到的日期記在 failed_dates，cursor 走到 end 之後先重抓這些日期，都抓到才算 done；
+#   重抓 MAX_DATE_ATTEMPTS 次還不行就合併已經抓到的資料，job 標成 failed (status 看得到缺哪幾天)
+# -------------------------------------------------------------------
+def connect(backfill_dir=BACKFILL_DIR):
+    backfill_dir = os.path.expanduser(backfill_dir)
+    os.makedirs(backfill_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(backfill_dir, DB_FILE), timeout=60, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                        job_id INTEGER PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        broker_code TEXT NOT NULL,
+                        branch_name TEXT NOT NULL,
+                        branch_code TEXT NOT NULL,
+                        start TEXT NOT NULL,
+                        end TEXT NOT NULL,
+                        cursor TEXT,
+                        total_days INTEGER NOT NULL,
+                        done_days INTEGER NOT NULL DEFAULT 0,
+                        failed_days INTEGER NOT NULL DEFAULT 0,
+                        rows INTEGER NOT NULL DEFAULT 0,
+                        active_s REAL NOT NULL DEFAULT 0,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        created_at REAL,
+                        finished_at REAL)""")
+    # 所有 job 用到的交易日 (prepend 的日期可能比 Tradingdate.csv 還早)
+    conn.execute("CREATE TABLE IF NOT EXISTS dates (str_date TEXT PRIMARY KEY)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS failed_dates (
+                        job_id INTEGER NOT NULL,
+                        str_date TEXT NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 1,
+                        PRIMARY KEY (job_id, str_date))""")
+    return conn
+
+
+def enqueue(conn, kind, broker_code, branch_name, branch_code, dates):
+    """
+    add a job for these trading dates (list of 'YYYY-MM-DD')
+    同一個分點同一種 kind 已經有沒做完的 job 就不加，return job_id or None
+    """
+    if not dates:
+        return None
+    exists = conn.execute("SELECT 1 FROM jobs WHERE branch_code = ? AND kind = ? AND status = 'pending'",
+                          (branch_code, kind)).fetchone()
+    if exists:
+        return None
+    dates = sorted(dates)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT OR IGNORE INTO dates VALUES (?)', [(d,) for d in dates])
+    cur = conn.execute("""INSERT INTO jobs (kind, broker_code, branch_name, branch_code, start, end,
+                                            total_days, created_at)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                       (kind, broker_code, branch_name, branch_code, dates[0], dates[-1], len(dates), time.time()))
+    conn.execute('COMMIT')
+    return cur.lastrowid
+
+
+def hand_off_gaps(Ori_Tradingdate, Brockerlist, saved_df, backfill_dir=BACKFILL_DIR, max_days=DAILY_MAX_DAYS):
+    """
+    called by go_through_dates: 缺超過 max_days 天的分點加進 queue
+    return branch codes the daily crawl should skip (有沒做完的 append job)
+    """
+    conn = connect(backfill_dir)
+    last = saved_df.set_index('Branch_Code')['Date']
+    for _, row in Brockerlist.iterrows():
+        max_date = last.get(row['Branch_Code'])
+        new_dates = Ori_Tradingdate['str_date_dt'] > max_date if pd.notnull(max_date) else \
+            pd.Series(True, index=Ori_Tradingdate.index)
+        if new_dates.sum() > max_days:
+            job_id = enqueue(conn, 'append', row['Broker_Code'], row['Branch_Name'], row['Branch_Code'],
+                             Ori_Tradingdate.loc[new_dates, 'str_date'].tolist())
+            if job_id is not None:
+                crawler.logger.info(f"Broker {row['Branch_Code']} is {new_dates.sum()} days behind, "
+                                    f"queued for backfill (job {job_id})")
+    skip = {r[0] for r in conn.execute("SELECT branch_code FROM jobs WHERE kind = 'append' AND status = 'pending'")}
+    conn.close()
+    return skip
+
+
+def enqueue_history(conn, Brockerlist, Saved_dir, dates):
+    """
+    prepend jobs: 分點檔第一天之前、在 dates 裡的日期
+    """
+    n_jobs = 0
+    for _, row in Brockerlist.iterrows():
+        path = branch_path(Saved_dir, row['Branch_Code'])
+        if not os.path.isfile(path):
+            continue    # 沒有檔案的分點由 append job 處理
+        line = first_line(path)
+        if not line:
+            continue
+        first_date = line.decode().split(',')[BRANCH_COLUMNS.index('Date')]
+        older = [d for d in dates if d < first_date]
+        if enqueue(conn, 'prepend', row['Broker_Code'], row['Branch_Name'], row['Branch_Code'], older):
+            n_jobs += 1
+    return n_jobs
+
+
+# -------------------------------------------------------------------
+# Runner
+# -------------------------------------------------------------------
+class RateLimiter:
+    """
+    at most rps request starts per second (整個 backfill 共用)
+    """
+    def __init__(self, rps):
+        self.interval = 1.0 / rps
+        self.next_time = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_time)
+        self.next_time = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def in_hours(hours, now=None):
+    """
+    hours 像 (22, 6) 代表 22:00 ~ 隔天 06:00, None 代表任何時間
+    """
+    if hours is None:
+        return True
+    start, end = hours
+    h = (now or datetime.now()).hour
+    return start <= h < end if start <= end else (h >= start or h < end)
+
+
+async def fetch_days(jobs, max_rps, concurrency):
+    """
+    fetch and parse [(job, [dates])], return {job_id: (DataFrame or None, [failed dates])}
+    """
+    import aiohttp
+
+    limiter = RateLimiter(max_rps)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(session, job, date_str):
+        async with semaphore:
+            url = crawler.construct_url(job['broker_code'], job['branch_code'], 'E', date_str, date_str)
+            # fetch_async 的重試也要經過 limiter
+            html_content = await crawler.fetch_async(session, url, limiter=limiter)
+        if not html_content:
+            return None
+        try:
+            df = crawler.parse_broker_page(html_content)
+            if df is not None:
+                df = parse_numbers(df)
+        except Exception as e:
+            crawler.logger.error(f"Error parsing HTML for Broker {job['branch_code']}, date {date_str}: {e}")
+            return None
+        if df is None:
+            return None
+        return df.assign(Branch=job['branch_name'], Date=date_str, Branch_Code=job['branch_code'])
+
+    async with aiohttp.ClientSession() as session:
+        results = {}
+        for job, dates in jobs:
+            results[job['job_id']] = [asyncio.ensure_future(one(session, job, d)) for d in dates]
+        await asyncio.gather(*[f for futures in results.values() for f in futures])
+
+    out = {}
+    for job, dates in jobs:
+        frames = [f.result() for f in results[job['job_id']]]
+        ok = [df for df in frames if df is not None and not df.empty]
+        out[job['job_id']] = (pd.concat(ok, ignore_index=True) if ok else None,
+                              [d for d, df in zip(dates, frames) if df is None])
+    return out
+
+
+def record_failed(conn, job_id, dates, failed):
+    """
+    update failed_dates after a batch: 這批抓到的日期刪掉，失敗的加進去或 attempts + 1
+    return number of dates of the job still missing
+    """
+    failed = set(failed)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('DELETE FROM failed_dates WHERE job_id = ? AND str_date = ?',
+                     [(job_id, d) for d in dates if d not in failed])
+    conn.executemany("""INSERT INTO failed_dates (job_id, str_date) VALUES (?, ?)
+                        ON CONFLICT (job_id, str_date) DO UPDATE SET attempts = attempts + 1""",
+                     [(job_id, d) for d in sorted(failed)])
+    conn.execute('COMMIT')
+    return conn.execute('SELECT COUNT(*) FROM failed_dates WHERE job_id = ?', (job_id,)).fetchone()[0]
+
+
+def merge_job(job, Saved_dir, staging):
+    """
+    merge the staging file of a finished job into the branch file (在 branch_lock 裡整檔重寫)
+    """
+    code = job['branch_code']
+    path = branch_path(staging, code)
+    if not os.path.isfile(path):
+        return 0
+    df_new = pd.read_csv(path, dtype=str, keep_default_na=False)
+    target = branch_path(Saved_dir, code)
+    with branch_lock(Saved_dir, code):
+        frames = [df_new]
+        if os.path.isfile(target):
+            frames.append(pd.read_csv(target, dtype=str, keep_default_na=False))
+        df = pd.concat(frames, ignore_index=True).drop_duplicates()
+        df = df.sort_values('Date', kind='stable')[BRANCH_COLUMNS]
+        tmp = target + '.tmp'
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, target)
+    shutil.rmtree(staging)
+    return len(df_new)
+
+
+def run_backfill(Saved_dir, backfill_dir=BACKFILL_DIR, batch_days=BATCH_DAYS, concurrency=BACKFILL_CONCURRENCY,
+                 max_rps=MAX_RPS, hours=None, max_batches=None):
+    """
+    work through the queue in batches until it is empty, 超出 hours 或做完 max_batches 批就停
+    每批結束都會寫進度，隨時中斷都可以從下一批繼續
+    """
+    if NICE and hasattr(os, 'nice'):
+        os.nice(NICE)
+    Saved_dir = os.path.expanduser(Saved_dir)
+    conn = connect(backfill_dir)
+    conn.row_factory = sqlite3.Row
+    n_batches = 0
+
+    while max_batches is None or n_batches < max_batches:
+        if not in_hours(hours):
+            print(f"Outside backfill hours {hours[0]}:00-{hours[1]}:00, stop")
+            break
+        # 先做 append (新分點缺的資料)，再補舊的歷史
+        jobs = conn.execute("""SELECT * FROM jobs WHERE status = 'pending'
+                               ORDER BY kind = 'prepend', job_id LIMIT ?""", (concurrency,)).fetchall()
+        if not jobs:
+            print("Backfill queue is empty")
+            break
+
+        work = []
+        for job in jobs:
+            dates = [r[0] for r in conn.execute(
+                """SELECT str_date FROM dates WHERE str_date >= ? AND str_date <= ? AND str_date > ?
+                   ORDER BY str_date LIMIT ?""", (job['start'], job['end'], job['cursor'] or '', batch_days))]
+            is_retry = not dates
+            if is_retry:
+                # cursor 已經到 end，重抓之前失敗的日期
+                dates = [r[0] for r in conn.execute(
+                    """SELECT str_date FROM failed_dates WHERE job_id = ? AND attempts < ?
+                       ORDER BY str_date LIMIT ?""", (job['job_id'], MAX_DATE_ATTEMPTS, batch_days))]
+            work.append((dict(job), dates, is_retry))
+
+        t0 = time.time()
+        results = asyncio.run(fetch_days([(job, dates) for job, dates, _ in work], max_rps, concurrency))
+        elapsed = time.time() - t0
+
+        for job, dates, is_retry in work:
+            df, failed = results[job['job_id']]
+            staging = os.path.join(os.path.expanduser(backfill_dir), 'staging', str(job['job_id']))
+            if df is not None:
+                os.makedirs(staging, exist_ok=True)
+                append_branch_rows(staging, job['branch_code'], df)
+            n_failed = record_failed(conn, job['job_id'], dates, failed)
+            conn.execute("""UPDATE jobs SET cursor = ?, done_days = done_days + ?, failed_days = ?,
+                                            rows = rows + ?, active_s = active_s + ?
+                            WHERE job_id = ?""",
+                         (job['cursor'] if is_retry else dates[-1],
+                          0 if is_retry else len(dates), n_failed,
+                          0 if df is None else len(df), elapsed / len(work), job['job_id']))
+            if failed:
+                print(f"Job {job['job_id']} ({job['branch_code']}): {len(failed)} days failed, "
+                      f"retried once the cursor reaches {job['end']}")
+            cursor_done = is_retry or dates[-1] >= job['end']
+            retry_left = conn.execute("SELECT COUNT(*) FROM failed_dates WHERE job_id = ? AND attempts < ?",
+                                      (job['job_id'], MAX_DATE_ATTEMPTS)).fetchone()[0]
+            if cursor_done and not retry_left:
+                n_rows = merge_job(job, Saved_dir, staging)
+                status = 'failed' if n_failed else 'done'
+                conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE job_id = ?",
+                             (status, time.time(), job['job_id']))
+                print(f"Job {job['job_id']} ({job['kind']} {job['branch_code']}) {status}, {n_rows} rows merged"
+                      + (f", {n_failed} days still missing" if n_failed else ''))
+
+        n_batches += 1
+        print(progress(conn, hours))
+    conn.close()
+    return n_batches
+
+
+def progress(conn, hours=None):
+    """
+    one-line progress with an estimated completion time
+    速度用目前為止實際在抓的時間算，有 hours 時換算成大概還要幾個晚上
+    """
+    total, done, active_s, n_open = conn.execute(
+        """SELECT COALESCE(SUM(total_days), 0), COALESCE(SUM(done_days), 0), COALESCE(SUM(active_s), 0),
+                  COALESCE(SUM(status = 'pending'), 0) FROM jobs""").fetchone()
+    if not total:
+        return "Backfill queue is empty"
+    line = f"Backfill: {done}/{total} branch-days ({100 * done / total:.1f}%), {n_open} jobs left"
+    if done and active_s and done < total:
+        # 每批的時間平均分給同一批的 job，所以 active_s 加起來就是實際在抓的總時間
+        rate = done / active_s
+        eta_h = (total - done) / rate / 3600
+        line += f", {rate * 3600:.0f} days/h, about {eta_h:.1f} h of crawling left"
+        if hours is not None:
+            window = (hours[1] - hours[0]) % 24 or 24
+            line += f" (~{eta_h / window:.1f} runs of {window} h)"
+    return line
+
+
+def job_table(conn):
+    df = pd.read_sql_query("""SELECT job_id, kind, branch_code, start, end, cursor, done_days, total_days,
+                                     failed_days, rows, status FROM jobs ORDER BY job_id""", conn)
+    return df
+
+
+def parse_hours(text):
+    if text is None:
+        return None
+    start, end = text.split('-')
+    return int(start), int(end)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill branch history separately from the daily crawl')
+    parser.add_argument('--backfill-dir', type=str, default=BACKFILL_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_enq = sub.add_parser('enqueue', help='queue missing history')
+    p_enq.add_argument('--history-start', type=str, default=None,
+                       help='also backfill every branch back to this date (YYYY-MM-DD)')
+    p_enq.add_argument('--dates-file', type=str, default=f'{DATA_DIR}/Tradingdate.csv',
+                       help='trading dates (str_date column), must cover --history-start')
+
+    p_run = sub.add_parser('run', help='work through the queue')
+    p_run.add_argument('--hours', type=str, default=None, help='only run between these hours, e.g. 22-6')
+    p_run.add_argument('--batch-days', type=int, default=BATCH_DAYS)
+    p_run.add_argument('--concurrency', type=int, default=BACKFILL_CONCURRENCY)
+    p_run.add_argument('--max-rps', type=float, default=MAX_RPS)
+    p_run.add_argument('--max-batches', type=int, default=None)
+    p_run.add_argument('--base-url', type=str, default=None, help='e.g. the mock_fubon.py address')
+
+    p_status = sub.add_parser('status')
+    p_status.add_argument('--hours', type=str, default=None, help='estimate runs needed with this window')
+    p_status.add_argument('--jobs', action='store_true', help='list every job')
+    args = parser.parse_args()
+
+    Brokerlist_path = f'{DATA_DIR}/big_branch_list.csv'
+    Saved_dir = f'{DATA_DIR}/small_broker_trading'
+
+    if args.command == 'enqueue':
+        from branch_store import last_dates
+        df_dates = pd.read_csv(os.path.expanduser(args.dates_file))
+        df_dates['str_date_dt'] = pd.to_datetime(df_dates['str_date'], format='%Y-%m-%d')
+        Brockerlist = pd.read_csv(os.path.expanduser(Brokerlist_path), dtype=str)
+        skip = hand_off_gaps(df_dates, Brockerlist, last_dates(Saved_dir), args.backfill_dir)
+        print(f"{len(skip)} branches waiting for append jobs")
+        if args.history_start:
+            conn = connect(args.backfill_dir)
+            dates = df_dates.loc[df_dates['str_date'] >= args.history_start, 'str_date'].tolist()
+            print(f"{enqueue_history(conn, Brockerlist, Saved_dir, dates)} history jobs queued")
+            conn.close()
+    elif args.command == 'run':
+        if args.base_url:
+            crawler.BASE_URL = args.base_url
+        run_backfill(Saved_dir, args.backfill_dir, args.batch_days, args.concurrency, args.max_rps,
+                     parse_hours(args.hours), args.max_batches)
+    else:
+        conn = connect(args.backfill_dir)
+        if args.jobs:
+            print(job_table(conn).to_string(index=False))
+        print(progress(conn, parse_hours(args.hours)))
+        conn.close()
@@ -0,0 +1,182 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from broker_analyze import list_csv_files, load_price_files, read_signals, read_big_buy
+from price_panel import build_price_panel, locate, forward_window
+
+# 台股手續費 0.1425% * 2 + 證交稅 0.3%
+DEFAULT_FEE = 0.001425 * 2 + 0.003
+
+
+def label_events(df_big_buy, df_signals):
+    """
+    return a bool array, True if the big buy (Ticker, Date) matches a signal (同 cheating_rate)
+    """
+    keys = df_signals[['Ticker', 'Date']].drop_duplicates()
+    df = df_big_buy[['Ticker', 'Date']].merge(keys, on=['Ticker', 'Date'], how='left', indicator=True)
+    return (df['_merge'] == 'both').to_numpy()
+
+
+def walk_forward_counts(pair, event_ord, success, label_lag):
+    """
+    for every event, count earlier events of the same pair whose result was already known
+    一筆 big buy 要等 label_lag 個交易日後 (未來均線算完) 才知道成功與否，
+    只用 known_ord <= 當天 的事件，所以沒有 lookahead
+    return (known_count, known_success)
+    """
+    pair = np.asarray(pair, dtype=np.int64)
+    event_ord = np.asarray(event_ord, dtype=np.int64)
+    known_ord = event_ord + label_lag
+    span = int(known_ord.max()) + 1 if len(known_ord) else 1
+
+    order = np.lexsort((known_ord, pair))
+    key_sorted = pair[order] * span + known_ord[order]
+    success_cum = np.concatenate([[0], np.cumsum(success[order])])
+
+    idx = np.searchsorted(key_sorted, pair * span + event_ord, side='right')
+    pair_start = np.searchsorted(key_sorted, pair * span, side='left')
+    return idx - pair_start, success_cum[idx] - success_cum[pair_start]
+
+
+def simulate_trades(panel, ti, entry_ord, hold_days, target=None, stop=None, fee=DEFAULT_FEE):
+    """
+    enter on the open of entry_ord, exit on target / stop / after hold_days (收盤出場)
+    所有交易一次用 (trades x hold_days) 的 window 計算
+    同一天同時碰到停利和停損時，保守當作停損
+    """
+    open_w = forward_window(panel['Open'], ti, entry_ord, hold_days)
+    high_w = forward_window(panel['High'], ti, entry_ord, hold_days)
+    low_w = forward_window(panel['Low'], ti, entry_ord, hold_days)
+    close_w = forward_window(panel['Close'], ti, entry_ord, hold_days)
+
+    entry_price = open_w[:, 0]
+    n = len(entry_price)
+    rows = np.arange(n)
+
+    with np.errstate(invalid='ignore'):
+        hit_target = high_w >= (entry_price * (1 + target))[:, None] if target else np.zeros_like(high_w, dtype=bool)
+        hit_stop = low_w <= (entry_price * (1 - stop))[:, None] if stop else np.zeros_like(low_w, dtype=bool)
+
+    valid_close = ~np.isnan(close_w)
+    last_valid = hold_days - 1 - np.argmax(valid_close[:, ::-1], axis=1)
+    any_hit = hit_target | hit_stop
+    exit_idx = np.where(any_hit.any(axis=1), np.argmax(any_hit, axis=1), last_valid)
+
+    is_stop = hit_stop[rows, exit_idx]
+    is_target = hit_target[rows, exit_idx] & ~is_stop
+    exit_open = open_w[rows, exit_idx]
+
+    exit_price = close_w[rows, exit_idx]
+    if stop:
+        exit_price = np.where(is_stop, np.fmin(entry_price * (1 - stop), exit_open), exit_price)
+    if target:
+        exit_price = np.where(is_target, np.fmax(entry_price * (1 + target), exit_open), exit_price)
+
+    reason = np.where(is_stop, 'stop',
+             np.where(is_target, 'target',
+             np.where(valid_close[:, -1], 'hold', 'end')))
+
+    return {
+        'entry_price': entry_price,
+        'exit_ord': entry_ord + exit_idx,
+        'exit_price': exit_price,
+        'exit_reason': reason,
+        'return': exit_price / entry_price - 1 - fee,
+    }
+
+
+def run_backtest(df_big_buy, df_signals, df_price, hold_days=5, target=None, stop=None,
+                 success_threshold=0.49, min_events=2, label_lag=8, fee=DEFAULT_FEE, dedupe=True):
+    """
+    follow (Branch_Code, Ticker) pairs whose walk-forward success rate > success_threshold:
+    big buy 當天收盤後決定，隔天開盤進場
+    label_lag 預設 8 = 未來 7 日均線 + is_signal_next 的一天
+    """
+    df_events = df_big_buy[['Branch_Code', 'Ticker', 'Date']].reset_index(drop=True)
+    success = label_events(df_events, df_signals)
+
+    panel = build_price_panel(df_price)
+    ti, di = locate(panel, df_events['Ticker'], df_events['Date'])
+    ok = (ti >= 0) & (di >= 0)
+    df_events, success, ti, di = df_events[ok].reset_index(drop=True), success[ok], ti[ok], di[ok]
+
+    pair = df_events.groupby(['Branch_Code', 'Ticker'], sort=False).ngroup().to_numpy()
+    known_count, known_success = walk_forward_counts(pair, di, success, label_lag)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = np.where(known_count > 0, known_success / known_count, 0)
+
+    df_events['known_count'] = known_count
+    df_events['known_success'] = known_success
+    df_events['success_rate'] = rate
+
+    qualify = (known_count >= min_events) & (rate > success_threshold)
+    df_trades = df_events[qualify].copy()
+    df_trades['ti'] = ti[qualify]
+    df_trades['entry_ord'] = di[qualify] + 1
+
+    if dedupe:
+        # 同一天多個分點買同一檔，只跟一次 (取成功率最高的)
+        df_trades = df_trades.sort_values('success_rate', ascending=False) \
+                             .drop_duplicates(['Ticker', 'Date']) \
+                             .sort_values(['Date', 'Ticker'])
+
+    df_trades = df_trades[df_trades['entry_ord'] < len(panel['dates'])]
+    result = simulate_trades(panel, df_trades['ti'].to_numpy(), df_trades['entry_ord'].to_numpy(),
+                             hold_days, target, stop, fee)
+
+    df_trades['entry_date'] = panel['dates'][df_trades['entry_ord'].to_numpy()]
+    df_trades['exit_date'] = panel['dates'][np.minimum(result['exit_ord'], len(panel['dates']) - 1)]
+    for key in ['entry_price', 'exit_price', 'exit_reason', 'return']:
+        df_trades[key] = result[key]
+
+    df_trades = df_trades[~np.isnan(df_trades['entry_price'])]
+    return df_trades.drop(columns=['ti', 'entry_ord']).reset_index(drop=True)
+
+
+def summarize_trades(df_trades):
+    """
+    per entry year and overall: trades, win rate, average / median / total return
+    """
+    def _stat(df):
+        return pd.Series({
+            'trades': len(df),
+            'win_rate': (df['return'] > 0).mean() if len(df) else 0,
+            'avg_return': df['return'].mean(),
+            'median_return': df['return'].median(),
+            'total_return': df['return'].sum(),
+        })
+
+    df_year = df_trades.groupby(df_trades['entry_date'].dt.year).apply(_stat)
+    df_year.index = df_year.index.astype(str)
+    df_year.loc['All'] = _stat(df_trades)
+    return df_year.rename_axis('year').reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtest following high success rate branches')
+    parser.add_argument('--hold-days', type=int, default=5, help='max trading days to hold')
+    parser.add_argument('--target', type=float, default=None, help='take profit, e.g. 0.1 for +10%%')
+    parser.add_argument('--stop', type=float, default=None, help='stop loss, e.g. 0.05 for -5%%')
+    parser.add_argument('--threshold', type=float, default=0.49, help='walk-forward success rate threshold')
+    parser.add_argument('--min-events', type=int, default=2, help='min known big buys of the pair')
+    parser.add_argument('--fee', type=float, default=DEFAULT_FEE, help='round trip cost')
+    args = parser.parse_args()
+
+    calc_dir = os.path.expanduser('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result')
+    price_files = list_csv_files('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/AllStockHist')
+
+    df_price = load_price_files(price_files)
+    df_signals = read_signals(os.path.join(calc_dir, 'big_gain_signals.csv'))
+    df_big_buy = read_big_buy(os.path.join(calc_dir, 'broker_big_buy.csv'))
+
+    df_trades = run_backtest(df_big_buy, df_signals, df_price,
+                             hold_days=args.hold_days, target=args.target, stop=args.stop,
+                             success_threshold=args.threshold, min_events=args.min_events, fee=args.fee)
+    df_summary = summarize_trades(df_trades)
+
+    df_trades.to_csv(os.path.join(calc_dir, 'backtest_trades.csv'), index=False)
+    df_summary.to_csv(os.path.join(calc_dir, 'backtest_summary.csv'), index=False)
+    print(df_summary.to_string(index=False))
@@ -0,0 +1,184 @@
+import os
+import io
+import sys
+import time
+import argparse
+import subprocess
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+from run_stats import maxrss_mb
+from synthetic_data import generate
+
+DATA_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/synthetic'
+RESULTS_FILE = '~/Documents/Dev/Cheater_finder/Stock_project/py_scripts/sh_logs/benchmark_results.csv'
+RESULT_COLUMNS = ['run_id', 'git_rev', 'stage', 'axis', 'scale', 'tickers', 'branches', 'days',
+                  'price_rows', 'broker_rows', 'out_rows', 'wall_s', 'cpu_s',
+                  'rss_before_mb', 'peak_rss_mb', 'py_peak_mb']
+
+# 1x 的資料量，--axis 決定哪一個維度乘上 scale
+BASE = {'tickers': 50, 'branches': 20, 'days': 250}
+STAGES = ['load_price', 'tag_price_files', 'build_volume_lookup', 'big_buy_calc', 'cheating_rate',
+          'run_analysis']
+
+
+def dataset(axis, scale, base=BASE, data_dir=DATA_DIR, seed=0):
+    """
+    generate (or reuse) the synthetic dataset for one scale
+    同樣的參數只產生一次，目錄名稱就是參數
+    """
+    config = dict(base)
+    config[axis] *= scale
+    out_dir = os.path.join(os.path.expanduser(data_dir),
+                           f"t{config['tickers']}_b{config['branches']}_d{config['days']}_s{seed}")
+    done = os.path.join(out_dir, '.done')
+    if not os.path.isfile(done):
+        print(f"Generating {out_dir}")
+        info = generate(out_dir, config['tickers'], config['branches'], config['days'], seed=seed)
+        with open(done, 'w') as f:
+            f.write(f"{info['price_rows']},{info['broker_rows']}\n")
+    with open(done) as f:
+        price_rows, broker_rows = map(int, f.read().split(','))
+    return {**config, 'dir': out_dir, 'price_rows': price_rows, 'broker_rows': broker_rows}
+
+
+def _run_stage(stage, data_dir, start_date, trace):
+    """
+    worker: 先準備好前面階段的結果 (不計時)，再量這個 stage
+    每次都在新的 process 跑，peak RSS 才不會被前一個 stage 影響
+    """
+    import resource
+    import numpy as np
+    import broker_analyze as ba
+
+    price_files = ba.list_csv_files(os.path.join(data_dir, 'AllStockHist'))
+    broker_files = ba.list_csv_files(os.path.join(data_dir, 'small_broker_trading'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if stage in ('tag_price_files', 'build_volume_lookup', 'big_buy_calc', 'cheating_rate'):
+            df_price = ba.load_price_files(price_files, start_date)
+            trading_dates = np.sort(df_price['Date'].unique())
+        if stage in ('big_buy_calc', 'cheating_rate'):
+            df_volume = ba.build_volume_lookup(df_price)
+        if stage == 'cheating_rate':
+            df_signals = ba.tag_price_files(df_price)
+            df_big_buy = ba.big_buy_calc(broker_files, df_volume, trading_dates=trading_dates)
+
+        stages = {
+            'load_price': lambda: ba.load_price_files(price_files, start_date),
+            'tag_price_files': lambda: ba.tag_price_files(df_price),
+            'build_volume_lookup': lambda: ba.build_volume_lookup(df_price),
+            'big_buy_calc': lambda: ba.big_buy_calc(broker_files, df_volume, trading_dates=trading_dates),
+            'cheating_rate': lambda: ba.cheating_rate(df_signals, df_big_buy, None, 0.49,
+                                                      trading_dates=trading_dates)['success'],
+            'run_analysis': lambda: ba.run_analysis(price_files, broker_files, start_date=start_date)['success'],
+        }
+
+        rss_before = maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        if trace:
+            import tracemalloc
+            tracemalloc.start()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        out = stages[stage]()
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        py_peak = None
+        if trace:
+            py_peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+    return {'out_rows': len(out), 'wall_s': wall, 'cpu_s': cpu, 'rss_before_mb': rss_before,
+            'peak_rss_mb': maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+            'py_peak_mb': py_peak}
+
+
+def git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run_benchmark(stages=STAGES, scales=(1, 10, 100), axis='branches', trace=False, data_dir=DATA_DIR,
+                  results_file=RESULTS_FILE, run_id=None):
+    """
+    run every stage at every scale, append one row per (stage, scale) to results_file
+    peak_rss_mb 是 process 的最高 RSS (含準備資料)，比 rss_before_mb 大才是 stage 本身造成的
+    """
+    import pandas as pd
+
+    run_id = run_id or time.strftime('%Y%m%d_%H%M%S')
+    rev = git_rev()
+    rows = []
+    for scale in scales:
+        data = dataset(axis, scale, data_dir=data_dir)
+        start_date = pd.read_csv(os.path.join(data['dir'], 'Tradingdate.csv'))['str_date'].iloc[0]
+        for stage in stages:
+            # 每個 stage 一個新的 process
+            with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+                stats = pool.submit(_run_stage, stage, data['dir'], start_date, trace).result()
+            row = {'run_id': run_id, 'git_rev': rev, 'stage': stage, 'axis': axis, 'scale': scale,
+                   **{k: data[k] for k in ('tickers', 'branches', 'days', 'price_rows', 'broker_rows')},
+                   **stats}
+            print(f"{stage:<20}{scale:>5}x  {stats['wall_s']:8.2f} s  {stats['peak_rss_mb']:8.1f} MB")
+            rows.append(row)
+
+    df = pd.DataFrame(rows, columns=RESULT_COLUMNS).round(3)
+    results_file = os.path.expanduser(results_file)
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    df.to_csv(results_file, mode='a', header=not os.path.isfile(results_file), index=False)
+    print(f"Results appended to {results_file}")
+    return df
+
+
+def compare(results_file=RESULTS_FILE, run_id=None, baseline=None):
+    """
+    wall / peak RSS ratio of run_id (預設最新) against baseline (預設前一次 run)
+    只比較兩次都有的 (stage, axis, scale)
+    """
+    import pandas as pd
+
+    df = pd.read_csv(os.path.expanduser(results_file), dtype={'run_id': str})
+    runs = df['run_id'].drop_duplicates().tolist()
+    run_id = run_id or runs[-1]
+    if baseline is None:
+        earlier = [r for r in runs if r < run_id]
+        if not earlier:
+            return f"No run before {run_id} to compare with"
+        baseline = earlier[-1]
+
+    keys = ['stage', 'axis', 'scale']
+    df_cmp = df[df['run_id'] == run_id].merge(df[df['run_id'] == baseline], on=keys, suffixes=('', '_base'))
+    lines = [f"Run {run_id} ({df_cmp['git_rev'].iloc[0] if len(df_cmp) else ''}) vs "
+             f"{baseline} ({df_cmp['git_rev_base'].iloc[0] if len(df_cmp) else ''})",
+             f"{'stage':<20}{'scale':>6}{'wall(s)':>9}{'base':>9}{'ratio':>7}{'rss(MB)':>9}{'base':>9}{'ratio':>7}"]
+    for _, r in df_cmp.iterrows():
+        lines.append(f"{r['stage']:<20}{r['scale']:>5}x{r['wall_s']:>9.2f}{r['wall_s_base']:>9.2f}"
+                     f"{r['wall_s'] / r['wall_s_base']:>7.2f}{r['peak_rss_mb']:>9.1f}{r['peak_rss_mb_base']:>9.1f}"
+                     f"{r['peak_rss_mb'] / r['peak_rss_mb_base']:>7.2f}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time broker_analyze stages on synthetic data at several scales')
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help='comma separated stage names')
+    parser.add_argument('--scales', type=str, default='1,10,100')
+    parser.add_argument('--axis', choices=list(BASE), default='branches', help='dimension multiplied by scale')
+    parser.add_argument('--tracemalloc', action='store_true', help='also record the Python heap peak (slower)')
+    parser.add_argument('--data-dir', type=str, default=DATA_DIR)
+    parser.add_argument('-o', '--results', type=str, default=RESULTS_FILE)
+    parser.add_argument('--compare', nargs='?', const='', default=None, metavar='BASELINE_RUN',
+                        help='only compare the latest run with BASELINE_RUN (default the run before it)')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        print(compare(args.results, baseline=args.compare or None))
+        sys.exit(0)
+
+    stages = args.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages {sorted(unknown)}, choose from {STAGES}")
+    run_benchmark(stages, [int(s) for s in args.scales.split(',')], args.axis, args.tracemalloc,
+                  args.data_dir, args.results)
@@ -0,0 +1,142 @@
+import os
+import io
+import contextlib
+
+import pandas as pd
+
+from broker_analyze import BROKER_DTYPES
+
+# 分點檔的欄位 (small_broker_trading schema)
+BRANCH_COLUMNS = ['Ticker', 'Name', 'buy', 'sell', 'diff', 'Branch', 'Date', 'Branch_Code']
+NUMBER_COLUMNS = ['buy', 'sell', 'diff']
+
+
+def branch_path(store_dir, branch_code):
+    return os.path.join(os.path.expanduser(store_dir), f"{branch_code}.csv")
+
+
+@contextlib.contextmanager
+def branch_lock(store_dir, branch_code):
+    """
+    exclusive lock of one branch file (store_dir/.locks/<分點>.lock)
+    daily crawl 的 append 和 backfill 的合併可能在不同 process 同時發生
+    """
+    import fcntl
+    lock_dir = os.path.join(os.path.expanduser(store_dir), '.locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{branch_code}.lock"), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def parse_numbers(df):
+    """
+    buy / sell / diff 去掉千分位轉成 int，和 split_brokerdata 切出來的格式一樣
+    有轉不了的值時 raise ValueError，crawler 要在每一頁的 try 裡先呼叫，壞掉的頁面才會被當成失敗的日期
+    """
+    df = df.copy()
+    for col in NUMBER_COLUMNS:
+        values = df[col].astype(str).str.replace(',', '', regex=False)
+        numbers = pd.to_numeric(values, errors='coerce')
+        bad = numbers.isna() | (numbers != numbers.round())
+        if bad.any():
+            raise ValueError(f"Bad {col} values {values[bad].unique()[:5].tolist()}")
+        df[col] = numbers.astype('int64')
+    return df
+
+
+def append_branch_rows(store_dir, branch_code, df):
+    """
+    append crawled rows to the branch file, 第一次寫入時加 header
+    """
+    df = parse_numbers(df[BRANCH_COLUMNS])
+
+    path = branch_path(store_dir, branch_code)
+    with branch_lock(store_dir, branch_code):
+        if not os.path.isfile(path):
+            df.to_csv(path, index=False)
+        else:
+            df.to_csv(path, mode='a', index=False, header=False)
+
+
+def merge_branch_rows(store_dir, branch_code, df):
+    """
+    merge rows of any dates into the branch file (在 branch_lock 裡整檔重寫，依日期排序)
+    分點檔已經有的日期以檔案裡的資料為準，df 裡同一天的列不加
+    df 的數字欄位要已經是 append_branch_rows 寫出來的格式 (沒有千分位)
+    return number of rows added
+    """
+    path = branch_path(store_dir, branch_code)
+    df = df[BRANCH_COLUMNS].astype(str)
+    with branch_lock(store_dir, branch_code):
+        frames = []
+        if os.path.isfile(path):
+            df_old = pd.read_csv(path, dtype=str, keep_default_na=False)
+            df = df[~df['Date'].isin(df_old['Date'])]
+            frames.append(df_old)
+        if df.empty:
+            return 0
+        df_all = pd.concat(frames + [df], ignore_index=True).sort_values('Date', kind='stable')
+        tmp = path + '.tmp'
+        df_all[BRANCH_COLUMNS].to_csv(tmp, index=False)
+        os.replace(tmp, path)
+    return len(df)
+
+
+def first_line(path):
+    """
+    first data line of a file (bytes), 沒有資料回傳 b''
+    """
+    with open(path, 'rb') as f:
+        f.readline()
+        return f.readline().rstrip(b'\n')
+
+
+def last_line(path):
+    """
+    last complete line of a file (bytes), 只讀檔案尾巴
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b''
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            lines = buf.rstrip(b'\n').split(b'\n')
+            # 多於一行才確定拿到完整的最後一行 (或已經讀到檔頭)
+            if len(lines) > 1 or pos == 0:
+                return lines[-1]
+    return b''
+
+
+def last_dates(store_dir):
+    """
+    last saved Date of every branch file, 給 go_through_dates 決定每個分點要補哪些日期
+    每個檔案只讀 header 和最後一行，不用把整份資料讀進來
+    return DataFrame [Branch_Code, Date]
+    """
+    store_dir = os.path.expanduser(store_dir)
+    rows = []
+    if os.path.isdir(store_dir):
+        for filename in sorted(os.listdir(store_dir)):
+            if not filename.endswith('.csv'):
+                continue
+            path = os.path.join(store_dir, filename)
+            with open(path, 'rb') as f:
+                header = f.readline()
+            line = last_line(path)
+            if not line or line == header.rstrip(b'\n'):
+                continue
+            df_last = pd.read_csv(io.BytesIO(header + line + b'\n'), dtype=BROKER_DTYPES, thousands=',')
+            rows.append({'Branch_Code': filename[:-4], 'Date': df_last['Date'].iloc[0]})
+
+    df_dates = pd.DataFrame(rows, columns=['Branch_Code', 'Date'])
+    df_dates['Date'] = pd.to_datetime(df_dates['Date'], format='%Y-%m-%d', errors='coerce')
+    return df_dates
+
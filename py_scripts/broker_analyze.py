@@ -1,7 +1,49 @@
 import os
+import argparse
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from interval_join import window_join
+from calendar_rolling import to_ordinals, calendar_rolling_sum, calendar_rolling_mean
+
+# 券商交易資料的欄位型態，各階段共用，避免讀檔 / 傳遞時型態飄移
+BROKER_DTYPES = {"Ticker":"string",
+                 "Name":"string",
+                 "buy":int,
+                 "sell":int,
+                 "diff":int,
+                 "Branch":"string",
+                 "Date":"string",
+                 "Branch_Code":"string"}
+
+BIG_BUY_DTYPES = {**BROKER_DTYPES,
+                  'diff_7days_avg':float,
+                  'Volume':float,
+                  'is_big_buy_c1':bool,
+                  'is_big_buy_c2':bool}
+
+# 省記憶體的版本：重複的字串用 category，數量用 int32
+# Name / Branch 在 big_buy_calc 讀檔後收進 names 就丟掉，輸出時再用 restore_names 補回
+COMPACT_BROKER_DTYPES = {"Ticker":"category",
+                         "Name":"category",
+                         "buy":"int32",
+                         "sell":"int32",
+                         "diff":"int32",
+                         "Branch":"category",
+                         "Date":"string",
+                         "Branch_Code":"category"}
+
+# Volume 留 float64：big buy 條件要和非 compact 模式算出一樣的結果
+COMPACT_BIG_BUY_DTYPES = {**COMPACT_BROKER_DTYPES,
+                          'diff_7days_avg':'float32',
+                          'Volume':'float64',
+                          'is_big_buy_c1':bool,
+                          'is_big_buy_c2':bool}
+
+# 讀進 DataFrame 後大約是 csv 檔案大小的幾倍 (用實際分點檔量測的概略值)
+FRAME_BYTES_PER_CSV_BYTE = {'full': 6.0, 'compact': 0.8}
 
 def list_csv_files(directory):
     """
@@ -14,10 +56,11 @@ def list_csv_files(directory):
         if f.endswith('.csv')
     ]
 
-def get_signal_dates_from_price(df_price):
+def get_signal_dates_from_price(df_price, past_window=7, future_window=7, past_tol=1.03, future_gain=1.20):
     """
     傳回該股票符合「大漲前 signal」的日期列表，以及對應的 DataFrame 內容
     df_price 欄位需包含 ['Date', 'Close', 'Volume', 'Ticker']，且要有時間排序
+    門檻預設為 7 日均線、收盤 <= 過去均線 * 1.03、未來均線 >= 收盤 * 1.20
     """
 
     # 確保按照日期排序
@@ -26,92 +69,161 @@ def get_signal_dates_from_price(df_price):
     # 計算 7 日移動平均 (MA7)
     # 前 7 日平均：shift(1) 之後 rolling(7) 計算
     # （若要包含當天在內，就要調整shift的參數）
-    df_price['MA7_past'] = df_price.groupby('Ticker')['Close'].transform(lambda x: x.shift(1).rolling(7).mean())
+    df_price['MA7_past'] = df_price.groupby('Ticker')['Close'].transform(lambda x: x.shift(1).rolling(past_window).mean())
 
     # 未來 7 日平均：rolling(7) 對 shift(-1)，亦或 shift(-6) ~ shift(0) 之類做法
     # 這裡示範一個做法：對於當天，取未來7天(含當天~第6天)的平均
     # 也可以改為 shift(-7).rolling(7).mean() 等等看實際需求
-    df_price['MA7_future'] = df_price.groupby('Ticker')['Close'].transform(lambda x: x.shift(-6).rolling(7).mean())
+    df_price['MA7_future'] = df_price.groupby('Ticker')['Close'].transform(lambda x: x.shift(1 - future_window).rolling(future_window).mean())
 
     # 建立條件
     # (1) 當日收盤 <= 過去7日MA * 1.03
-    cond1 = df_price['Close'] <= df_price['MA7_past'] * 1.03
+    cond1 = df_price['Close'] <= df_price['MA7_past'] * past_tol
 
     # (2) 未來 7 日 MA >= current price
-    cond2 = df_price['MA7_future'] >= df_price['Close'] * 1.20
+    cond2 = df_price['MA7_future'] >= df_price['Close'] * future_gain
 
     df_price['is_signal'] = cond1 & cond2
 
-    # Mark rows where the next row's 'is_signal' is True
-    df_price['is_signal_next'] = df_price['is_signal'].shift(-1, fill_value=False)
+    # Mark rows where the next row's 'is_signal' is True (同一檔股票內)
+    # 原本是整個 frame 一起 shift，某檔最後一天會吃到下一檔第一天的 is_signal，現在改成每檔各自 shift
+    df_price['is_signal_next'] = df_price.groupby('Ticker')['is_signal'].shift(-1, fill_value=False)
 
     # 取出符合條件的 row
     df_signals = df_price[df_price['is_signal'] | df_price['is_signal_next']].copy()
     return df_signals
 
-def tag_price_files(price_files, start_date='2023-01-01'):
-    all_signals_list = []
-    
+def load_price_files(price_files, start_date='2023-01-01'):
+    """
+    read all price files once and return one typed DataFrame
+    Ticker 會去掉 .TW / .TWO，Date 為 datetime
+    """
+    price_list = []
     for f in price_files:
         df = pd.read_csv(f)
-        # 若有需要處理 Ticker 欄位（例如它可能是 "[1110.TW]" 這種格式），可在此處理
         df['Date'] = pd.to_datetime(df['Date'])
         df = df[df['Date'] >= start_date]
-        df['Ticker'] = df['Ticker'].str.replace(r'\.TWO|\.TW', '', regex=True)
+        price_list.append(df)
+
+    df_price = pd.concat(price_list, ignore_index=True)
+    df_price['Ticker'] = df_price['Ticker'].astype('string').str.replace(r'\.TWO|\.TW', '', regex=True)
+    return df_price
+
+
+def tag_price_files(price_files, start_date='2023-01-01', **signal_params):
+    """
+    price_files can be a list of csv paths or the DataFrame from load_price_files
+    signal_params 會傳給 get_signal_dates_from_price (past_window, future_gain ...)
+    """
+    if isinstance(price_files, pd.DataFrame):
+        df_price = price_files
+    else:
+        df_price = load_price_files(price_files, start_date)
 
-        df_signals = get_signal_dates_from_price(df)
-        all_signals_list.append(df_signals)
-    
     # 合併所有股票的 signal
-    df_all_signals = pd.concat(all_signals_list, ignore_index=True)
-    
+    df_all_signals = get_signal_dates_from_price(df_price, **signal_params)
+
     return df_all_signals
-    
 
 
 def build_volume_lookup(price_files, start_date='2023-01-01'):
     """
-    build a dict= {(Ticker, Date), value=Volume}
+    build a lookup table with columns [Ticker, Date, Volume]
+    Volume 以張為單位 (股數 / 1000)，price_files 可以是檔案列表或 load_price_files 的結果
     """
-    volume_dict = {}
-    
-    for f in price_files:
-        df_price = pd.read_csv(f)
-        df_price['Date'] = pd.to_datetime(df_price['Date'])
-        df_price = df_price[df_price['Date'] >= start_date]
+    if isinstance(price_files, pd.DataFrame):
+        df_price = price_files
+    else:
+        df_price = load_price_files(price_files, start_date)
+
+    df_volume = df_price[['Ticker', 'Date']].copy()
+    df_volume['Volume'] = df_price['Volume'] / 1000
+    # 同一天同一檔只留一筆，避免 merge 時把券商資料變多
+    return df_volume.drop_duplicates(['Ticker', 'Date'], keep='last').reset_index(drop=True)
+
+
+def concat_frames(frames):
+    """
+    pd.concat that keeps categorical columns categorical
+    各 frame 的 category 先換成同一份字典 (聯集)，不然 concat 會變回 object
+    (merge 之後 category 可能已經變回 object，這種 frame 就直接用它的值)
+    """
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            cats = np.unique(np.concatenate([
+                (f[col].cat.categories if isinstance(f[col].dtype, pd.CategoricalDtype) else f[col].dropna().unique())
+                .astype(str) for f in frames]))
+            dtype = pd.CategoricalDtype(cats)
+            frames = [f.assign(**{col: f[col].astype(str).astype(dtype)}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def collect_names(df_b, names):
+    """
+    keep Ticker -> Name and Branch_Code -> Branch in names so the columns can be dropped
+    """
+    for key, col in [('Ticker', 'Name'), ('Branch_Code', 'Branch')]:
+        pairs = df_b[[key, col]].drop_duplicates(key, keep='last')
+        names[col].update(zip(pairs[key].astype(str), pairs[col].astype(str)))
 
-        for idx, row in df_price.iterrows():
-            # 可能 row['Ticker'] = "[1110.TW]" 等，需要做字串清理
-            ticker_str = str(row['Ticker']).replace('.TWO', '').replace('.TW', '')
-                # .replace('[', '') \
-                # .replace(']', '') \
-                # .replace('(', '') \
-                # .replace(')', '') \
-                # .replace(r'\.TWO|\.TW', '')
-            date_str = row['Date'].strftime('%Y-%m-%d')
-            volume_dict[(ticker_str, date_str)] = row['Volume'] / 1000
 
-    return volume_dict
+def restore_names(df, names):
+    """
+    add Name / Branch back (for output), columns in the original broker_big_buy order
+    """
+    if names is None or 'Name' in df.columns:
+        return df
+    df = df.copy()
+    df['Name'] = df['Ticker'].astype(str).map(names['Name'])
+    df['Branch'] = df['Branch_Code'].astype(str).map(names['Branch'])
+    ordered = [c for c in BIG_BUY_DTYPES if c in df.columns]
+    return df[ordered + [c for c in df.columns if c not in ordered]]
 
 
-def big_buy_calc(broker_files,volume_dict):
+def read_broker_file(bf, compact=False, names=None):
+    """
+    read one branch file, compact=True 時用 COMPACT_BROKER_DTYPES 並丟掉 Name / Branch
+    """
+    df_b = pd.read_csv(bf, dtype=COMPACT_BROKER_DTYPES if compact else BROKER_DTYPES)
+    # 確保 Date 為 datetime
+    df_b['Date'] = pd.to_datetime(df_b['Date'])
+    if compact:
+        if names is not None:
+            collect_names(df_b, names)
+        df_b = df_b.drop(columns=['Name', 'Branch'])
+    return df_b
+
+
+def load_broker_files(broker_files, usecols=None, compact=False):
+    """
+    concat branch files (small_broker_trading schema) into one typed DataFrame
+    """
+    dtypes = COMPACT_BROKER_DTYPES if compact else BROKER_DTYPES
+    dtype = dtypes if usecols is None else {c: dtypes[c] for c in usecols}
+    df_list = [pd.read_csv(bf, dtype=dtype, usecols=usecols) for bf in broker_files]
+    df_b = concat_frames(df_list)
+    df_b['Date'] = pd.to_datetime(df_b['Date'])
+    return df_b
+
+
+def big_buy_calc(broker_files,df_volume, vol_ratio=0.18, avg_mult=2, avg_window=7, trading_dates=None,
+                 compact=False, names=None):
+    """
+    tag big buy rows of every branch file
+    df_volume 為 build_volume_lookup 的結果 [Ticker, Date, Volume]
+    big buy: diff >= vol_ratio * Volume，或 diff >= avg_mult * 前 avg_window 天 diff 平均
+    有給 trading_dates 時是前 avg_window 個交易日 (沒交易算 0)，否則是前 avg_window 筆交易
+    compact=True 時用省記憶體的欄位型態，Name / Branch 收進 names (見 restore_names)
+    """
 
     big_buy_result_list = []
 
     for idx, bf in enumerate(broker_files):
         print(f'--- Deal with {bf[-8:]} , process is {idx+1}/{len(broker_files)} ----')
-        df_b = pd.read_csv(bf,
-                            dtype={"Ticker":"string",
-                                    "Name":"string",
-                                    "buy":int,
-                                    "sell":int,
-                                    "diff":int,
-                                    "Branch":"string",
-                                    "Date":"string",
-                                    "Branch_Code":"string"})
-
-        # 確保 Date 為 datetime
-        df_b['Date'] = pd.to_datetime(df_b['Date'])
+        df_b = read_broker_file(bf, compact, names)
 
         # 依據欄位狀況調整；假設檔案欄位是:
         # Ticker,Name,buy,sell,diff,Branch,Date,Branch_Code
@@ -121,23 +233,31 @@ def big_buy_calc(broker_files,volume_dict):
         df_b = df_b.sort_values(['Ticker','Date']).reset_index(drop=True)
 
         # 新增一個「前 7 天 diff 平均」欄位
-        df_b['diff_7days_avg'] = df_b.groupby('Ticker')['diff'] \
-                                     .transform(lambda x: x.shift(1).rolling(7).mean())
-
-        # 新增一個 volume 欄位 (對每列做 apply)
-        def get_volume(row):
-            t = row['Ticker']  # e.g. "1605", "00632R"
-            d = row['Date'].strftime('%Y-%m-%d')
-            return volume_dict.get((t, d), 0)  # 沒找到就用 NaN
-
-        df_b['Volume'] = df_b.apply(get_volume, axis=1)
-
-        # 建立條件
-        cond1 = (df_b['diff'] >= 0.18 * df_b['Volume']) & (df_b['Volume']!=0) & (~df_b['Ticker'].str.startswith('0'))
-        cond2 = (df_b['diff'] >= 2 * df_b['diff_7days_avg']) & (~df_b['Ticker'].str.startswith('0'))
+        if trading_dates is None:
+            df_b['diff_7days_avg'] = df_b.groupby('Ticker')['diff'] \
+                                         .transform(lambda x: x.shift(1).rolling(avg_window).mean())
+        else:
+            df_b['diff_7days_avg'] = calendar_rolling_mean(df_b['diff'].to_numpy(),
+                                                           df_b.groupby('Ticker', sort=False, observed=True).ngroup().to_numpy(),
+                                                           to_ordinals(df_b['Date'], trading_dates),
+                                                           avg_window)
+
+        # 新增一個 volume 欄位 (用 merge 取代逐列 apply)，沒找到就用 0
+        df_b = df_b.merge(df_volume, on=['Ticker', 'Date'], how='left')
+        df_b['Volume'] = df_b['Volume'].fillna(0)
+        if compact:
+            # merge 會把 category key 變回 object
+            df_b['Ticker'] = df_b['Ticker'].astype('category')
+
+        # 建立條件 (float64 比較，compact 模式也一樣)
+        cond1 = (df_b['diff'] >= vol_ratio * df_b['Volume']) & (df_b['Volume']!=0) & (~df_b['Ticker'].str.startswith('0'))
+        cond2 = (df_b['diff'] >= avg_mult * df_b['diff_7days_avg']) & (~df_b['Ticker'].str.startswith('0'))
 
         df_b['is_big_buy_c1'] = cond1
         df_b['is_big_buy_c2'] = cond2
+        if compact:
+            # 條件算完才縮小
+            df_b['diff_7days_avg'] = df_b['diff_7days_avg'].astype('float32')
 
         # 篩出符合條件的 row
         df_big_buy = df_b[df_b['is_big_buy_c2'] | df_b['is_big_buy_c1']].copy()
@@ -152,118 +272,424 @@ def big_buy_calc(broker_files,volume_dict):
         del df_b
 
     # return big_buy_result_list
-    return pd.concat(big_buy_result_list, ignore_index=True)
+    return concat_frames(big_buy_result_list)
 
-def cheating_rate(df_signals, df_big_buy,save_dir,success_threshold):
-    df_signals = pd.read_csv(df_signals)
+def read_signals(path):
+    df_signals = pd.read_csv(path, dtype={'Ticker':'string'})
     df_signals['Date'] = pd.to_datetime(df_signals['Date'])
-    df_signals['Ticker'] = df_signals['Ticker'].astype(str)
-
-    df_big_buy = pd.read_csv(df_big_buy,
-                             thousands=',',
-                             dtype={'Ticker':'string',
-                                    'Name':'string',
-                                    'buy':int,
-                                    'sell':int,
-                                    'diff':int,
-                                    'Branch':'string',
-                                    'Date':'string',
-                                    'Branch_Code':'string',
-                                    'diff_7days_avg':float,
-                                    'Volume':float,
-                                    'is_big_buy_c1':bool,
-                                    'is_big_buy_c2':bool})
+    return df_signals
+
+
+def read_big_buy(path, compact=False):
+    df_big_buy = pd.read_csv(path, thousands=',', dtype=COMPACT_BIG_BUY_DTYPES if compact else BIG_BUY_DTYPES)
     df_big_buy['Date'] = pd.to_datetime(df_big_buy['Date'])
-    df_big_buy['Ticker'] = df_big_buy['Ticker'].astype(str)
+    return df_big_buy
+
 
+def empty_big_buy():
+    """big buy frame with no rows (compact dtypes, 不含 Name / Branch)"""
+    dtypes = {c: t for c, t in COMPACT_BIG_BUY_DTYPES.items() if c not in ('Name', 'Branch')}
+    df = pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtypes.items()})
+    df['Date'] = pd.to_datetime(df['Date'])
+    return df
+
+
+def calc_success_rate(df_signals, df_big_buy, lead_days=None, trading_dates=None):
+    """
+    match big buy rows to signals, return (df_merged, df_stat, df_stat_bt)
+    df_stat 為每個分點的成功率，df_stat_bt 為每個 (分點, 股票) 的成功率
+    lead_days 為 None 時用 (Ticker, Date) exact merge；
+    否則算 signal 開始前 lead_days 個交易日內的 big buy (見 interval_join.window_join)
+    """
     # 合併
-    df_merged = pd.merge(
-        df_big_buy, 
-        df_signals[['Ticker','Date']], 
-        on=['Ticker','Date'], 
-        how='inner'
-    )
-    df_merged.to_csv(save_dir+'broker_big_buy_success.csv', index=False)
+    if lead_days is None:
+        df_merged = pd.merge(
+            df_big_buy, 
+            df_signals[['Ticker','Date']], 
+            on=['Ticker','Date'], 
+            how='inner'
+        )
+    else:
+        df_merged = window_join(df_big_buy, df_signals, lead_days, trading_dates)
 
     # 計算成功率
     # - total_count: 該券商(或分點)的「大量買入」次數
     # - success_count: 該券商(或分點)與 signal match 的次數
-    df_total = df_big_buy.groupby('Branch_Code').size().reset_index(name='total_count')
-    df_success = df_merged.groupby('Branch_Code').size().reset_index(name='success_count')
+    df_total = df_big_buy.groupby('Branch_Code', observed=True).size().reset_index(name='total_count')
+    df_success = df_merged.groupby('Branch_Code', observed=True).size().reset_index(name='success_count')
 
     df_stat = pd.merge(df_total, df_success, on='Branch_Code', how='left')
-    df_stat['success_rate'] = df_stat['success_count'] / df_stat['total_count'] * 100
-    df_stat.fillna({'success_count': 0, 'success_rate': 0}, inplace=True)
-
-    df_stat.to_csv(save_dir+'broker_success_rate.csv', index=False)
 
     #success rate to a every ticker
-    df_total_bt = df_big_buy.groupby(['Branch_Code','Ticker']).size().reset_index(name='total_count')
-    df_success_bt = df_merged.groupby(['Branch_Code','Ticker']).size().reset_index(name='success_count')
+    df_total_bt = df_big_buy.groupby(['Branch_Code','Ticker'], observed=True).size().reset_index(name='total_count')
+    df_success_bt = df_merged.groupby(['Branch_Code','Ticker'], observed=True).size().reset_index(name='success_count')
     df_stat_bt = pd.merge(df_total_bt, df_success_bt, on=['Branch_Code','Ticker'], how='left')
+
+    df_stat, df_stat_bt = success_rate_tables(df_stat, df_stat_bt)
+    return df_merged, df_stat, df_stat_bt
+
+
+def success_rate_tables(df_stat, df_stat_bt):
+    """
+    compute the success rate columns from total_count / success_count (沒有成功的 success_count 為 NaN)
+    """
+    df_stat['success_rate'] = df_stat['success_count'] / df_stat['total_count'] * 100
+    df_stat.fillna({'success_count': 0, 'success_rate': 0}, inplace=True)
+
     df_stat_bt['success_count'] = df_stat_bt['success_count'].fillna(0).astype(int)
     df_stat_bt['success_rate'] = df_stat_bt['success_count'] / df_stat_bt['total_count']
     df_stat_bt['success_rate_percent'] = df_stat_bt['success_rate'] * 100
+    return df_stat, df_stat_bt
 
-    df_stat_bt.to_csv(save_dir+'broker_branch_ticker_success_rate.csv', index=False)
 
-    #calc today big buy branch
-    success_rate_file = save_dir+'broker_branch_ticker_success_rate.csv'
-    df_success_rate = pd.read_csv(success_rate_file,
-                                  dtype={"Branch_Code":"string","Ticker":"string"})
+def find_today_cheaters(df_big_buy, df_stat_bt, success_threshold, names=None):
+    """
+    calc today big buy branch, return the rows whose (Branch_Code, Ticker) success rate > success_threshold
+    """
     # 篩選出成功率 > 0.49
-    df_high_sr = df_success_rate[df_success_rate['success_rate'] > success_threshold].copy()
-    # 先做成 (Branch_Code, Ticker) set 以便快速比對
-    high_sr_pairs = set(zip(df_high_sr['Branch_Code'], df_high_sr['Ticker']))
+    df_high_sr = df_stat_bt[df_stat_bt['success_rate'] > success_threshold]
     
     latest_date = df_big_buy['Date'].max()
-    df_latest_day = df_big_buy[df_big_buy['Date'] == latest_date].copy()
+    df_latest_day = restore_names(df_big_buy[df_big_buy['Date'] == latest_date], names)
     if df_latest_day.empty:
         print(f"No branch big buy today {latest_date}")
+        return df_latest_day.iloc[0:0]
+
+    print(f'There are {len(df_latest_day)} big buy data for today {latest_date}')
+    df_merge_cheater = pd.merge(
+        df_latest_day,
+        df_high_sr[['Branch_Code','Ticker','success_rate']],  # 只帶需要的欄位
+        on=['Branch_Code','Ticker'],
+        how='inner'
+    )
+    if df_merge_cheater.empty:
+        print('No cheater bought previous ticker today ')
     else:
-        print(f'There are {len(df_latest_day)} big buy data for today {latest_date}')
-        df_merge_cheater = pd.merge(
-            df_latest_day,
-            df_high_sr[['Branch_Code','Ticker','success_rate']],  # 只帶需要的欄位
-            on=['Branch_Code','Ticker'],
-            how='inner'
-        )
-        if df_merge_cheater.empty:
-            print('No cheater bought previous ticker today ')
+        print('Cheaters bought:')
+        print(df_merge_cheater[['Branch','Ticker','Date','diff','Volume','success_rate']].to_string(index=False))
+    return df_merge_cheater
+
+
+def save_frames(frames, save_dir, executor=None, append=False):
+    """
+    write {file_name: DataFrame} to save_dir
+    若有給 executor (例如 ThreadPoolExecutor)，寫檔會在背景執行，回傳 futures
+    append=True 時接在既有檔案後面 (不寫 header)
+    """
+    save_dir = os.path.expanduser(save_dir)
+    os.makedirs(save_dir, exist_ok=True)
+
+    futures = []
+    for file_name, df in frames.items():
+        path = os.path.join(save_dir, file_name)
+        kwargs = {'index': False}
+        if append and os.path.isfile(path):
+            kwargs.update(mode='a', header=False)
+        if executor is None:
+            df.to_csv(path, **kwargs)
         else:
-            print('Cheaters bought:')
-            print(df_merge_cheater[['Branch','Ticker','Date','diff','Volume','success_rate']].to_string(index=False))
-            df_merge_cheater.to_csv(save_dir+'cheater_today_bought.csv', index=False)
+            futures.append(executor.submit(df.to_csv, path, **kwargs))
+    return futures
 
 
-if __name__ == '__main__':
+def cheating_rate(df_signals, df_big_buy,save_dir,success_threshold, executor=None,
+                  lead_days=None, trading_dates=None, compact=False, names=None):
+    """
+    df_signals / df_big_buy 可以是 DataFrame 或 csv 路徑
+    save_dir 為 None 時不寫檔，只回傳結果
+    """
+    if not isinstance(df_signals, pd.DataFrame):
+        df_signals = read_signals(df_signals)
+    if not isinstance(df_big_buy, pd.DataFrame):
+        df_big_buy = read_big_buy(df_big_buy, compact)
 
+    df_merged, df_stat, df_stat_bt = calc_success_rate(df_signals, df_big_buy, lead_days, trading_dates)
+    df_cheater = find_today_cheaters(df_big_buy, df_stat_bt, success_threshold, names)
 
-    price_folder = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/AllStockHist'
-    price_files = list_csv_files(price_folder)
+    if save_dir is not None:
+        frames = {'broker_big_buy_success.csv': restore_names(df_merged, names),
+                  'broker_success_rate.csv': df_stat,
+                  'broker_branch_ticker_success_rate.csv': df_stat_bt}
+        if not df_cheater.empty:
+            frames['cheater_today_bought.csv'] = df_cheater
+        save_frames(frames, save_dir, executor)
 
-    #Deal with stock hist data, add signal dates in
-    df_all_signals = tag_price_files(price_files)
-    df_all_signals.to_csv('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result/big_gain_signals.csv', index=False)
+    return {'success': df_merged,
+            'success_rate': df_stat,
+            'branch_ticker_success_rate': df_stat_bt,
+            'cheater_today': df_cheater}
+
+
+def choose_memory_plan(broker_files, max_memory_mb):
+    """
+    decide (compact, batch_size) so the broker data fits in max_memory_mb
+    先試原本的型態，不夠就用 compact，再不夠就分批 (batch_size 個分點檔一批)
+    """
+    if max_memory_mb is None or not broker_files:
+        return False, None
+
+    sizes = [os.path.getsize(os.path.expanduser(f)) for f in broker_files]
+    budget = max_memory_mb * 1024 * 1024
+    if sum(sizes) * FRAME_BYTES_PER_CSV_BYTE['full'] <= budget:
+        return False, None
+    if sum(sizes) * FRAME_BYTES_PER_CSV_BYTE['compact'] <= budget:
+        return True, None
+
+    per_file = max(sizes) * FRAME_BYTES_PER_CSV_BYTE['compact']
+    return True, max(1, int(budget // per_file))
 
 
+def run_batches(df_all_signals, broker_files, df_volume, save_dir, success_threshold, batch_size,
+                lead_days=None, trading_dates=None, compact=False):
+    """
+    process batch_size branch files at a time, big buy 結果直接 append 到檔案，不留在記憶體
+    每個分點檔只有一個分點，所以每批的成功率統計可以直接接起來
+    """
+    names = {'Name': {}, 'Branch': {}} if compact else None
+    stat_list, stat_bt_list, latest_list = [], [], []
+
+    for i in range(0, len(broker_files), batch_size):
+        batch = broker_files[i:i + batch_size]
+        print(f'=== Batch {i // batch_size + 1}/{(len(broker_files) - 1) // batch_size + 1} ===')
+        df_bb = big_buy_calc(batch, df_volume, trading_dates=trading_dates, compact=compact, names=names)
+        df_merged, df_stat, df_stat_bt = calc_success_rate(df_all_signals, df_bb, lead_days, trading_dates)
+
+        stat_list.append(df_stat)
+        stat_bt_list.append(df_stat_bt)
+        latest_list.append(df_bb[df_bb['Date'] == df_bb['Date'].max()])
+
+        if save_dir is not None:
+            # 同一個檔案要依序 append，所以這裡不用背景寫檔
+            save_frames({'broker_big_buy.csv': restore_names(df_bb, names),
+                         'broker_big_buy_success.csv': restore_names(df_merged, names)},
+                        save_dir, append=i > 0)
+        del df_bb, df_merged
+
+    df_stat = concat_frames(stat_list)
+    df_stat_bt = concat_frames(stat_bt_list)
+    df_cheater = find_today_cheaters(concat_frames(latest_list), df_stat_bt, success_threshold, names)
+
+    if save_dir is not None:
+        frames = {'broker_success_rate.csv': df_stat,
+                  'broker_branch_ticker_success_rate.csv': df_stat_bt}
+        if not df_cheater.empty:
+            frames['cheater_today_bought.csv'] = df_cheater
+        save_frames(frames, save_dir)
+
+    return {'success': None,
+            'success_rate': df_stat,
+            'branch_ticker_success_rate': df_stat_bt,
+            'cheater_today': df_cheater}
+
+
+def stream_big_buy(input_paths, df_volume, trading_dates, chunksize=500000,
+                   vol_ratio=0.18, avg_mult=2, avg_window=7, names=None):
+    """
+    generator: read the trade history in bounded chunks and yield the big buy rows of each chunk
+    每個分點檔只有一個分點，每個 (分點, 股票) 的資料要依日期排列
+    rolling window 需要的最近 avg_window 個交易日資料 (tail) 和每組第一天會帶到同一個檔案的下一個 chunk，
+    換檔時清掉，所以記憶體只跟 chunksize 和單一分點的股票數有關，跟分點數、資料年數無關
+    """
+    for path in input_paths:
+        tail = None
+        first_ord = pd.Series(dtype='int64')
+        reader = pd.read_csv(os.path.expanduser(path), chunksize=chunksize, thousands=',',
+                             dtype=COMPACT_BROKER_DTYPES)
+        for chunk in reader:
+            chunk['Date'] = pd.to_datetime(chunk['Date'])
+            if names is not None:
+                collect_names(chunk, names)
+            chunk = chunk.drop(columns=['Name', 'Branch'])
+            chunk['ord'] = to_ordinals(chunk['Date'], trading_dates)
+            chunk['is_new'] = True
+
+            # 比這個 chunk 第一天早 avg_window 天以上的 tail 不會再用到
+            if tail is not None and len(chunk):
+                tail = tail[tail['ord'] >= chunk['ord'].min() - avg_window]
+            df_b = chunk if tail is None else concat_frames([tail, chunk])
+            df_b = df_b.sort_values(['Branch_Code', 'Ticker', 'ord'], kind='stable').reset_index(drop=True)
+            key = df_b['Branch_Code'].astype(str) + '|' + df_b['Ticker'].astype(str)
+            pair = df_b.groupby(['Branch_Code', 'Ticker'], sort=False, observed=True).ngroup().to_numpy()
+            ords = df_b['ord'].to_numpy()
+
+            # 每組第一天：之前的 chunk 看過就用之前的
+            window_sum, group_first = calendar_rolling_sum(df_b['diff'].to_numpy(), pair, ords, avg_window)
+            first = np.fmin(first_ord.reindex(key).to_numpy(dtype=float), group_first)
+            df_b['diff_7days_avg'] = np.where(first <= ords - avg_window, window_sum / avg_window, np.nan)
+            first_ord = first_ord.combine_first(pd.Series(group_first, index=key).groupby(level=0).min())
+
+            # 下一個 chunk 只需要每組最後 avg_window 個交易日
+            last_ord = df_b.groupby(pair)['ord'].transform('max')
+            tail = df_b.loc[(ords >= last_ord - avg_window),
+                            ['Ticker', 'buy', 'sell', 'diff', 'Date', 'Branch_Code', 'ord']].assign(is_new=False)
+
+            df_b = df_b[df_b['is_new']].drop(columns=['ord', 'is_new'])
+            df_b = df_b.merge(df_volume, on=['Ticker', 'Date'], how='left')
+            df_b['Ticker'] = df_b['Ticker'].astype('category')
+            df_b['Volume'] = df_b['Volume'].fillna(0)
+
+            # 建立條件 (同 big_buy_calc，float64 比較)
+            cond1 = (df_b['diff'] >= vol_ratio * df_b['Volume']) & (df_b['Volume']!=0) & (~df_b['Ticker'].str.startswith('0'))
+            cond2 = (df_b['diff'] >= avg_mult * df_b['diff_7days_avg']) & (~df_b['Ticker'].str.startswith('0'))
+            df_b['is_big_buy_c1'] = cond1
+            df_b['is_big_buy_c2'] = cond2
+            df_b['diff_7days_avg'] = df_b['diff_7days_avg'].astype('float32')
+
+            yield df_b[cond1 | cond2]
+
+
+def run_streaming(price_files, input_paths, save_dir=None, success_threshold=0.49,
+                  start_date='2023-01-01', chunksize=500000, lead_days=None):
+    """
+    out-of-core version of run_analysis
+    big buy / success 結果每個 chunk 直接 append 到檔案，成功次數用累加的方式合併
+    """
+    df_price = load_price_files(price_files, start_date)
+    trading_dates = np.sort(df_price['Date'].unique())
+    df_all_signals = tag_price_files(df_price)
+    df_volume = build_volume_lookup(df_price)
+    del df_price
+
+    if save_dir is not None:
+        save_frames({'big_gain_signals.csv': df_all_signals}, save_dir)
+
+    names = {'Name': {}, 'Branch': {}}
+    stat, stat_bt, latest = None, None, None
+    written = False
+
+    for i, df_bb in enumerate(stream_big_buy(input_paths, df_volume, trading_dates, chunksize, names=names)):
+        print(f'--- Stream chunk {i+1}: {len(df_bb)} big buy rows ----')
+        if df_bb.empty:
+            continue
+        df_merged, df_stat, df_stat_bt = calc_success_rate(df_all_signals, df_bb, lead_days, trading_dates)
+
+        # 累加成功次數 (同一個分點可能出現在很多個 chunk)
+        df_stat = df_stat[['Branch_Code', 'total_count', 'success_count']]
+        df_stat_bt = df_stat_bt[['Branch_Code', 'Ticker', 'total_count', 'success_count']]
+        stat = df_stat if stat is None else concat_frames([stat, df_stat]) \
+            .groupby('Branch_Code', observed=True, as_index=False).sum(min_count=1)
+        stat_bt = df_stat_bt if stat_bt is None else concat_frames([stat_bt, df_stat_bt]) \
+            .groupby(['Branch_Code', 'Ticker'], observed=True, as_index=False).sum()
+
+        # 只留目前最新一天的 big buy，最後拿來找今天的 cheater
+        df_last = df_bb[df_bb['Date'] == df_bb['Date'].max()]
+        if latest is None or df_last['Date'].iloc[0] > latest['Date'].iloc[0]:
+            latest = df_last
+        elif df_last['Date'].iloc[0] == latest['Date'].iloc[0]:
+            latest = concat_frames([latest, df_last])
+
+        if save_dir is not None:
+            save_frames({'broker_big_buy.csv': restore_names(df_bb, names),
+                         'broker_big_buy_success.csv': restore_names(df_merged, names)},
+                        save_dir, append=written)
+            written = True
+
+    # 沒有資料或沒有任何 big buy：用空的 big buy 算，輸出空表 (同 run_analysis)
+    if stat is None:
+        latest = empty_big_buy()
+        df_merged, stat, stat_bt = calc_success_rate(df_all_signals, latest, lead_days, trading_dates)
+        if save_dir is not None:
+            save_frames({'broker_big_buy.csv': restore_names(latest, names),
+                         'broker_big_buy_success.csv': restore_names(df_merged, names)}, save_dir)
+
+    df_stat, df_stat_bt = success_rate_tables(stat, stat_bt)
+    df_cheater = find_today_cheaters(latest, df_stat_bt, success_threshold, names)
+
+    if save_dir is not None:
+        frames = {'broker_success_rate.csv': df_stat,
+                  'broker_branch_ticker_success_rate.csv': df_stat_bt}
+        if not df_cheater.empty:
+            frames['cheater_today_bought.csv'] = df_cheater
+        save_frames(frames, save_dir)
+
+    return {'success': None,
+            'success_rate': df_stat,
+            'branch_ticker_success_rate': df_stat_bt,
+            'cheater_today': df_cheater,
+            'signals': df_all_signals,
+            'big_buy': None}
+
+
+def run_analysis(price_files, broker_files, save_dir=None, success_threshold=0.49,
+                 start_date='2023-01-01', executor=None, lead_days=None,
+                 compact=False, batch_size=None):
+    """
+    whole analysis in memory: tag_price_files -> big_buy_calc -> cheating_rate
+    各階段直接傳 DataFrame，不再寫檔後重讀。save_dir 有給才會另外存檔
+    batch_size 有給時分批處理分點檔 (見 run_batches)，回傳結果不含 big_buy / success
+    """
+    df_price = load_price_files(price_files, start_date)
+    trading_dates = np.sort(df_price['Date'].unique())
+
+    #Deal with stock hist data, add signal dates in
+    df_all_signals = tag_price_files(df_price)
+
     #Deal with brocker trading data, tag big buy date and tickers
-    volume_dict = build_volume_lookup(price_files, start_date='2023-01-01')
+    df_volume = build_volume_lookup(df_price)
+    del df_price
+
+    if batch_size is not None:
+        if save_dir is not None:
+            save_frames({'big_gain_signals.csv': df_all_signals}, save_dir, executor)
+        results = run_batches(df_all_signals, broker_files, df_volume, save_dir, success_threshold,
+                              batch_size, lead_days, trading_dates, compact)
+        results['signals'] = df_all_signals
+        results['big_buy'] = None
+        return results
+
+    names = {'Name': {}, 'Branch': {}} if compact else None
+    df_broker_big_buy = big_buy_calc(broker_files, df_volume, trading_dates=trading_dates,
+                                     compact=compact, names=names)
+
+    if save_dir is not None:
+        save_frames({'big_gain_signals.csv': df_all_signals,
+                     'broker_big_buy.csv': restore_names(df_broker_big_buy, names)},
+                    save_dir, executor)
+
+    #calculate success rate
+    results = cheating_rate(df_all_signals, df_broker_big_buy, save_dir, success_threshold, executor,
+                            lead_days, trading_dates, names=names)
+    results['signals'] = df_all_signals
+    results['big_buy'] = df_broker_big_buy
+    return results
+
+
+def main(argv=None):
+    """
+    command line entry, pipeline 在同一個 process 裡直接呼叫 main([])
+    """
+    parser = argparse.ArgumentParser(description='Find branches that big buy right before a big gain')
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help='memory budget in MB, use compact dtypes / batches when the data would exceed it')
+    parser.add_argument('--compact', action='store_true', help='always use compact dtypes')
+    parser.add_argument('--stream', action='store_true',
+                        help='out-of-core mode, read the branch files in bounded chunks')
+    parser.add_argument('--chunksize', type=int, default=500000, help='rows per chunk in --stream mode')
+    args = parser.parse_args(argv)
+
+    price_folder = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/AllStockHist'
+    price_files = list_csv_files(price_folder)
+
     # broker_trading_folder = 'small_broker_trading'
     # broker_files = ['~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/small_broker_trading/9661.csv']
     broker_files = list_csv_files('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/small_broker_trading')
-    df_broker_big_buy = big_buy_calc(broker_files,volume_dict)  # 用來裝所有檔案計算出的大量買入紀錄
-    df_broker_big_buy.to_csv('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result/broker_big_buy.csv', index=False)
-
-
-    #calculate success rate
-    big_gain_signals_path = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result/big_gain_signals.csv'
-    broker_big_buy_path = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result/broker_big_buy.csv'
     save_dir = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result/'
-    cheating_rate(big_gain_signals_path,broker_big_buy_path, save_dir,0.49)
 
-    print('--Finish broker_analyze--')
+    if args.stream:
+        run_streaming(price_files, broker_files, save_dir, 0.49, chunksize=args.chunksize)
+    else:
+        compact, batch_size = choose_memory_plan(broker_files, args.max_memory)
+        compact = compact or args.compact
+        if args.max_memory is not None:
+            print(f'Memory budget {args.max_memory} MB -> compact={compact}, batch_size={batch_size}')
 
+        # 寫檔交給背景 thread，離開 with 時會等所有檔案寫完
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            run_analysis(price_files, broker_files, save_dir, 0.49, executor=executor,
+                         compact=compact, batch_size=batch_size)
 
+    print('--Finish broker_analyze--')
 
 
+if __name__ == '__main__':
+    main()
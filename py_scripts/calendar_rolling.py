@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+
+def to_ordinals(dates, trading_dates):
+    """
+    map dates to trading day ordinals (index in the sorted trading_dates)
+    """
+    return np.searchsorted(np.asarray(trading_dates), pd.to_datetime(dates).to_numpy()).astype(np.int64)
+
+
+def calendar_rolling_sum(values, group, ords, window):
+    """
+    sum of values over the previous `window` trading days [t - window, t - 1] of the same group
+    沒有交易的日子當作 0，只用稀疏事件的累加和，不需要把每個 (分點, 股票) reindex 到完整日曆
+    資料需依 (group, ords) 排序
+    return (window_sum, first_ord) ，first_ord 為該 group 第一筆資料的 ordinal
+    """
+    group = np.asarray(group, dtype=np.int64)
+    ords = np.asarray(ords, dtype=np.int64)
+    n = len(ords)
+    if n == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+
+    span = int(ords.max()) + window + 1
+    key = group * span + ords
+
+    prefix = np.zeros(n + 1, dtype=np.result_type(values, np.int64))
+    np.cumsum(values, out=prefix[1:])
+
+    lo = np.searchsorted(key, key - window, side='left')
+    hi = np.searchsorted(key, key, side='left')   # 不含當天
+
+    group_start = np.searchsorted(key, group * span, side='left')
+    return prefix[hi] - prefix[lo], ords[group_start]
+
+
+def calendar_rolling_mean(values, group, ords, window):
+    """
+    calendar-aware version of groupby(...).shift(1).rolling(window).mean()
+    group 的歷史還不滿 window 個交易日時為 NaN (和 rolling 需要滿 window 筆的行為一致)
+    """
+    window_sum, first_ord = calendar_rolling_sum(values, group, ords, window)
+    ords = np.asarray(ords, dtype=np.int64)
+    return np.where(first_ord <= ords - window, window_sum / window, np.nan)
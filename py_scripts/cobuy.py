@@ -0,0 +1,229 @@
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from calendar_rolling import to_ordinals
+
+CALC_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result'
+TRADINGDATE_FILE = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/Tradingdate.csv'
+PAIR_COLUMNS = ['Branch_Code_a', 'Branch_Code_b', 'events_a', 'events_b', 'co_events', 'expected', 'lift',
+                'jaccard']
+CLUSTER_COLUMNS = ['cluster', 'cluster_size', 'Branch_Code', 'Branch', 'events', 'shared_events', 'mean_jaccard',
+                   'mean_lift', 'top_tickers']
+
+
+# -------------------------------------------------------------------
+# Co-buying clusters
+#   B: 分點 x (股票, 交易日) 的 big buy incidence matrix (0/1, scipy.sparse)
+#      column = ticker_id * n_days + 交易日 ordinal
+#   E: 同樣的 B 但每個 big buy 往前後各擴 window 個交易日 (同一檔股票)
+#   M = B @ E.T  M[i, j] = 分點 i 的 big buy 裡，分點 j 在 window 天內也 big buy 同一檔的次數
+#   co_events = (M + M.T) / 2，jaccard = co / (n_i + n_j - co)
+#   expected: 兩個分點各自買的股票不變、日期隨機時的 co_events (每檔股票分開算)，
+#             lift = co_events / expected，只是常買同幾檔熱門股的分點 lift 會接近 1
+#   co_events >= min_co、jaccard >= min_jaccard 且 lift >= min_lift 的分點連成一群 (connected components)
+#   全部都是 sparse，分點 x 分點的結果也只存有共同 big buy 的組合
+# -------------------------------------------------------------------
+def incidence(df_big_buy, trading_dates=None, exclude_etf=True, max_branches=None):
+    """
+    build B from big buy rows (Branch_Code, Ticker, Date)
+    max_branches: 同一天同一檔被超過這麼多分點 big buy 的 (大行情) 不算
+    return (B as csr, branch codes, tickers, n_days)
+    """
+    df = df_big_buy[['Branch_Code', 'Ticker', 'Date']].copy()
+    if exclude_etf:
+        df = df[~df['Ticker'].astype(str).str.startswith('0')]
+    if trading_dates is None:
+        trading_dates = np.unique(pd.to_datetime(df['Date']).to_numpy())
+    trading_dates = np.sort(pd.to_datetime(np.asarray(trading_dates)).to_numpy())
+
+    branch_id, branches = pd.factorize(df['Branch_Code'].astype(str), sort=True)
+    ticker_id, tickers = pd.factorize(df['Ticker'].astype(str), sort=True)
+    n_days = len(trading_dates)
+    cols = ticker_id.astype(np.int64) * n_days + to_ordinals(df['Date'], trading_dates)
+
+    B = sparse.csr_matrix((np.ones(len(df), dtype=np.float32), (branch_id, cols)),
+                          shape=(len(branches), len(tickers) * n_days))
+    B.sum_duplicates()
+    B.data[:] = 1
+    if max_branches is not None:
+        crowded = np.flatnonzero(np.asarray(B.sum(axis=0)).ravel() > max_branches)
+        if len(crowded):
+            keep = np.ones(B.shape[1], dtype=np.float32)
+            keep[crowded] = 0
+            B = B @ sparse.diags(keep, format='csr')
+            B.eliminate_zeros()
+    return B, np.asarray(branches), np.asarray(tickers), n_days
+
+
+def spread(B, n_days, window):
+    """E: every event of B widened to [day - window, day + window] of the same ticker (0/1)"""
+    if window == 0:
+        return B.copy()
+    coo = B.tocoo()
+    day = coo.col % n_days
+    rows, cols = [], []
+    for k in range(-window, window + 1):
+        ok = (day + k >= 0) & (day + k < n_days)
+        rows.append(coo.row[ok])
+        cols.append(coo.col[ok] + k)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    E = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=B.shape)
+    E.sum_duplicates()
+    E.data[:] = 1
+    return E
+
+
+def co_occurrence(B, E):
+    """
+    symmetric co_events matrix (sparse, 對角線是 0) and events per branch
+    """
+    M = (B @ E.T).tocsr()
+    co = ((M + M.T) / 2).tocsr()
+    co.setdiag(0)
+    co.eliminate_zeros()
+    return co, np.asarray(B.sum(axis=1)).ravel()
+
+
+def expected_co(B, E, n_days):
+    """
+    co_events expected by chance: 每檔股票 big buy 次數 x 另一個分點 E 涵蓋的天數比例
+    用 分點 x 股票 的計數矩陣相乘，和 co_occurrence 一樣是 sparse
+    """
+    n_tickers = B.shape[1] // n_days
+    to_ticker = sparse.csr_matrix((np.ones(B.shape[1], dtype=np.float32),
+                                   (np.arange(B.shape[1]), np.arange(B.shape[1]) // n_days)),
+                                  shape=(B.shape[1], n_tickers))
+    X = ((B @ to_ticker) @ (E @ to_ticker).T / n_days).tocsr()
+    return ((X + X.T) / 2).tocsr()
+
+
+def _edges(co, expected, n_events):
+    """(i, j, co_events, expected, lift, jaccard) of every pair with common big buys"""
+    coo = co.tocoo()
+    i, j, c = coo.row, coo.col, coo.data
+    exp = np.asarray(expected[i, j]).ravel()
+    lift = np.divide(c, exp, out=np.full(len(c), np.inf), where=exp > 0)
+    return i, j, c, exp, lift, c / (n_events[i] + n_events[j] - c)
+
+
+def pair_table(co, expected, n_events, branches, min_co=1):
+    """branch pairs with co_events >= min_co, 依 lift 排序"""
+    i, j, c, exp, lift, jaccard = _edges(co, expected, n_events)
+    keep = (i < j) & (c >= min_co)
+    i, j = i[keep], j[keep]
+    df = pd.DataFrame({'Branch_Code_a': branches[i], 'Branch_Code_b': branches[j],
+                       'events_a': n_events[i].astype(int), 'events_b': n_events[j].astype(int),
+                       'co_events': c[keep], 'expected': exp[keep], 'lift': lift[keep], 'jaccard': jaccard[keep]},
+                      columns=PAIR_COLUMNS)
+    return df.sort_values(['lift', 'co_events'], ascending=False).reset_index(drop=True)
+
+
+def shared_events(B_sub, E_sub):
+    """
+    events of B_sub that another row of E_sub also covers (同群其他分點 window 天內也 big buy 同一檔)
+    E_sub 是 0/1 而且涵蓋自己的事件，所以 column 合計 >= 2 就代表有別人
+    """
+    colsum = np.asarray(E_sub.sum(axis=0)).ravel()
+    coo = B_sub.tocoo()
+    ok = colsum[coo.col] >= 2
+    return sparse.csr_matrix((coo.data[ok], (coo.row[ok], coo.col[ok])), shape=B_sub.shape)
+
+
+def clusters(B, E, co, expected, n_events, branches, tickers, n_days, min_co=5, min_jaccard=0.1, min_lift=2.0,
+             top=5, names=None):
+    """
+    connected components of the graph with edges co_events >= min_co, jaccard >= min_jaccard, lift >= min_lift
+    只回傳兩個分點以上的群，每個分點一列
+    shared_events: 這個分點的 big buy 裡，同群其他分點在 window 天內也 big buy 同一檔的次數
+    top_tickers:   群裡最常一起 big buy 的股票 (股票:次數)
+    """
+    i, j, c, _, lift, jaccard = _edges(co, expected, n_events)
+    keep = (c >= min_co) & (jaccard >= min_jaccard) & (lift >= min_lift)
+    graph = sparse.csr_matrix((jaccard[keep], (i[keep], j[keep])), shape=co.shape)
+    lifts = sparse.csr_matrix((np.minimum(lift[keep], 1e9), (i[keep], j[keep])), shape=co.shape)
+    _, labels = connected_components(graph, directed=False)
+
+    sizes = np.bincount(labels)
+    rows = []
+    for cluster_no, label in enumerate(sorted(np.flatnonzero(sizes >= 2), key=lambda l: -sizes[l])):
+        members = np.flatnonzero(labels == label)
+        sub = graph[members][:, members]
+        mean_jaccard = sub.data.mean() if sub.nnz else np.nan
+        mean_lift = lifts[members][:, members].data.mean() if sub.nnz else np.nan
+        shared = shared_events(B[members], E[members])
+        counts = np.bincount(shared.tocoo().col // n_days, minlength=len(tickers))
+        top_ids = np.argsort(-counts)[:top]
+        top_tickers = ' '.join(f'{tickers[t]}:{counts[t]}' for t in top_ids if counts[t] > 0)
+        per_branch = np.asarray(shared.sum(axis=1)).ravel()
+        for k, m in enumerate(members):
+            rows.append({'cluster': cluster_no, 'cluster_size': len(members), 'Branch_Code': branches[m],
+                         'Branch': None if names is None else names.get(branches[m]),
+                         'events': int(n_events[m]), 'shared_events': int(per_branch[k]),
+                         'mean_jaccard': mean_jaccard, 'mean_lift': mean_lift, 'top_tickers': top_tickers})
+    return pd.DataFrame(rows, columns=CLUSTER_COLUMNS)
+
+
+def run(df_big_buy, trading_dates=None, window=1, min_co=5, min_jaccard=0.1, min_lift=2.0, exclude_etf=True,
+        max_branches=None, start=None, end=None):
+    """
+    return {'pairs': DataFrame, 'clusters': DataFrame}
+    """
+    t0 = time.perf_counter()
+    df = df_big_buy
+    if start is not None:
+        df = df[pd.to_datetime(df['Date']) >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[pd.to_datetime(df['Date']) <= pd.Timestamp(end)]
+    names = dict(zip(df['Branch_Code'].astype(str), df['Branch'])) if 'Branch' in df.columns else None
+
+    B, branches, tickers, n_days = incidence(df, trading_dates, exclude_etf, max_branches)
+    E = spread(B, n_days, window)
+    co, n_events = co_occurrence(B, E)
+    expected = expected_co(B, E, n_days)
+    print(f"Co-buying: {B.shape[0]} branches x {B.shape[1]} (ticker, day) columns, {B.nnz} big buys, "
+          f"{co.nnz // 2} branch pairs with common big buys ({time.perf_counter() - t0:.1f}s)")
+
+    df_pairs = pair_table(co, expected, n_events, branches, min_co)
+    df_clusters = clusters(B, E, co, expected, n_events, branches, tickers, n_days, min_co, min_jaccard, min_lift,
+                           names=names)
+    print(f"{len(df_pairs)} pairs with >= {min_co} common big buys, "
+          f"{df_clusters['cluster'].nunique()} clusters ({len(df_clusters)} branches)")
+    return {'pairs': df_pairs, 'clusters': df_clusters}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find branches that big-buy the same tickers around the same days')
+    parser.add_argument('--calc-dir', type=str, default=CALC_DIR)
+    parser.add_argument('--window', type=int, default=1, help='trading days apart that still count as together')
+    parser.add_argument('--min-co', type=int, default=5, help='common big buys needed for an edge')
+    parser.add_argument('--min-jaccard', type=float, default=0.1, help='similarity needed for an edge')
+    parser.add_argument('--min-lift', type=float, default=2.0,
+                        help='common big buys / expected by chance needed for an edge')
+    parser.add_argument('--max-branches', type=int, default=None,
+                        help='ignore (ticker, day) big-bought by more branches than this')
+    parser.add_argument('--include-etf', action='store_true')
+    parser.add_argument('--start', type=str, default=None)
+    parser.add_argument('--end', type=str, default=None)
+    args = parser.parse_args()
+
+    calc_dir = os.path.expanduser(args.calc_dir)
+    df_big_buy = pd.read_csv(os.path.join(calc_dir, 'broker_big_buy.csv'),
+                             usecols=['Branch_Code', 'Branch', 'Ticker', 'Date'], dtype=str)
+    trading_dates = None
+    if os.path.isfile(os.path.expanduser(TRADINGDATE_FILE)):
+        trading_dates = pd.to_datetime(pd.read_csv(os.path.expanduser(TRADINGDATE_FILE))['str_date'])
+        # Tradingdate.csv 只從 2023 開始，比它早的 big buy 用資料裡的日期
+        if trading_dates.min() > pd.to_datetime(df_big_buy['Date']).min():
+            trading_dates = None
+
+    result = run(df_big_buy, trading_dates, args.window, args.min_co, args.min_jaccard, args.min_lift,
+                 not args.include_etf, args.max_branches, args.start, args.end)
+    result['pairs'].to_csv(os.path.join(calc_dir, 'cobuy_pairs.csv'), index=False)
+    result['clusters'].to_csv(os.path.join(calc_dir, 'cobuy_clusters.csv'), index=False)
+    print(result['clusters'].head(30).to_string(index=False))
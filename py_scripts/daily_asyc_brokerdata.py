@@ -5,27 +5,37 @@ import time
 import random
 import logging
 import asyncio
-import aiohttp
 import pandas as pd
-from bs4 import BeautifulSoup
 
-# -------------------------------------------------------------------
-# Create the "logs" directory if it doesn't exist yet.
-os.makedirs("logs", exist_ok=True)
-
-# Generate a filename that includes the local time (YearMonthDay_HourMinuteSecond).
-# Example filename: logs/broker_data_20241226_071759.log
-log_filename = time.strftime("logs/broker_data_%Y%m%d_%H%M%S.log", time.localtime())
+# aiohttp / bs4 在用到的 function 裡才 import
 
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+from branch_store import append_branch_rows, last_dates, parse_numbers
+from run_stats import count
 
 logger = logging.getLogger(__name__)
 
+# -------------------------------------------------------------------
+# Logging
+# -------------------------------------------------------------------
+def setup_logging():
+    """
+    log to logs/broker_data_<time>.log, 在 go_through_dates 開始時才設定，
+    import 這個 module (例如 pipeline 在同一個 process 裡跑) 不會動到 logging 設定
+    """
+    # Create the "logs" directory if it doesn't exist yet.
+    os.makedirs("logs", exist_ok=True)
+
+    # Generate a filename that includes the local time (YearMonthDay_HourMinuteSecond).
+    # Example filename: logs/broker_data_20241226_071759.log
+    log_filename = time.strftime("logs/broker_data_%Y%m%d_%H%M%S.log", time.localtime())
+
+    handler = logging.FileHandler(log_filename)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+                                           datefmt='%Y-%m-%d %H:%M:%S'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return handler
+
 # -------------------------------------------------------------------
 # Global User Agents, Config
 # -------------------------------------------------------------------
@@ -33,6 +43,8 @@ MAX_RETRIES = 4       # Number of attempts before giving up
 RETRY_DELAY = 2       # Seconds to wait between retries
 CHUNK_SIZE = 10       # Number of dates fetched at once per broker
 BROKER_CONCURRENCY = 5  # How many brokers to process concurrently
+BASE_URL = 'https://fubon-ebrokerdj.fbs.com.tw/z/zg/zgb/zgb0.djhtm'  # sharded_crawl.py 測試時換成 mock server
+HTML_PARSER = 'html.parser'  # BeautifulSoup parser engine ('lxml' / 'html5lib' 也可以，見 parser_bench.py)
 
 USER_AGENTS = [
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 '
@@ -70,7 +82,6 @@ def construct_url(brokerHQ_id, broker_id, c, start_date, end_date):
     """
     Constructs the URL with query parameters given broker IDs and dates.
     """
-    base_url = 'https://fubon-ebrokerdj.fbs.com.tw/z/zg/zgb/zgb0.djhtm'
     params = {
         'a': brokerHQ_id,
         'b': broker_id,
@@ -78,7 +89,7 @@ def construct_url(brokerHQ_id, broker_id, c, start_date, end_date):
         'e': transform_date(start_date),
         'f': transform_date(end_date)
     }
-    url = base_url + '?' + '&'.join([f"{key}={value}" for key, value in params.items()])
+    url = BASE_URL + '?' + '&'.join([f"{key}={value}" for key, value in params.items()])
     logger.info(
         f"++++ Constructing URL - HQ ID: {brokerHQ_id}, Broker ID: {broker_id}, "
         f"Date Range: {start_date} to {end_date} ++++"
@@ -88,14 +99,18 @@ def construct_url(brokerHQ_id, broker_id, c, start_date, end_date):
 # -------------------------------------------------------------------
 # Async Fetch
 # -------------------------------------------------------------------
-async def fetch_async(session, url, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY):
+async def fetch_async(session, url, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY, limiter=None):
     """
     Asynchronously fetches the text content of the provided URL with retry logic.
+    limiter: 有 wait() 的 rate limiter (例如 backfill.RateLimiter)，每一次 attempt 前都要先拿
     """
     headers = {"User-Agent": random.choice(USER_AGENTS)}
 
     for attempt in range(1, max_retries + 1):
         try:
+            if limiter is not None:
+                await limiter.wait()
+            count('broker_http')
             async with session.get(url, headers=headers, timeout=10) as response:
                 response.raise_for_status()
                 return await response.text(errors="replace")
@@ -128,14 +143,16 @@ async def fetch_async(session, url, max_retries=MAX_RETRIES, retry_delay=RETRY_D
 # -------------------------------------------------------------------
 # Parsing Functions
 # -------------------------------------------------------------------
-def extract_code_name(html_fragment):
+def extract_code_name(html_fragment, parser=HTML_PARSER):
     """
     Extract Ticker and Name from the given HTML fragment.
     """
+    from bs4 import BeautifulSoup
+
     if not html_fragment:
         return pd.Series({'Ticker': None, 'Name': None})
 
-    soup = BeautifulSoup(html_fragment, 'html.parser')
+    soup = BeautifulSoup(html_fragment, parser)
     td = soup.find('td', {'id': 'oAddCheckbox'})
     if not td:
         return pd.Series({'Ticker': None, 'Name': None})
@@ -164,7 +181,7 @@ def extract_code_name(html_fragment):
     return pd.Series({'Ticker': None, 'Name': None})
 
 
-def extract_name(names):
+def extract_name(names, parser=HTML_PARSER):
     """
     Iterate over a list of <td> elements (class='t4t1') and extract Ticker/Name info.
     """
@@ -174,8 +191,10 @@ def extract_name(names):
         df_list.append({'stock_name': fragment})
 
     # Apply the extraction to each row
-    name_list = pd.DataFrame(df_list)
-    name_list = name_list.stock_name.apply(extract_code_name)
+    name_list = pd.DataFrame(df_list, columns=['stock_name'])
+    if name_list.empty:
+        return pd.DataFrame(columns=['Ticker', 'Name'])
+    name_list = name_list.stock_name.apply(extract_code_name, parser=parser)
     return name_list
 
 
@@ -192,7 +211,29 @@ def extract_number(numbers):
                 'sell': numbers[i+1].get_text(strip=True),
                 'diff': numbers[i+2].get_text(strip=True)
             })
-    return pd.DataFrame(number_list)
+    return pd.DataFrame(number_list, columns=['buy', 'sell', 'diff'])
+
+
+def parse_broker_page(html_content, parser=HTML_PARSER):
+    """
+    parse one zgb0 page into [Ticker, Name, buy, sell, diff] (數字還是網頁上的字串，例如 '1,234')
+    沒有主 <table> 回傳 None，當天沒有交易回傳空的 DataFrame
+    """
+    from bs4 import BeautifulSoup
+
+    real_soup = BeautifulSoup(html_content, parser)
+    table_rows = real_soup.find('table')
+    if not table_rows:
+        return None
+
+    data_row = table_rows.find_all('tr')[5]
+    numbers = data_row.find('table').find_all('td', class_='t3n1')
+    names = data_row.find('table').find_all('td', class_='t4t1')
+
+    return pd.concat([
+        extract_name(names, parser),
+        extract_number(numbers)
+    ], axis=1)
 
 # -------------------------------------------------------------------
 # ASYNC: Download for a single chunk of dates (for one broker)
@@ -218,11 +259,17 @@ async def process_broker(
     branch_name,
     branch_code,
     new_dates_df,
-    Saved_path
+    Saved_dir,
+    on_rows=None,
+    failed=None
 ):
     """
     For a single broker (branch_code), fetch data for all `new_dates_df`,
-    parse them chunk-by-chunk, and append to CSV.
+    parse them chunk-by-chunk, and append to the branch's own CSV in Saved_dir.
+    每個分點只有一個 task 在寫，日期由舊到新，所以分點檔保持依日期排序
+    on_rows: 每一天的資料 parse 完就呼叫 on_rows(data_table) (例如 StreamingAlerts.evaluate)
+    failed: list, 抓不到 / 沒有主 table / parse 失敗的日期會 append (branch_code, date_str) 進去
+    失敗的日期也會算進 broker_failed counter (pipeline 看到就不把 crawl_broker 記成 up to date)
     """
     str_date_list = new_dates_df['str_date'].tolist()
     data_tables = []
@@ -241,46 +288,45 @@ async def process_broker(
         for html_content, date_str in soup_date_list:
             if not html_content:
                 # If None, an error or timeout occurred
+                count('broker_failed')
+                if failed is not None:
+                    failed.append((branch_code, date_str))
                 continue
 
-            real_soup = BeautifulSoup(html_content, 'html.parser')
             try:
-                table_rows = real_soup.find('table')
-                if not table_rows:
+                data_table = parse_broker_page(html_content)
+                if data_table is None:
                     logger.warning(f"No main <table> found for Broker {branch_code}, date {date_str}")
+                    count('broker_failed')
+                    if failed is not None:
+                        failed.append((branch_code, date_str))
                     continue
-
-                data_row = table_rows.find_all('tr')[5]
-                if not data_row:
-                    logger.warning(f"Cannot find row index 5 for Broker {branch_code}, date {date_str}")
+                if data_table.empty:
                     continue
+                # 數字在這裡先轉好，壞掉的頁面算這一天失敗，不會讓後面的 append_branch_rows 中斷整個 crawl
+                data_table = parse_numbers(data_table)
 
-                numbers = data_row.find('table').find_all('td', class_='t3n1')
-                names = data_row.find('table').find_all('td', class_='t4t1')
-
-                # Construct partial dataframe
-                data_table = pd.concat([
-                    extract_name(names),
-                    extract_number(numbers)
-                ], axis=1)
                 data_table['Branch'] = branch_name
                 data_table['Date'] = date_str
                 data_table['Branch_Code'] = branch_code
                 data_tables.append(data_table)
+                if on_rows is not None:
+                    on_rows(data_table)
 
             except Exception as e:
                 logger.error(
                     f"Error parsing HTML for Broker {branch_code}, date {date_str}: {e}",
                     exc_info=True
                 )
+                count('broker_failed')
+                if failed is not None:
+                    failed.append((branch_code, date_str))
 
         # PARTIAL SAVE if there's a significant amount of data
         if len(data_tables) > 20:
             combined_df = pd.concat(data_tables, ignore_index=True)
-            if not os.path.isfile(Saved_path):
-                combined_df.to_csv(Saved_path, index=False)
-            else:
-                combined_df.to_csv(Saved_path, mode='a', index=False, header=False)
+            # 拿 branch lock + 寫檔會 block，丟到 thread，不要卡住其他分點的下載
+            await asyncio.to_thread(append_branch_rows, Saved_dir, branch_code, combined_df)
             data_tables.clear()
 
         # Be kind to the server
@@ -289,10 +335,7 @@ async def process_broker(
     # After finishing all chunks for this broker, do a final save if there's leftover data
     if data_tables:
         combined_df = pd.concat(data_tables, ignore_index=True)
-        if not os.path.isfile(Saved_path):
-            combined_df.to_csv(Saved_path, index=False)
-        else:
-            combined_df.to_csv(Saved_path, mode='a', index=False, header=False)
+        await asyncio.to_thread(append_branch_rows, Saved_dir, branch_code, combined_df)
         data_tables.clear()
 
     logger.info(f"--- Finished broker: {branch_code} ---")
@@ -307,7 +350,9 @@ async def run_with_semaphore(
     branch_name,
     branch_code,
     new_dates_df,
-    Saved_path
+    Saved_dir,
+    on_rows=None,
+    failed=None
 ):
     """
     Wrap the process_broker logic in a semaphore to limit concurrency
@@ -320,16 +365,21 @@ async def run_with_semaphore(
             branch_name,
             branch_code,
             new_dates_df,
-            Saved_path
+            Saved_dir,
+            on_rows,
+            failed
         )
 
 # -------------------------------------------------------------------
 # ASYNC: Main logic to process all brokers in parallel
 # -------------------------------------------------------------------
-async def main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_path):
+async def main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_dir, skip=(), on_rows=None):
     """
     Creates tasks for each broker and runs them concurrently with a semaphore limit.
+    skip: branch codes handled by the backfill queue (見 backfill.py)
     """
+    import aiohttp
+
     async with aiohttp.ClientSession() as session:
         # We will limit concurrency to avoid overloading the server
         semaphore = asyncio.Semaphore(BROKER_CONCURRENCY)
@@ -340,6 +390,10 @@ async def main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_path):
             branch_name = row['Branch_Name']
             branch_code = row['Branch_Code']
 
+            if branch_code in skip:
+                logger.info(f"Broker {branch_code} is being backfilled. Skipping.")
+                continue
+
             # 1) Find the max date we have already
             broker_saved = saved_df[saved_df['Branch_Code'] == branch_code]
             if not broker_saved.empty:
@@ -368,7 +422,8 @@ async def main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_path):
                     branch_name,
                     branch_code,
                     new_dates_df,
-                    Saved_path
+                    Saved_dir,
+                    on_rows
                 )
             )
             tasks.append(task)
@@ -381,21 +436,30 @@ async def main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_path):
 # -------------------------------------------------------------------
 # SYNC: Entry function
 # -------------------------------------------------------------------
-def go_through_dates(Tradingdatefile_path, Brokerlist_path, Saved_path):
+def go_through_dates(Tradingdatefile_path, Brokerlist_path, Saved_dir, Ori_Tradingdate=None,
+                     backfill_dir=None, on_rows=None):
     """
     Main driver function (synchronous) that:
       1) Reads CSV data
       2) Determines new dates per broker
       3) Runs the async logic to fetch/parse in parallel
-      4) Saves results to CSV (incrementally).
+      4) Saves results to one CSV per branch in Saved_dir (incrementally).
+    Ori_Tradingdate: trading dates already in memory (e.g. returned by generate_trading_date),
+    有給就不用再讀一次 Tradingdate.csv
+    backfill_dir: 缺超過 backfill.DAILY_MAX_DAYS 天的分點 (新加的分點等) 交給這個 backfill queue，
+    daily 只抓最近幾天，不會被整段歷史資料拖住
+    on_rows: callback for every parsed page (見 process_broker)
     """
     # Expand user paths ~ => /home/<user>, etc.
     Tradingdatefile_path = os.path.expanduser(Tradingdatefile_path)
     Brokerlist_path = os.path.expanduser(Brokerlist_path)
-    Saved_path = os.path.expanduser(Saved_path)
+    Saved_dir = os.path.expanduser(Saved_dir)
 
     # 1) Read the trading dates
-    Ori_Tradingdate = pd.read_csv(Tradingdatefile_path)
+    if Ori_Tradingdate is None:
+        Ori_Tradingdate = pd.read_csv(Tradingdatefile_path)
+    else:
+        Ori_Tradingdate = Ori_Tradingdate.copy()
     if 'str_date' not in Ori_Tradingdate.columns:
         raise ValueError("Tradingdate CSV must have a column named 'str_date'.")
 
@@ -417,31 +481,24 @@ def go_through_dates(Tradingdatefile_path, Brokerlist_path, Saved_path):
     if not required_cols.issubset(set(Brockerlist.columns)):
         raise ValueError(f"Brokerlist CSV must have columns: {required_cols}")
 
-    # 3) Load or init the saved data
-    if os.path.isfile(Saved_path):
-        saved_df = pd.read_csv(Saved_path,
-                               thousands=',',
-                               dtype={"Ticker":"string",
-                                    "Name":"string",
-                                    "buy":int,
-                                    "sell":int,
-                                    "diff":int,
-                                    "Branch":"string",
-                                    "Date":"string",
-                                    "Branch_Code":"string"})
-        if not saved_df.empty:
-            if 'Date' not in saved_df.columns:
-                raise ValueError("Saved CSV must have a 'Date' column.")
-            saved_df['Date'] = pd.to_datetime(saved_df['Date'], format='%Y-%m-%d', errors='coerce')
-        else:
-            saved_df = pd.DataFrame(columns=['Branch_Code', 'Date'])
-    else:
-        saved_df = pd.DataFrame(columns=['Branch_Code', 'Date'])
+    # 3) Last saved date of every branch (只讀每個分點檔的最後一行)
+    os.makedirs(Saved_dir, exist_ok=True)
+    saved_df = last_dates(Saved_dir)
+
+    handler = setup_logging()
+    try:
+        logger.info("=== Starting daily update process (async version) ===")
 
-    logger.info("=== Starting daily update process (async version) ===")
+        skip = set()
+        if backfill_dir is not None:
+            from backfill import hand_off_gaps
+            skip = hand_off_gaps(Ori_Tradingdate, Brockerlist, saved_df, backfill_dir)
 
-    # 4) Run async logic
-    asyncio.run(main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_path))
+        # 4) Run async logic
+        asyncio.run(main_async(Ori_Tradingdate, Brockerlist, saved_df, Saved_dir, skip, on_rows))
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
 
 
 # -------------------------------------------------------------------
@@ -450,6 +507,13 @@ def go_through_dates(Tradingdatefile_path, Brokerlist_path, Saved_path):
 if __name__ == '__main__':
     Tradingdatefile_path = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/Tradingdate.csv'
     Brokerlist_path       = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/big_branch_list.csv'
-    Saved_path            = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/broker_trading_list.csv'
-
-    go_through_dates(Tradingdatefile_path, Brokerlist_path, Saved_path)
+    Saved_dir             = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/small_broker_trading'
+    Backfill_dir          = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/backfill'
+
+    from stream_alerts import for_crawl
+    alerts = for_crawl('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data')
+    go_through_dates(Tradingdatefile_path, Brokerlist_path, Saved_dir, backfill_dir=Backfill_dir,
+                     on_rows=alerts.evaluate if alerts is not None else None)
+    if alerts is not None:
+        # 單獨跑時不知道 download_stock 什麼時候做完，只在最後再讀一次成交量
+        alerts.finish()
@@ -0,0 +1,96 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from broker_analyze import list_csv_files, load_price_files, read_big_buy
+from price_panel import build_price_panel, locate, forward_window
+
+DEFAULT_HORIZONS = (1, 3, 5, 10, 20)
+
+
+def event_returns(df_big_buy, df_price, horizons=DEFAULT_HORIZONS, chunk_size=500000, panel=None):
+    """
+    for every big buy event, compute forward return / max run-up / max drawdown at each horizon
+    基準價為事件當天收盤；ret = 第 h 個交易日收盤，runup / drawdown = 之後 h 天內最高 / 最低價
+    事件分批 (chunk_size) 一次用 (events x max horizon) 的 window 計算
+    """
+    horizons = sorted(horizons)
+    max_h = horizons[-1]
+    cols = [h - 1 for h in horizons]
+
+    if panel is None:
+        panel = build_price_panel(df_price, columns=('High', 'Low', 'Close'))
+
+    df_events = df_big_buy[['Branch_Code', 'Ticker', 'Date']].reset_index(drop=True)
+    ti, di = locate(panel, df_events['Ticker'], df_events['Date'])
+    ok = (ti >= 0) & (di >= 0)
+    df_events, ti, di = df_events[ok].reset_index(drop=True), ti[ok], di[ok]
+
+    out = {f'{k}_{h}d': np.full(len(df_events), np.nan, dtype=np.float32)
+           for k in ['ret', 'runup', 'drawdown'] for h in horizons}
+
+    for s in range(0, len(df_events), chunk_size):
+        e = s + chunk_size
+        base = panel['Close'][ti[s:e], di[s:e]]
+        close_w = forward_window(panel['Close'], ti[s:e], di[s:e] + 1, max_h)
+        high_w = np.fmax.accumulate(forward_window(panel['High'], ti[s:e], di[s:e] + 1, max_h), axis=1)
+        low_w = np.fmin.accumulate(forward_window(panel['Low'], ti[s:e], di[s:e] + 1, max_h), axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ret = close_w[:, cols] / base[:, None] - 1
+            runup = high_w[:, cols] / base[:, None] - 1
+            drawdown = low_w[:, cols] / base[:, None] - 1
+
+        for j, h in enumerate(horizons):
+            out[f'ret_{h}d'][s:e] = ret[:, j]
+            out[f'runup_{h}d'][s:e] = runup[:, j]
+            out[f'drawdown_{h}d'][s:e] = drawdown[:, j]
+
+    return pd.concat([df_events, pd.DataFrame(out)], axis=1)
+
+
+def aggregate_events(df_events, by=('Branch_Code',), horizons=DEFAULT_HORIZONS):
+    """
+    aggregate event results per branch or per (branch, ticker)
+    每個 horizon 給平均 / 中位數報酬、勝率、平均 run-up / drawdown
+    """
+    by = list(by)
+    agg = {'event_count': ('Date', 'size')}
+    for h in horizons:
+        agg[f'ret_{h}d_mean'] = (f'ret_{h}d', 'mean')
+        agg[f'ret_{h}d_median'] = (f'ret_{h}d', 'median')
+        agg[f'runup_{h}d_mean'] = (f'runup_{h}d', 'mean')
+        agg[f'drawdown_{h}d_mean'] = (f'drawdown_{h}d', 'mean')
+
+    df = df_events.copy()
+    for h in horizons:
+        # NaN (資料不足) 不算在勝率裡
+        df[f'win_{h}d'] = (df[f'ret_{h}d'] > 0).where(df[f'ret_{h}d'].notna())
+        agg[f'win_rate_{h}d'] = (f'win_{h}d', 'mean')
+
+    return df.groupby(by, observed=True).agg(**agg).reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Event study of big buy forward returns')
+    parser.add_argument('--horizons', type=str, default=','.join(map(str, DEFAULT_HORIZONS)),
+                        help='comma separated trading day horizons')
+    args = parser.parse_args()
+    horizons = [int(h) for h in args.horizons.split(',')]
+
+    calc_dir = os.path.expanduser('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result')
+    price_files = list_csv_files('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/AllStockHist')
+
+    df_price = load_price_files(price_files)
+    df_big_buy = read_big_buy(os.path.join(calc_dir, 'broker_big_buy.csv'))
+
+    df_events = event_returns(df_big_buy, df_price, horizons)
+    df_events.to_csv(os.path.join(calc_dir, 'event_study.csv'), index=False)
+    aggregate_events(df_events, ['Branch_Code'], horizons) \
+        .to_csv(os.path.join(calc_dir, 'event_study_branch.csv'), index=False)
+    aggregate_events(df_events, ['Branch_Code', 'Ticker'], horizons) \
+        .to_csv(os.path.join(calc_dir, 'event_study_branch_ticker.csv'), index=False)
+
+    print(f'--Finish event study, {len(df_events)} events--')
@@ -0,0 +1,76 @@
+import sys
+import argparse
+import subprocess
+
+import pandas as pd
+
+# pipeline 各 stage 的 module，預設都量
+DEFAULT_MODULES = ['trading_date', 'async_download_stock', 'daily_asyc_brokerdata',
+                   'broker_analyze', 'send_email', 'pipeline']
+
+
+def parse_importtime(stderr):
+    """
+    parse `python -X importtime` output into [module, self_us, cumulative_us, depth]
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        # 前面的空白數代表被誰 import 的深度
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append({'module': name.strip(), 'self_us': int(self_us),
+                     'cumulative_us': int(cum_us), 'depth': depth})
+    return pd.DataFrame(rows, columns=['module', 'self_us', 'cumulative_us', 'depth'])
+
+
+def measure_import(target, cwd=None):
+    """
+    cold import cost of one module (新開一個 interpreter，所以不會吃到已經 import 過的)
+    target 結尾是 .py 時改成執行該 script (後面可以接參數，例如 'async_download_stock.py -h')
+    """
+    if target.split()[0].endswith('.py'):
+        cmd = [sys.executable, '-X', 'importtime'] + target.split()
+    else:
+        cmd = [sys.executable, '-X', 'importtime', '-c', f'import {target}']
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return parse_importtime(proc.stderr)
+
+
+def import_report(targets, top=15, cwd=None):
+    """
+    total import time of each target and the slowest top-level packages
+    套件時間 = 該套件底下所有 module 的 self time 加總 (pandas.core.xxx 都算 pandas)
+    return (df_total, df_top)
+    """
+    totals, tops = [], []
+    for target in targets:
+        df = measure_import(target, cwd)
+        # depth 0 的 cumulative 加總就是整個 import 花的時間
+        totals.append({'target': target,
+                       'import_ms': df.loc[df['depth'] == 0, 'cumulative_us'].sum() / 1000,
+                       'modules': len(df)})
+        df_pkg = df.assign(package=df['module'].str.split('.').str[0]) \
+                   .groupby('package', as_index=False) \
+                   .agg(import_ms=('self_us', 'sum'), modules=('module', 'size'))
+        df_pkg['import_ms'] /= 1000
+        tops.append(df_pkg.nlargest(top, 'import_ms').assign(target=target))
+    df_top = pd.concat(tops, ignore_index=True)[['target', 'package', 'import_ms', 'modules']]
+    return pd.DataFrame(totals), df_top
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold import time of the pipeline modules (python -X importtime)')
+    parser.add_argument('targets', nargs='*', default=DEFAULT_MODULES,
+                        help="modules to import, or a quoted script command like 'async_download_stock.py -h'")
+    parser.add_argument('--top', type=int, default=15, help='slowest packages to list per target')
+    parser.add_argument('-o', '--output', type=str, default=None, help='save the top packages table (per target) as csv')
+    args = parser.parse_args()
+
+    df_total, df_top = import_report(args.targets, args.top)
+    print(df_total.to_string(index=False))
+    print()
+    print(df_top.to_string(index=False))
+    if args.output:
+        df_top.to_csv(args.output, index=False)
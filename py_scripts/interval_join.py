@@ -0,0 +1,100 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from calendar_rolling import to_ordinals
+
+
+def window_join(df_events, df_signals, lead_days, trading_dates=None, min_lead=0):
+    """
+    match every event to the first signal day of the same ticker
+    within [t + min_lead, t + lead_days] trading days after the event day t
+    lead_days=1 等同舊的 exact merge + is_signal_next (當天或前一天買進)
+    每檔股票的 signal 日期排序後用 searchsorted，不用複製位移過的資料，O(n log n)
+    return matched events with 'signal_date' and 'lag' (trading days)
+    """
+    if 'is_signal' in df_signals.columns:
+        df_signals = df_signals[df_signals['is_signal'].astype(bool)]
+
+    if trading_dates is None:
+        # 沒有給交易日曆時，用兩邊出現過的日期 (所有分點合起來幾乎每天都有資料)
+        trading_dates = np.union1d(df_events['Date'].unique(), df_signals['Date'].unique())
+    trading_dates = np.sort(pd.to_datetime(np.asarray(trading_dates)).to_numpy())
+
+    tickers = np.union1d(df_events['Ticker'].astype(str).unique(), df_signals['Ticker'].astype(str).unique())
+    span = len(trading_dates) + lead_days + 1
+
+    sig_key = np.searchsorted(tickers, df_signals['Ticker'].astype(str).to_numpy()) * span + \
+              to_ordinals(df_signals['Date'], trading_dates)
+    sig_key = np.unique(sig_key)
+
+    ev_ord = to_ordinals(df_events['Date'], trading_dates)
+    ev_key = np.searchsorted(tickers, df_events['Ticker'].astype(str).to_numpy()) * span + ev_ord
+
+    idx = np.searchsorted(sig_key, ev_key + min_lead, side='left')
+    found = idx < len(sig_key)
+    lag = np.full(len(ev_key), -1, dtype=np.int64)
+    lag[found] = sig_key[idx[found]] - ev_key[found]
+    # key 差距在 window 內就代表同一檔股票 (span 大於 lead_days)
+    matched = found & (lag >= min_lead) & (lag <= lead_days)
+
+    df_matched = df_events[matched].copy()
+    df_matched['lag'] = lag[matched]
+    df_matched['signal_date'] = trading_dates[ev_ord[matched] + lag[matched]]
+    return df_matched
+
+
+def lag_stats(df_matched, by=('Branch_Code',), lead_days=None):
+    """
+    per-match lag statistics: count, mean / median lag and count per lag
+    """
+    by = list(by)
+    df_stat = df_matched.groupby(by, observed=True)['lag'].agg(
+        match_count='size', lag_mean='mean', lag_median='median').reset_index()
+
+    df_lag = pd.crosstab([df_matched[c] for c in by], df_matched['lag'])
+    if lead_days is not None:
+        df_lag = df_lag.reindex(columns=range(lead_days + 1), fill_value=0)
+    df_lag.columns = [f'lag_{c}' for c in df_lag.columns]
+    return df_stat.merge(df_lag.reset_index(), on=by, how='left')
+
+
+def lead_time_profile(df_big_buy, df_signals, max_lead=10, trading_dates=None, by=('Branch_Code',)):
+    """
+    success count per group for every lead window 1..max_lead in one join
+    lead k 的成功數 = lag <= k 的 match 數 (累加)，不用每個 k 重新 join
+    """
+    by = list(by)
+    df_matched = window_join(df_big_buy, df_signals, max_lead, trading_dates)
+    df_total = df_big_buy.groupby(by, observed=True).size().rename('total_count')
+
+    df_lag = pd.crosstab([df_matched[c] for c in by], df_matched['lag']) \
+               .reindex(columns=range(max_lead + 1), fill_value=0) \
+               .cumsum(axis=1)
+    df_profile = df_total.to_frame().join(df_lag, how='left').fillna(0)
+    for k in range(1, max_lead + 1):
+        df_profile[f'success_rate_{k}d'] = df_profile[k] / df_profile['total_count']
+    df_profile = df_profile.rename(columns={k: f'success_count_{k}d' for k in range(max_lead + 1)})
+    return df_profile.drop(columns=['success_count_0d']).reset_index()
+
+
+if __name__ == '__main__':
+    from broker_analyze import read_signals, read_big_buy
+
+    parser = argparse.ArgumentParser(description='Success rate for big buy lead windows 1..k days')
+    parser.add_argument('-k', '--max-lead', type=int, default=10, help='max trading days before signal')
+    args = parser.parse_args()
+
+    calc_dir = os.path.expanduser('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result')
+    df_signals = read_signals(os.path.join(calc_dir, 'big_gain_signals.csv'))
+    df_big_buy = read_big_buy(os.path.join(calc_dir, 'broker_big_buy.csv'))
+
+    df_profile = lead_time_profile(df_big_buy, df_signals, args.max_lead)
+    df_profile.to_csv(os.path.join(calc_dir, 'lead_time_profile.csv'), index=False)
+
+    df_matched = window_join(df_big_buy, df_signals, args.max_lead)
+    lag_stats(df_matched, lead_days=args.max_lead) \
+        .to_csv(os.path.join(calc_dir, 'lead_time_lag_stats.csv'), index=False)
+    print(f'--Finish lead time profile, {len(df_matched)} matches within {args.max_lead} days--')
@@ -0,0 +1,84 @@
+import zlib
+import random
+import asyncio
+import argparse
+
+# -------------------------------------------------------------------
+# 本機測試用的假富邦 zgb0 server
+#   同一個 (分點, 日期) 每次都回傳一樣的頁面，格式和 parser_fixtures 裡的頁面相同
+#   --fail-rate / --delay 可以模擬 server 出錯和變慢
+# -------------------------------------------------------------------
+PATH = '/z/zg/zgb/zgb0.djhtm'
+STOCKS = [('2330', '台積電'), ('2317', '鴻海'), ('2454', '聯發科'), ('1101', '台泥'), ('2603', '長榮'),
+          ('3008', '大立光'), ('2882', '國泰金'), ('00632R', '元大台灣50反1'), ('0050', '元大台灣50')]
+
+
+def _name_cell(code, name, script):
+    if script:
+        inner = f"<SCRIPT LANGUAGE=\"JavaScript\">\n<!--\n\tGenLink2stk('AS{code}','{name}');\n//-->\n</SCRIPT>"
+    else:
+        inner = f"<A HREF=\"javascript:Link2Stk('{code}');\">{code}{name}</A>"
+    return f'<TD CLASS="t4t1" id="oAddCheckbox" NOWRAP>{inner}</TD>'
+
+
+def make_page(branch_code, date_str, max_rows=6):
+    """
+    deterministic zgb0 page for one branch and day (0 ~ max_rows 列)
+    """
+    rng = random.Random(zlib.crc32(f'{branch_code}|{date_str}'.encode()))
+    rows = []
+    for _ in range(rng.randint(0, max_rows)):
+        cells = []
+        for buy_side in (True, False):
+            code, name = rng.choice(STOCKS)
+            big, small = rng.randint(1, 3000), rng.randint(0, 20)
+            buy, sell = (big, small) if buy_side else (small, big)
+            cells.append(_name_cell(code, name, rng.random() < 0.5) +
+                         ''.join(f'<TD CLASS="t3n1">{v:,}</TD>' for v in (buy, sell, buy - sell)))
+        rows.append('<TR>' + ''.join(cells) + '</TR>\n')
+
+    return ('<HTML><BODY>\n<TABLE>\n'
+            + '<TR><TD>&nbsp;</TD></TR>\n' * 5
+            + '<TR><TD>\n<TABLE CLASS="t01">\n'
+            + f'<TR><TD CLASS="t2" COLSPAN="8">{branch_code} {date_str}</TD></TR>\n'
+            + ''.join(rows)
+            + '</TABLE>\n</TD></TR>\n</TABLE>\n</BODY></HTML>\n')
+
+
+def make_app(fail_rate=0.0, delay=0.0, seed=0):
+    from aiohttp import web
+
+    rng = random.Random(seed)
+    stats = {'requests': 0, 'failed': 0}
+
+    async def zgb0(request):
+        stats['requests'] += 1
+        if delay:
+            await asyncio.sleep(rng.uniform(0, 2 * delay))
+        if rng.random() < fail_rate:
+            stats['failed'] += 1
+            raise web.HTTPInternalServerError()
+        # 日期格式是 YYYY-M-D (見 transform_date)
+        year, month, day = request.query['e'].split('-')
+        date_str = f"{year}-{int(month):02d}-{int(day):02d}"
+        return web.Response(text=make_page(request.query['b'], date_str), content_type='text/html')
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get(PATH, zgb0)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Fubon broker page server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--delay', type=float, default=0.0, help='average response delay in seconds')
+    args = parser.parse_args()
+
+    from aiohttp import web
+    print(f"Serving http://127.0.0.1:{args.port}{PATH}")
+    web.run_app(make_app(args.fail_rate, args.delay), host='127.0.0.1', port=args.port, print=None)
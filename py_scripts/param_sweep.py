@@ -0,0 +1,268 @@
+import os
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from broker_analyze import list_csv_files, load_price_files, load_broker_files
+from calendar_rolling import to_ordinals, calendar_rolling_mean
+
+# -------------------------------------------------------------------
+# Default grid, 中間值就是 broker_analyze.py 目前寫死的門檻
+# -------------------------------------------------------------------
+DEFAULT_GRID = {
+    'vol_ratio':   [0.10, 0.14, 0.18, 0.22, 0.26, 0.30],
+    'avg_mult':    [1.5, 2, 3, 4],
+    'avg_window':  [5, 7, 10],
+    'past_window': [7],
+    'future_window': [5, 7, 10],
+    'past_tol':    [1.00, 1.03, 1.05],
+    'future_gain': [1.10, 1.15, 1.20, 1.30],
+    'success_threshold': [0.3, 0.49, 0.7],
+}
+
+BIG_BUY_PARAMS = ['vol_ratio', 'avg_mult', 'avg_window']
+SIGNAL_PARAMS = ['past_window', 'future_window', 'past_tol', 'future_gain']
+
+
+def group_bounds(group_codes):
+    """
+    for data sorted by group, return (start, end) index of each row's group
+    """
+    n = len(group_codes)
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = group_codes[1:] != group_codes[:-1]
+    starts = np.flatnonzero(is_start)
+    sizes = np.diff(np.append(starts, n))
+    start = np.repeat(starts, sizes)
+    end = np.repeat(starts + sizes - 1, sizes)
+    return start, end
+
+
+def past_rolling_mean(values, start, window):
+    """
+    same as groupby(...).shift(1).rolling(window).mean(), computed with a prefix sum
+    """
+    n = len(values)
+    prefix = np.zeros(n + 1, dtype=values.dtype)
+    np.cumsum(values, out=prefix[1:])
+    idx = np.arange(n)
+    lo = idx - window
+    out = np.full(n, np.nan)
+    ok = lo >= start
+    out[ok] = (prefix[idx[ok]] - prefix[lo[ok]]) / window
+    return out
+
+
+def future_rolling_mean(values, end, window):
+    """
+    same as groupby(...).shift(1 - window).rolling(window).mean() (含當天往後 window 筆)
+    """
+    n = len(values)
+    prefix = np.zeros(n + 1, dtype=values.dtype)
+    np.cumsum(values, out=prefix[1:])
+    idx = np.arange(n)
+    hi = idx + window
+    out = np.full(n, np.nan)
+    ok = hi - 1 <= end
+    out[ok] = (prefix[hi[ok]] - prefix[idx[ok]]) / window
+    return out
+
+
+def prepare_sweep_data(df_price, df_b, grid):
+    """
+    compute the shared intermediates once:
+    price 的過去 / 未來均線 (每個 window 一次)、分點 diff 交易日曆平均、volume join、對應的價格列
+    return a dict of numpy arrays
+    """
+    df_price = df_price.sort_values(['Ticker', 'Date']).reset_index(drop=True)
+    ticker_codes = df_price['Ticker'].astype('category').cat.codes.to_numpy()
+    p_start, p_end = group_bounds(ticker_codes)
+    close = df_price['Close'].to_numpy(dtype=float)
+
+    ma_past = {w: past_rolling_mean(close, p_start, w) for w in grid['past_window']}
+    ma_future = {w: future_rolling_mean(close, p_end, w) for w in grid['future_window']}
+
+    # 下一列是否為同一檔股票 (is_signal_next 用)
+    same_next = np.zeros(len(close), dtype=bool)
+    same_next[:-1] = ticker_codes[1:] == ticker_codes[:-1]
+
+    # 分點資料：排除 0 開頭 (ETF) 後依 (Branch_Code, Ticker, Date) 排序
+    df_b = df_b[~df_b['Ticker'].str.startswith('0')]
+    df_b = df_b.sort_values(['Branch_Code', 'Ticker', 'Date']).reset_index(drop=True)
+    pair = df_b.groupby(['Branch_Code', 'Ticker'], sort=False).ngroup().to_numpy()
+    diff = df_b['diff'].to_numpy(dtype=np.int64)
+    # 和 big_buy_calc 一樣用交易日曆的 window (沒交易算 0)
+    ords = to_ordinals(df_b['Date'], np.sort(df_price['Date'].unique()))
+    diff_avg = {w: calendar_rolling_mean(diff, pair, ords, w) for w in grid['avg_window']}
+
+    # volume join 只做一次，順便記下對應的價格列
+    df_key = df_price[['Ticker', 'Date']].copy()
+    df_key['Volume'] = df_price['Volume'] / 1000
+    df_key['price_row'] = np.arange(len(df_key))
+    df_key = df_key.drop_duplicates(['Ticker', 'Date'], keep='last')
+    df_b = df_b[['Ticker', 'Date']].merge(df_key, on=['Ticker', 'Date'], how='left')
+
+    return {
+        'close': close,
+        'ma_past': ma_past,
+        'ma_future': ma_future,
+        'same_next': same_next,
+        'diff': diff,
+        'diff_avg': diff_avg,
+        'volume': df_b['Volume'].fillna(0).to_numpy(),
+        'price_row': df_b['price_row'].fillna(-1).to_numpy(dtype=np.int64),
+        'pair': pair,
+        'n_pairs': int(pair.max()) + 1 if len(pair) else 0,
+    }
+
+
+# -------------------------------------------------------------------
+# Worker side, 每個 process 只收一次資料，mask 在 process 內重複使用
+# -------------------------------------------------------------------
+_DATA = None
+_MASKS = {}
+
+
+def _init_worker(data):
+    global _DATA
+    _DATA = data
+    _MASKS.clear()
+
+
+def _mask(key, func):
+    if key not in _MASKS:
+        _MASKS[key] = func()
+    return _MASKS[key]
+
+
+def _c1_mask(vol_ratio):
+    d = _DATA
+    return _mask(('c1', vol_ratio),
+                 lambda: (d['diff'] >= vol_ratio * d['volume']) & (d['volume'] != 0))
+
+
+def _c2_mask(avg_mult, avg_window):
+    d = _DATA
+    return _mask(('c2', avg_mult, avg_window),
+                 lambda: d['diff'] >= avg_mult * d['diff_avg'][avg_window])
+
+
+def _signal_hit(past_window, future_window, past_tol, future_gain):
+    """
+    signal mask on price rows (含前一天)，再對應到每筆分點資料
+    """
+    d = _DATA
+    close = d['close']
+    with np.errstate(invalid='ignore'):
+        sig = (close <= d['ma_past'][past_window] * past_tol) & \
+              (d['ma_future'][future_window] >= close * future_gain)
+    sig_next = np.zeros_like(sig)
+    sig_next[:-1] = sig[1:] & d['same_next'][:-1]
+    sig = sig | sig_next
+
+    price_row = d['price_row']
+    hit = np.zeros(len(price_row), dtype=bool)
+    ok = price_row >= 0
+    hit[ok] = sig[price_row[ok]]
+    return hit
+
+
+def _eval_signal(signal_values, big_buy_combos, thresholds):
+    """
+    evaluate every big buy combination against one signal setting
+    """
+    d = _DATA
+    signal_params = dict(zip(SIGNAL_PARAMS, signal_values))
+    hit = _signal_hit(*signal_values)
+
+    rows = []
+    for vol_ratio, avg_mult, avg_window in big_buy_combos:
+        with np.errstate(invalid='ignore'):
+            big_buy = _c1_mask(vol_ratio) | _c2_mask(avg_mult, avg_window)
+        success = big_buy & hit
+
+        pair_total = np.bincount(d['pair'], weights=big_buy, minlength=d['n_pairs'])
+        pair_success = np.bincount(d['pair'], weights=success, minlength=d['n_pairs'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pair_rate = np.where(pair_total > 0, pair_success / pair_total, 0)
+
+        big_buy_count = int(big_buy.sum())
+        success_count = int(success.sum())
+        for th in thresholds:
+            high = pair_rate > th
+            rows.append({
+                'vol_ratio': vol_ratio,
+                'avg_mult': avg_mult,
+                'avg_window': avg_window,
+                **signal_params,
+                'success_threshold': th,
+                'big_buy_count': big_buy_count,
+                'success_count': success_count,
+                'success_rate': success_count / big_buy_count if big_buy_count else 0,
+                'high_sr_pairs': int(high.sum()),
+                'high_sr_big_buy_count': int(pair_total[high].sum()),
+                'high_sr_success_count': int(pair_success[high].sum()),
+            })
+    return rows
+
+
+def run_sweep(df_price, df_b, grid=None, workers=None):
+    """
+    evaluate every combination of grid, return the results table
+    """
+    grid = {**DEFAULT_GRID, **(grid or {})}
+    data = prepare_sweep_data(df_price, df_b, grid)
+
+    big_buy_combos = list(itertools.product(*[grid[k] for k in BIG_BUY_PARAMS]))
+    signal_combos = list(itertools.product(*[grid[k] for k in SIGNAL_PARAMS]))
+    thresholds = grid['success_threshold']
+    print(f'Sweep {len(big_buy_combos)} big buy x {len(signal_combos)} signal x '
+          f'{len(thresholds)} threshold combinations')
+
+    rows = []
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        _init_worker(data)
+        for sv in signal_combos:
+            rows.extend(_eval_signal(sv, big_buy_combos, thresholds))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(data,)) as executor:
+            futures = [executor.submit(_eval_signal, sv, big_buy_combos, thresholds)
+                       for sv in signal_combos]
+            for f in futures:
+                rows.extend(f.result())
+
+    return pd.DataFrame(rows)
+
+
+def _parse_list(text, cast=float):
+    return [cast(v) for v in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep big buy / big gain thresholds')
+    for key, values in DEFAULT_GRID.items():
+        cast = int if key.endswith('window') else float
+        parser.add_argument(f'--{key.replace("_", "-")}', type=lambda t, c=cast: _parse_list(t, c),
+                            default=values, help=f'comma separated values (default {values})')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of processes (default all cores)')
+    parser.add_argument('-o', '--output', type=str,
+                        default='~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result/param_sweep.csv')
+    args = parser.parse_args()
+
+    grid = {key: getattr(args, key) for key in DEFAULT_GRID}
+
+    price_files = list_csv_files('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/AllStockHist')
+    broker_files = list_csv_files('~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/small_broker_trading')
+
+    df_price = load_price_files(price_files)
+    df_b = load_broker_files(broker_files, usecols=['Ticker', 'diff', 'Date', 'Branch_Code'])
+
+    df_result = run_sweep(df_price, df_b, grid, args.workers)
+    df_result.to_csv(os.path.expanduser(args.output), index=False)
+    print(f'--Finish param sweep, {len(df_result)} rows saved to {args.output}--')
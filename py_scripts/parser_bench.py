@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import argparse
+import importlib.util
+
+import pandas as pd
+
+from daily_asyc_brokerdata import HTML_PARSER, parse_broker_page
+
+# -------------------------------------------------------------------
+# 存下來的富邦 zgb0 頁面 (utf-8，已經是 aiohttp decode 之後的文字) 和 parse 的正確結果
+#   <page>.html   頁面
+#   <page>.csv    golden: Ticker,Name,buy,sell,diff，當天沒交易只有 header
+#                 空檔案代表沒有主 <table> (parse_broker_page 回傳 None)
+# 改了 parser 之後跑 python parser_bench.py，結果不同就不能 merge
+# -------------------------------------------------------------------
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser_fixtures')
+ENGINES = ['html.parser', 'lxml', 'html5lib']
+ENGINE_MODULES = {'lxml': 'lxml', 'html5lib': 'html5lib'}
+RESULT_COLUMNS = ['run_id', 'engine', 'page', 'size_kb', 'rows', 'ok', 'ms_per_page', 'pages_per_s',
+                  'peak_kb_per_page']
+
+
+def load_pages(fixture_dir=FIXTURE_DIR):
+    pages = {}
+    for f in sorted(os.listdir(fixture_dir)):
+        if f.endswith('.html'):
+            with open(os.path.join(fixture_dir, f), encoding='utf-8') as fh:
+                pages[f[:-5]] = fh.read()
+    return pages
+
+
+def read_golden(fixture_dir, page):
+    path = os.path.join(fixture_dir, f'{page}.csv')
+    if os.path.getsize(path) == 0:
+        return None
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def write_golden(fixture_dir, page, df):
+    path = os.path.join(fixture_dir, f'{page}.csv')
+    if df is None:
+        open(path, 'w').close()
+    else:
+        df.to_csv(path, index=False)
+
+
+def same_rows(df, df_golden):
+    """
+    compare a parse result with the golden rows as strings (None 和空字串視為一樣)
+    return (ok, message)
+    """
+    if df is None or df_golden is None:
+        return df is None and df_golden is None, f"result is {'None' if df is None else 'a table'}, " \
+                                                   f"golden is {'None' if df_golden is None else 'a table'}"
+    if list(df.columns) != list(df_golden.columns):
+        return False, f"columns {list(df.columns)} != {list(df_golden.columns)}"
+    if len(df) != len(df_golden):
+        return False, f"{len(df)} rows != {len(df_golden)} golden rows"
+    df = df.fillna('').astype(str).reset_index(drop=True)
+    diff = (df != df_golden).any(axis=1)
+    if diff.any():
+        i = int(diff.idxmax())
+        return False, f"row {i}: {df.iloc[i].tolist()} != {df_golden.iloc[i].tolist()}"
+    return True, ''
+
+
+def available_engines(engines=ENGINES):
+    return [e for e in engines if e not in ENGINE_MODULES or importlib.util.find_spec(ENGINE_MODULES[e])]
+
+
+def measure(html, engine, min_time=0.5):
+    """
+    (ms per page, peak traced KB per page) of parse_broker_page
+    時間是重複 parse 到至少 min_time 秒的平均；記憶體另外用 tracemalloc 跑一次 (tracemalloc 會拖慢速度)
+    """
+    import tracemalloc
+
+    n, t0 = 0, time.perf_counter()
+    while True:
+        parse_broker_page(html, engine)
+        n += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time:
+            break
+
+    tracemalloc.start()
+    parse_broker_page(html, engine)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed / n * 1000, peak / 1024
+
+
+def run(engines=None, fixture_dir=FIXTURE_DIR, min_time=0.5, check_only=False):
+    """
+    check every page with every engine against the golden rows, then time them
+    return (DataFrame of results, set of engines with wrong results)
+    """
+    engines = available_engines(engines or ENGINES)
+    pages = load_pages(fixture_dir)
+    run_id = time.strftime('%Y%m%d_%H%M%S')
+    rows, failed = [], set()
+
+    for engine in engines:
+        print(f"=== {engine} ===")
+        for page, html in pages.items():
+            df = parse_broker_page(html, engine)
+            ok, msg = same_rows(df, read_golden(fixture_dir, page))
+            if not ok:
+                failed.add(engine)
+                print(f"  {page:<20} FAIL  {msg}")
+            row = {'run_id': run_id, 'engine': engine, 'page': page, 'size_kb': len(html.encode()) / 1024,
+                   'rows': None if df is None else len(df), 'ok': ok}
+            if not check_only:
+                ms, peak_kb = measure(html, engine, min_time)
+                row.update(ms_per_page=ms, pages_per_s=1000 / ms, peak_kb_per_page=peak_kb)
+                print(f"  {page:<20}{'ok' if ok else 'FAIL':<6}{ms:>9.2f} ms/page{1000 / ms:>9.1f} pages/s"
+                      f"{peak_kb:>10.0f} KB peak")
+            elif ok:
+                print(f"  {page:<20} ok")
+            rows.append(row)
+
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS).round(3), failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the broker page parser against saved pages and time it')
+    parser.add_argument('--engines', type=str, default=','.join(ENGINES),
+                        help='BeautifulSoup parser engines, not installed ones are skipped')
+    parser.add_argument('--check-only', action='store_true', help='only compare with the golden rows')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds spent timing each page')
+    parser.add_argument('--fixtures', type=str, default=FIXTURE_DIR)
+    parser.add_argument('-o', '--output', type=str, default=None, help='append results to this csv')
+    parser.add_argument('--update-golden', action='store_true',
+                        help=f'rewrite the golden csv files with the current parser ({HTML_PARSER})')
+    args = parser.parse_args()
+
+    if args.update_golden:
+        for page, html in load_pages(args.fixtures).items():
+            write_golden(args.fixtures, page, parse_broker_page(html, HTML_PARSER))
+        print(f"Golden files in {args.fixtures} rewritten with {HTML_PARSER}")
+        sys.exit(0)
+
+    df, failed = run(args.engines.split(','), args.fixtures, args.min_time, args.check_only)
+    if args.output:
+        output = os.path.expanduser(args.output)
+        df.to_csv(output, mode='a', header=not os.path.isfile(output), index=False)
+        print(f"Results appended to {output}")
+
+    if failed:
+        print(f"Wrong results with: {', '.join(sorted(failed))}")
+    # 只有正式使用的 engine 錯才算失敗
+    sys.exit(1 if HTML_PARSER in failed else 0)
@@ -0,0 +1,495 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from run_stats import current_stage, take_counts, StageMeter, maxrss_mb, proc_io, append_run
+from profile_hook import settings_from_env, profiled
+
+DATA_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data'
+LOG_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/py_scripts/sh_logs'
+STATE_FILE = 'pipeline_state.json'
+
+# stage name -> threading.Event, 這次 run 裡這個 stage 結束 (不管成功失敗或跳過) 時 set
+stage_done = {}
+
+
+# -------------------------------------------------------------------
+# In-process stage functions
+# 在同一個 process 裡跑時不用每個 stage 重開 interpreter 重新 import pandas 等套件，
+# results 是已經跑完的 stage 的回傳值，可以直接拿來用不用再讀檔
+# -------------------------------------------------------------------
+def _trading_date(results):
+    from trading_date import generate_trading_date
+    return generate_trading_date()
+
+
+def _download_stock(results):
+    import asyncio
+    from async_download_stock import main
+    asyncio.run(main())
+
+
+def _crawl_broker(results):
+    from daily_asyc_brokerdata import go_through_dates
+    from stream_alerts import for_crawl
+    # 今天的資料一抓到就檢查，不用等 analyze 跑完 (calc_result/live_alerts.csv)
+    alerts = for_crawl(DATA_DIR, results.get('trading_date'))
+    go_through_dates(f'{DATA_DIR}/Tradingdate.csv',
+                     f'{DATA_DIR}/big_branch_list.csv',
+                     f'{DATA_DIR}/small_broker_trading',
+                     Ori_Tradingdate=results.get('trading_date'),
+                     backfill_dir=f'{DATA_DIR}/backfill',
+                     on_rows=alerts.evaluate if alerts is not None else None)
+    if alerts is not None:
+        # download_stock 和 crawl 同時跑，還沒有成交量的列等它做完再檢查 cond1
+        alerts.finish(ready=stage_done.get('download_stock'))
+        print(f"{len(alerts.alerts)} streaming alerts")
+
+
+def _ticker_index(results):
+    import ticker_index
+    conn = ticker_index.connect(f'{DATA_DIR}/ticker_index')
+    ticker_index.update(conn, f'{DATA_DIR}/small_broker_trading')
+    conn.close()
+
+
+def _analyze(results):
+    from broker_analyze import main
+    main([])
+
+
+def _rolling_success(results):
+    from rolling_success import update
+    update(f'{DATA_DIR}/calc_result', f'{DATA_DIR}/rolling_success')
+
+
+def _send_email(results):
+    from send_email import send_latest_log
+    if not send_latest_log(LOG_DIR):
+        raise RuntimeError('send_latest_log failed')
+
+# -------------------------------------------------------------------
+# Stage DAG
+#   deps:    要先跑完的 stage
+#   inputs:  內容沒變 (且 outputs 都在) 就跳過這個 stage
+#   outputs: 這個 stage 產生的檔案 / 資料夾
+#   func / script: 同一個 process 裡呼叫的 function / --subprocess 時執行的 script
+#   always:  抓外部資料的 stage，沒辦法從本地檔案判斷有沒有新資料，每次都跑
+#   fail_counters: run_stats 的 counter，跑完後 > 0 代表有資料沒抓到，不記 fingerprint (下次還會再跑)
+# -------------------------------------------------------------------
+STAGES = {
+    'trading_date': {
+        'func': _trading_date,
+        'script': 'trading_date.py',
+        'deps': [],
+        'inputs': [],
+        'outputs': [f'{DATA_DIR}/Tradingdate.csv'],
+        'always': True,
+    },
+    'download_stock': {
+        'func': _download_stock,
+        'script': 'async_download_stock.py',
+        'deps': [],
+        'inputs': [],
+        'outputs': [f'{DATA_DIR}/AllStockHist'],
+        'always': True,
+    },
+    'crawl_broker': {
+        'func': _crawl_broker,
+        'script': 'daily_asyc_brokerdata.py',
+        'deps': ['trading_date'],
+        # 分點檔只補 Tradingdate.csv 裡比最後一天新的日期，交易日和分點清單都沒變就沒事可做
+        'inputs': [f'{DATA_DIR}/Tradingdate.csv', f'{DATA_DIR}/big_branch_list.csv'],
+        'outputs': [f'{DATA_DIR}/small_broker_trading'],
+        'always': False,
+        'fail_counters': ['broker_failed'],
+    },
+    'ticker_index': {
+        'func': _ticker_index,
+        'script': 'ticker_index.py',
+        'args': ['update'],
+        'deps': ['crawl_broker'],
+        # 只 index 分點檔新 append 的部分
+        'inputs': [f'{DATA_DIR}/small_broker_trading'],
+        'outputs': [f'{DATA_DIR}/ticker_index'],
+        'always': False,
+    },
+    'analyze': {
+        'func': _analyze,
+        'script': 'broker_analyze.py',
+        'deps': ['download_stock', 'crawl_broker'],
+        'inputs': [f'{DATA_DIR}/AllStockHist', f'{DATA_DIR}/small_broker_trading'],
+        'outputs': [f'{DATA_DIR}/calc_result'],
+        'always': False,
+    },
+    'rolling_success': {
+        'func': _rolling_success,
+        'script': 'rolling_success.py',
+        'deps': ['analyze'],
+        # 只加新的交易日，已經加過的日子 big buy 變了才重建
+        'inputs': [f'{DATA_DIR}/calc_result/broker_big_buy.csv', f'{DATA_DIR}/calc_result/big_gain_signals.csv',
+                   f'{DATA_DIR}/Tradingdate.csv'],
+        'outputs': [f'{DATA_DIR}/rolling_success'],
+        'always': False,
+    },
+    'send_email': {
+        'func': _send_email,
+        'script': 'send_email.py',
+        # log 要包含所有 stage 的結果
+        'deps': ['analyze', 'ticker_index', 'rolling_success'],
+        'inputs': [],
+        'outputs': [],
+        'always': True,
+    },
+}
+
+
+def topo_order(stages):
+    """
+    stage names in dependency order, 有循環或不存在的 dep 時 raise ValueError
+    """
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle in pipeline at stage {name}")
+        if name not in stages:
+            raise ValueError(f"Unknown stage {name}")
+        visiting.add(name)
+        for dep in stages[name]['deps']:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def _iter_files(path):
+    """files under path, 跳過隱藏的資料夾和檔案 (例如 branch_lock 的 .locks/，每次拿鎖都會改 mtime)"""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for filename in sorted(files):
+                if not filename.startswith('.'):
+                    yield os.path.join(root, filename)
+    elif os.path.isfile(path):
+        yield path
+
+
+def fingerprint(paths, mode='mtime'):
+    """
+    fingerprint of input files / folders
+    mode='hash' 用檔案內容 (重新下載但內容一樣也算沒變)，mode='mtime' 只看大小和修改時間，比較快
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        path = os.path.expanduser(path)
+        h.update(path.encode())
+        for file_path in _iter_files(path):
+            st = os.stat(file_path)
+            h.update(os.path.relpath(file_path, path).encode())
+            h.update(str(st.st_size).encode())
+            if mode == 'mtime':
+                h.update(str(st.st_mtime_ns).encode())
+            else:
+                with open(file_path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+    return h.hexdigest()
+
+
+def load_state(log_dir):
+    state_path = os.path.join(os.path.expanduser(log_dir), STATE_FILE)
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(log_dir, state):
+    state_path = os.path.join(os.path.expanduser(log_dir), STATE_FILE)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def is_up_to_date(stage, state_fp, fp_mode):
+    """
+    True if the stage's inputs are unchanged since its last successful run
+    """
+    if stage['always'] or not stage['inputs'] or state_fp is None:
+        return False, None
+    if not all(os.path.exists(os.path.expanduser(p)) for p in stage['outputs']):
+        return False, None
+    fp = fingerprint(stage['inputs'], fp_mode)
+    return fp == state_fp, fp
+
+
+def run_script(name, stage, cwd):
+    """
+    run one stage in its own interpreter, output 先收起來，結束後一次印出避免並行時交錯
+    CPU / peak RSS 用 wait4 拿 child 的 rusage，IO 在 child 還活著時從 /proc/<pid>/io 讀
+    return (returncode, output, stats)
+    """
+    t0 = time.perf_counter()
+    with tempfile.TemporaryFile() as out, tempfile.NamedTemporaryFile('r', suffix='.json') as counts_file:
+        env = dict(os.environ, PIPELINE_STAGE=name, PIPELINE_STATS_FILE=counts_file.name)
+        cmd = [stage['script']] + stage.get('args', [])
+        mode, frames = settings_from_env(name)
+        if mode or frames:
+            # 用 profile_hook.py 包起來跑這個 script
+            cmd = ['profile_hook.py', '--mode', mode or 'none', '--tracemalloc', str(frames),
+                   '--name', name] + cmd
+        proc = subprocess.Popen([sys.executable] + cmd,
+                                cwd=cwd, stdout=out, stderr=subprocess.STDOUT, env=env)
+        # WNOWAIT: 結束後先不回收，還能讀到最後的 /proc/<pid>/io，之後 wait4 再拿 rusage
+        while os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+            time.sleep(0.2)
+        io_last = proc_io(proc.pid)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        out.seek(0)
+        output = out.read().decode(errors='replace')
+        try:
+            counts = json.load(counts_file)
+        except ValueError:
+            counts = {}
+
+    stats = {
+        'wall_s': time.perf_counter() - t0,
+        'cpu_s': rusage.ru_utime + rusage.ru_stime,
+        'peak_rss_mb': maxrss_mb(rusage.ru_maxrss),
+        'read_mb': None if io_last is None else io_last[0] / 2**20,
+        'write_mb': None if io_last is None else io_last[1] / 2**20,
+        'requests_detail': counts,
+    }
+    return proc.returncode, output, stats
+
+
+# 每個 stage thread 的 stdout / stderr buffer
+_stage_local = threading.local()
+
+
+class _ThreadOutput:
+    """
+    sys.stdout / sys.stderr replacement, stage thread 裡的 print 寫到自己的 buffer
+    """
+    def __init__(self, real):
+        self.real = real
+
+    def write(self, text):
+        buf = getattr(_stage_local, 'buf', None)
+        return (self.real if buf is None else buf).write(text)
+
+    def flush(self):
+        self.real.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+
+def run_function(name, stage, results):
+    """
+    run one stage as a function in this process, 回傳格式和 run_script 一樣
+    """
+    buf = io.StringIO()
+    _stage_local.buf = buf
+    token = current_stage.set(name)
+    meter = StageMeter()
+    returncode = 0
+    try:
+        # 沒開 profile 時 profiled 直接 yield，幾乎沒有額外成本
+        with profiled(name, *settings_from_env(name)):
+            results[name] = stage['func'](results)
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (1 if e.code else 0)
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        _stage_local.buf = None
+        current_stage.reset(token)
+    stats = meter.stop()
+    stats['requests_detail'] = take_counts(name)
+    return returncode, buf.getvalue(), stats
+
+
+def run_stage(name, stage, state_fp, force, fp_mode, in_process, results, cwd):
+    """
+    skip check + run one stage in a pool thread (hash 模式要讀完整個 input，不能放在 scheduler thread)
+    return (fingerprint, None) when up to date, else (fingerprint, (returncode, output, stats))
+    """
+    up_to_date, fp = (False, None) if force else is_up_to_date(stage, state_fp, fp_mode)
+    if up_to_date:
+        return fp, None
+    if fp is None and stage['inputs'] and not stage['always']:
+        fp = fingerprint(stage['inputs'], fp_mode)
+    if in_process:
+        return fp, run_function(name, stage, results)
+    return fp, run_script(name, stage, cwd)
+
+
+def run_pipeline(stages=STAGES, only=None, force=False, fp_mode='mtime', max_workers=4,
+                 log_dir=LOG_DIR, cwd=None, in_process=True, run_id=None):
+    """
+    run the DAG, 依賴都完成的 stage 就丟進 thread pool 同時跑
+    失敗的 stage 之後的 stage 都不跑 (blocked)，其他分支照常
+    in_process=True 時所有 stage 在這個 process 裡當 function 跑，False 時每個 stage 開一個 subprocess
+    每個 stage 結束就 append 一列到 runs table (run_stats.RUNS_FILE)
+    return {stage: {'status', 'start_s', 'wall_s', 'cpu_s', ...}}
+    """
+    run_id = run_id or time.strftime('%Y%m%d_%H%M%S')
+    mode = 'process' if in_process else 'subprocess'
+    intervals = {}
+    cwd = cwd or os.path.dirname(os.path.abspath(__file__))
+    order = topo_order(stages)
+    if only:
+        order = [n for n in order if n in only]
+    state = load_state(log_dir)
+    report = {}
+    results = {}
+    stage_done.clear()
+    stage_done.update({name: threading.Event() for name in order})
+
+    def record(name, entry):
+        report[name] = entry
+        append_run(log_dir, {'run_id': run_id, 'stage': name, 'mode': mode, **entry})
+        stage_done[name].set()
+
+    if in_process:
+        # stage 裡的相對路徑 (例如 logs/) 和 script 一樣以 py_scripts 為準
+        os.chdir(cwd)
+        sys.stdout, sys.stderr = _ThreadOutput(sys.stdout), _ThreadOutput(sys.stderr)
+    t_start = time.perf_counter()
+
+    pending = list(order)
+    running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    stage = stages[name]
+                    deps = [d for d in stage['deps'] if d in order]
+                    if any(report.get(d, {}).get('status') in ('failed', 'blocked') for d in deps):
+                        record(name, {'status': 'blocked', 'start_s': None, 'wall_s': 0.0})
+                        pending.remove(name)
+                        print(f"Skip {name}: upstream stage failed")
+                        continue
+                    if not all(d in report for d in deps):
+                        continue
+
+                    pending.remove(name)
+                    start = time.perf_counter() - t_start
+                    fut = executor.submit(run_stage, name, stage, state.get(name, {}).get('fingerprint'), force,
+                                          fp_mode, in_process, results, cwd)
+                    running[fut] = (name, start)
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    name, start = running.pop(fut)
+                    fp, ran = fut.result()
+                    if ran is None:
+                        record(name, {'status': 'skipped', 'start_s': None, 'wall_s': 0.0})
+                        print(f"Skip {name}: inputs unchanged")
+                        continue
+                    returncode, output, stats = ran
+                    # 這段時間裡有沒有其他 stage 也在跑 (in-process 時 CPU / IO 是共用的)
+                    end = start + stats['wall_s']
+                    intervals[name] = (start, end)
+                    overlap = bool(running) or any(s0 < end and e0 > start
+                                                   for n, (s0, e0) in intervals.items() if n != name)
+                    print(f"Running {stages[name]['script']}...")
+                    print(output, end='' if output.endswith('\n') or not output else '\n')
+                    if returncode != 0:
+                        print(f"Error encountered while running {stages[name]['script']}. Check the log for details.")
+                        record(name, {'status': 'failed', 'start_s': start, 'overlap': overlap, **stats})
+                    else:
+                        print(f"Finished {stages[name]['script']}.")
+                        record(name, {'status': 'ok', 'start_s': start, 'overlap': overlap, **stats})
+                        failures = {k: stats['requests_detail'][k] for k in stages[name].get('fail_counters', [])
+                                    if stats['requests_detail'].get(k)}
+                        if failures:
+                            # 有資料沒抓到，下次 inputs 沒變也要再跑
+                            print(f"{name} finished with {failures}, not recorded as up to date")
+                            if state.pop(name, None) is not None:
+                                save_state(log_dir, state)
+                        elif fp is not None:
+                            state[name] = {'fingerprint': fp, 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+                            save_state(log_dir, state)
+                    print('--------------------------', flush=True)
+    finally:
+        if in_process:
+            sys.stdout, sys.stderr = sys.stdout.real, sys.stderr.real
+
+    # 依 DAG 順序排好
+    report = {name: report[name] for name in order}
+    report['_total'] = {'status': '', 'start_s': 0.0, 'wall_s': time.perf_counter() - t_start}
+    return report
+
+
+def format_report(report):
+    """
+    per-stage wall time table, 總時間是 critical path 而不是每個 stage 加總
+    """
+    lines = [f"{'stage':<16}{'status':<10}{'start(s)':>10}{'wall(s)':>10}{'cpu(s)':>10}{'rss(MB)':>10}"]
+    for name, r in report.items():
+        if name == '_total':
+            continue
+        start = '' if r['start_s'] is None else f"{r['start_s']:.1f}"
+        cpu = '' if r.get('cpu_s') is None else f"{r['cpu_s']:.1f}"
+        rss = '' if r.get('peak_rss_mb') is None else f"{r['peak_rss_mb']:.0f}"
+        lines.append(f"{name:<16}{r['status']:<10}{start:>10}{r['wall_s']:>10.1f}{cpu:>10}{rss:>10}")
+    stage_sum = sum(r['wall_s'] for n, r in report.items() if n != '_total')
+    lines.append(f"sum of stages {stage_sum:.1f}s, end-to-end {report['_total']['wall_s']:.1f}s")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the daily broker analysis pipeline')
+    parser.add_argument('--only', type=lambda t: t.split(','), default=None,
+                        help=f'comma separated stages to run ({",".join(STAGES)})')
+    parser.add_argument('--force', action='store_true', help='run every stage even if its inputs are unchanged')
+    parser.add_argument('--fingerprint', choices=['hash', 'mtime'], default='mtime',
+                        help='how to detect unchanged inputs (default size + mtime, hash reads every input file)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='max stages running at once')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='run every stage in its own interpreter instead of one warm process')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'], default=None,
+                        help='profile stages, output goes to sh_logs/profiles (same as PIPELINE_PROFILE)')
+    parser.add_argument('--profile-stages', type=str, default=None,
+                        help='comma separated stages to profile (default all)')
+    parser.add_argument('--tracemalloc', type=int, default=None, metavar='FRAMES',
+                        help='also record tracemalloc snapshots with this many frames')
+    args = parser.parse_args()
+
+    # 用環境變數傳給 stage，subprocess 模式也會繼承
+    if args.profile:
+        os.environ['PIPELINE_PROFILE'] = args.profile
+    if args.profile_stages:
+        os.environ['PIPELINE_PROFILE_STAGES'] = args.profile_stages
+    if args.tracemalloc:
+        os.environ['PIPELINE_TRACEMALLOC'] = str(args.tracemalloc)
+
+    os.makedirs(os.path.expanduser(LOG_DIR), exist_ok=True)
+    report = run_pipeline(only=args.only, force=args.force, fp_mode=args.fingerprint,
+                          max_workers=args.workers, in_process=not args.subprocess)
+    print(format_report(report))
+    sys.exit(1 if any(r['status'] == 'failed' for r in report.values()) else 0)
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+
+def build_price_panel(df_price, columns=('Open', 'High', 'Low', 'Close')):
+    """
+    pivot the price history into 2D arrays (ticker x trading day)
+    沒有交易的日子為 NaN，dates 就是所有股票日期的聯集 (交易日曆)
+    """
+    dates = np.sort(df_price['Date'].unique())
+    tickers = np.sort(df_price['Ticker'].astype(str).unique())
+
+    ti = np.searchsorted(tickers, df_price['Ticker'].astype(str).to_numpy())
+    di = np.searchsorted(dates, df_price['Date'].to_numpy())
+
+    panel = {'dates': pd.DatetimeIndex(dates), 'tickers': tickers}
+    for col in columns:
+        arr = np.full((len(tickers), len(dates)), np.nan)
+        arr[ti, di] = df_price[col].to_numpy(dtype=float)
+        panel[col] = arr
+    return panel
+
+
+def locate(panel, tickers, dates):
+    """
+    map (Ticker, Date) arrays to (ticker_idx, date_ord) of the panel, -1 when not found
+    不是交易日的日期會對到下一個交易日
+    """
+    tickers = np.asarray(tickers, dtype=str)
+    ti = np.searchsorted(panel['tickers'], tickers)
+    ti_ok = ti < len(panel['tickers'])
+    ti_ok[ti_ok] = panel['tickers'][ti[ti_ok]] == tickers[ti_ok]
+    ti = np.where(ti_ok, ti, -1)
+
+    di = np.searchsorted(panel['dates'].to_numpy(), pd.to_datetime(dates).to_numpy())
+    di = np.where(di < len(panel['dates']), di, -1)
+    return ti, di
+
+
+def forward_window(arr, ti, start, length):
+    """
+    return arr[ti, start:start+length] for every event as an (events x length) array
+    用 sliding_window_view 取 strided window，超出資料範圍的部分為 NaN
+    """
+    padded = np.pad(arr, ((0, 0), (0, length)), constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, length, axis=1)
+    start = np.minimum(start, arr.shape[1])
+    return windows[ti, start]
@@ -0,0 +1,269 @@
+import os
+import sys
+import time
+import runpy
+import argparse
+import threading
+import contextlib
+from collections import Counter
+
+PROFILE_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/py_scripts/sh_logs/profiles'
+
+# pipeline 的 stage 會在同一個 process 的不同 thread 同時跑
+#   tracemalloc 是整個 process 共用的，用 refcount 決定誰 start / stop，最後一個離開的才 stop
+#   cProfile 同一時間只能有一個 (3.12+ 第二個 enable 會 ValueError)，拿不到就改用 sampler
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+_cprofile_lock = threading.Lock()
+
+# -------------------------------------------------------------------
+# 開關都用環境變數，pipeline 的 --profile 也只是設定這幾個，subprocess 會繼承
+#   PIPELINE_PROFILE=cprofile|sample     profiler 種類，沒設就完全不做事
+#   PIPELINE_PROFILE_STAGES=a,b          只 profile 這些 stage (預設全部)
+#   PIPELINE_TRACEMALLOC=<frames>        同時記錄 tracemalloc snapshot
+# -------------------------------------------------------------------
+def settings_from_env(stage=None):
+    """
+    (mode, tracemalloc_frames) for a stage, mode None 代表不 profile
+    """
+    mode = os.environ.get('PIPELINE_PROFILE') or None
+    stages = os.environ.get('PIPELINE_PROFILE_STAGES')
+    if stage is not None and stages and stage not in stages.split(','):
+        return None, 0
+    return mode, int(os.environ.get('PIPELINE_TRACEMALLOC') or 0)
+
+
+def _func_label(code_or_key):
+    if isinstance(code_or_key, tuple):     # pstats key (file, line, name)
+        filename, line, name = code_or_key
+    else:                                  # frame.f_code
+        filename, line, name = code_or_key.co_filename, code_or_key.co_firstlineno, code_or_key.co_name
+    return f"{os.path.basename(filename)}:{name}:{line}"
+
+
+# -------------------------------------------------------------------
+# Sampling profiler: 背景 thread 每 interval 秒看一次所有 thread 的 stack
+# 會抓到 asyncio.to_thread / thread pool 裡的工作，cProfile 只看得到呼叫的那個 thread
+# -------------------------------------------------------------------
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_func_label(frame.f_code))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return self.stacks
+
+    def top_table(self, top=30):
+        """
+        self / inclusive samples per function
+        """
+        self_count, incl_count = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            funcs = stack.split(';')[1:]       # 第一格是 thread 名稱
+            if not funcs:
+                continue
+            self_count[funcs[-1]] += n
+            for f in set(funcs):
+                incl_count[f] += n
+        total = sum(self.stacks.values()) or 1
+        lines = [f"{total} samples every {self.interval * 1000:.0f} ms",
+                 f"{'self%':>7}{'incl%':>7}  function"]
+        for f, n in self_count.most_common(top):
+            lines.append(f"{100 * n / total:>7.1f}{100 * incl_count[f] / total:>7.1f}  {f}")
+        return '\n'.join(lines)
+
+
+# -------------------------------------------------------------------
+# cProfile -> collapsed stacks
+# cProfile 只有 caller -> callee 的邊，stack 用每條邊佔的 cumulative time 比例往下分 (近似值)
+# -------------------------------------------------------------------
+def cprofile_collapsed(stats, min_us=100, max_depth=64):
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+
+    roots = [f for f, v in stats.items() if not v[4]]
+    collapsed = Counter()
+
+    def visit(path, share):
+        func = path[-1]
+        _, _, tt, ct, _ = stats[func]
+        if ct <= 0 or len(path) > max_depth:
+            return
+        frac = min(share / ct, 1.0)
+        self_us = int(tt * frac * 1e6)
+        if self_us >= min_us:
+            collapsed[';'.join(_func_label(f) for f in path)] += self_us
+        for callee in callees.get(func, []):
+            # 遞迴呼叫不再往下展開
+            if callee in path:
+                continue
+            edge_ct = stats[callee][4][func][3]
+            if edge_ct * frac * 1e6 >= min_us:
+                visit(path + (callee,), edge_ct * frac)
+
+    for root in roots:
+        visit((root,), stats[root][3])
+    return collapsed
+
+
+def _tracemalloc_acquire(frames):
+    global _tracemalloc_users, _tracemalloc_owned
+    import tracemalloc
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _tracemalloc_release():
+    global _tracemalloc_users, _tracemalloc_owned
+    import tracemalloc
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        # 不是這裡 start 的 (例如 python -X tracemalloc) 就不去 stop
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+def _cprofile_start(name):
+    """
+    enabled cProfile.Profile holding _cprofile_lock, None 代表已經有別的 stage 在用 cProfile
+    """
+    import cProfile
+    if not _cprofile_lock.acquire(blocking=False):
+        print(f"{name}: cProfile already active in another stage, using the sampling profiler")
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 3.12+ 外面已經有別的 profiler (sys.monitoring) 在跑
+        _cprofile_lock.release()
+        print(f"{name}: another profiler is active, using the sampling profiler")
+        return None
+    return profiler
+
+
+@contextlib.contextmanager
+def profiled(name, mode=None, tracemalloc_frames=0, out_dir=PROFILE_DIR, top=30):
+    """
+    wrap a block in cProfile or the sampling profiler
+    寫出 <name>_<time>.collapsed (flamegraph.pl / speedscope 可用)、_top.txt，
+    tracemalloc_frames > 0 時再加 _mem.txt (記憶體配置最多的前 top 行)
+    mode=None 且沒開 tracemalloc 時什麼都不做
+    """
+    if not mode and not tracemalloc_frames:
+        yield
+        return
+    if mode not in (None, 'cprofile', 'sample'):
+        raise ValueError(f"Unknown profile mode {mode}, use 'cprofile' or 'sample'")
+
+    out_dir = os.path.expanduser(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.join(out_dir, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}")
+
+    if tracemalloc_frames:
+        _tracemalloc_acquire(tracemalloc_frames)
+
+    profiler = sampler = None
+    if mode == 'cprofile':
+        profiler = _cprofile_start(name)
+        if profiler is None:
+            mode = 'sample'
+    if mode == 'sample':
+        sampler = Sampler()
+        sampler.start()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            import io
+            import pstats
+            profiler.disable()
+            _cprofile_lock.release()
+            profiler.dump_stats(prefix + '.prof')
+            buf = io.StringIO()
+            ps = pstats.Stats(profiler, stream=buf)
+            ps.sort_stats('cumulative').print_stats(top)
+            with open(prefix + '_top.txt', 'w') as f:
+                f.write(buf.getvalue())
+            collapsed = cprofile_collapsed(ps.stats)
+        elif sampler is not None:
+            sampler.stop()
+            with open(prefix + '_top.txt', 'w') as f:
+                f.write(sampler.top_table(top) + '\n')
+            collapsed = sampler.collapsed()
+        else:
+            collapsed = None
+
+        if collapsed is not None:
+            with open(prefix + '.collapsed', 'w') as f:
+                for stack, n in collapsed.most_common():
+                    f.write(f"{stack} {n}\n")
+
+        if tracemalloc_frames:
+            import tracemalloc
+            # 還沒 release 前 tracing 一定是開著的，別的 stage 結束也不會 stop
+            try:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                _tracemalloc_release()
+            with open(prefix + '_mem.txt', 'w') as f:
+                f.write(f"current / peak traced: {current / 2**20:.1f} / {peak / 2**20:.1f} MB"
+                        f" (process-wide)\n")
+                for stat in snapshot.statistics('lineno')[:top]:
+                    f.write(f"{stat}\n")
+        print(f"Profile of {name} saved to {prefix}*")
+
+
+if __name__ == '__main__':
+    # python profile_hook.py --mode sample broker_analyze.py --stream
+    parser = argparse.ArgumentParser(description='Run a script under cProfile or the sampling profiler')
+    parser.add_argument('--mode', choices=['cprofile', 'sample', 'none'], default='cprofile',
+                        help="'none' only records tracemalloc")
+    parser.add_argument('--tracemalloc', type=int, default=0, metavar='FRAMES',
+                        help='also record tracemalloc with this many frames')
+    parser.add_argument('--name', type=str, default=None, help='output file prefix (default script name)')
+    parser.add_argument('-o', '--out-dir', type=str, default=PROFILE_DIR)
+    parser.add_argument('script')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.argv = [args.script] + args.args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    name = args.name or os.path.splitext(os.path.basename(args.script))[0]
+    mode = None if args.mode == 'none' else args.mode
+    with profiled(name, mode, args.tracemalloc, args.out_dir):
+        runpy.run_path(args.script, run_name='__main__')
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+from query_service import PORT
+
+# -------------------------------------------------------------------
+# Load test for query_service.py
+#   每個 thread 一條 keep-alive 連線，持續送隨機查詢 duration 秒
+#   查詢用的 (分點, 股票) 和日期從 server 的 /keys 取樣
+#   回報 QPS 和每種查詢的 latency (client 端量到的，含 json 傳輸)
+# -------------------------------------------------------------------
+MIX = {'pair': 4, 'ticker': 2, 'branch': 1, 'bought': 2, 'date': 1}
+RESULT_COLUMNS = ['run_id', 'query', 'threads', 'requests', 'errors', 'qps', 'p50_ms', 'p95_ms', 'p99_ms',
+                  'max_ms']
+
+
+def make_query(kind, keys, rng, min_rate):
+    branch, ticker = rng.choice(keys['pairs'])
+    if kind == 'pair':
+        params = {'branch': branch, 'ticker': ticker}
+    elif kind == 'ticker':
+        params = {'ticker': ticker}
+    elif kind == 'branch':
+        params = {'branch': branch}
+    elif kind == 'bought':
+        params = {'ticker': ticker, 'days': 5, 'min_rate': min_rate}
+    else:
+        params = {'date': rng.choice(keys['dates']), 'min_rate': min_rate}
+    return f'/{kind}?{urllib.parse.urlencode(params)}'
+
+
+def worker(host, port, keys, mix, duration, min_rate, seed, out):
+    rng = random.Random(seed)
+    kinds, weights = list(mix), list(mix.values())
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    latency = {k: [] for k in kinds}
+    errors = {k: 0 for k in kinds}
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        kind = rng.choices(kinds, weights)[0]
+        path = make_query(kind, keys, rng, min_rate)
+        t0 = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            resp.read()
+            ok = resp.status == 200
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            ok = False
+        if ok:
+            latency[kind].append(time.perf_counter() - t0)
+        else:
+            errors[kind] += 1
+    conn.close()
+    out.append((latency, errors))
+
+
+def run(url, threads=4, duration=10.0, mix=MIX, min_rate=0.49):
+    """
+    return a DataFrame with one row per query kind and one 'all' row
+    """
+    u = urllib.parse.urlsplit(url)
+    host, port = u.hostname, u.port or PORT
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    conn.request('GET', '/keys?n=500')
+    keys = json.loads(conn.getresponse().read())
+    conn.close()
+
+    out = []
+    pool = [threading.Thread(target=worker, args=(host, port, keys, mix, duration, min_rate, i, out))
+            for i in range(threads)]
+    t0 = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    run_id = time.strftime('%Y%m%d_%H%M%S')
+    rows = []
+    for kind in list(mix) + ['all']:
+        kinds = list(mix) if kind == 'all' else [kind]
+        lat = np.array([x for latency, _ in out for k in kinds for x in latency[k]]) * 1000
+        err = sum(errors[k] for _, errors in out for k in kinds)
+        p50, p95, p99, pmax = np.percentile(lat, [50, 95, 99, 100]) if len(lat) else [np.nan] * 4
+        rows.append({'run_id': run_id, 'query': kind, 'threads': threads, 'requests': len(lat), 'errors': err,
+                     'qps': len(lat) / elapsed, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': pmax})
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS).round(3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure QPS and latency of a running query_service.py')
+    parser.add_argument('--url', type=str, default=f'http://127.0.0.1:{PORT}')
+    parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--only', type=str, default=None, help=f"comma separated subset of {','.join(MIX)}")
+    parser.add_argument('--min-rate', type=float, default=0.49)
+    parser.add_argument('-o', '--output', type=str, default=None, help='append results to this csv')
+    args = parser.parse_args()
+
+    mix = MIX if args.only is None else {k: MIX[k] for k in args.only.split(',')}
+    df = run(args.url, args.threads, args.duration, mix, args.min_rate)
+    print(df.drop(columns='run_id').to_string(index=False))
+    if args.output:
+        output = os.path.expanduser(args.output)
+        df.to_csv(output, mode='a', header=not os.path.isfile(output), index=False)
+        print(f"Results appended to {output}")
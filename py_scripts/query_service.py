@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import ticker_index
+from broker_analyze import read_big_buy
+
+CALC_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result'
+PORT = 8766
+SOURCES = {'pair': 'broker_branch_ticker_success_rate.csv',
+           'branch': 'broker_success_rate.csv',
+           'big_buy': 'broker_big_buy.csv'}
+BIG_BUY_COLUMNS = ['Date', 'Branch_Code', 'Branch', 'Ticker', 'Name', 'buy', 'sell', 'diff', 'Volume',
+                   'diff_7days_avg', 'is_big_buy_c1', 'is_big_buy_c2']
+
+
+def _records(df):
+    """DataFrame -> list of dict that json can dump (NaN -> None)"""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+class _Rows:
+    """
+    columns of a DataFrame as numpy arrays, rows 用位置取出成 dict
+    (每次查詢都用 df.iloc 要好幾 ms，這樣只要幾十 µs)
+    """
+    def __init__(self, df):
+        self.names = list(df.columns)
+        self.arrays = [df[c].to_numpy() for c in self.names]
+        self.is_float = [a.dtype.kind == 'f' for a in self.arrays]
+
+    def __len__(self):
+        return len(self.arrays[0]) if self.arrays else 0
+
+    def records(self, rows):
+        cols = [[None if v != v else v for v in a[rows].tolist()] if f else a[rows].tolist()
+                for a, f in zip(self.arrays, self.is_float)]
+        return [dict(zip(self.names, vals)) for vals in zip(*cols)]
+
+
+# -------------------------------------------------------------------
+# In-memory index over calc_result (broker_analyze 的輸出)
+#   pair_row    (Branch_Code, Ticker) -> row of broker_branch_ticker_success_rate
+#   by_ticker   Ticker -> 有交易過的分點 (rows, 成功率高的在前)
+#   by_branch   Branch_Code -> 交易過的股票 (rows, 成功率高的在前)
+#   查詢結果的 rows 用 _Rows 依位置取，不經過 DataFrame
+#   big buy 依日期排序，日期區間用 searchsorted 找 row range；
+#   bb_ticker / bb_pair 是每檔股票 / 每個組合的 big buy rows (日期由舊到新)
+# 建好之後不再修改，reload 時整個換掉，所以查詢不需要 lock
+# -------------------------------------------------------------------
+class StatsIndex:
+    def __init__(self, calc_dir=CALC_DIR):
+        t0 = time.perf_counter()
+        self.calc_dir = os.path.expanduser(calc_dir)
+        self.signature = source_signature(self.calc_dir)
+
+        df_bt = pd.read_csv(self._path('pair'), dtype={'Branch_Code': str, 'Ticker': str})
+        df_bt = df_bt.sort_values('success_rate', ascending=False, kind='stable').reset_index(drop=True)
+        self.pair_row = dict(zip(zip(df_bt['Branch_Code'], df_bt['Ticker']), range(len(df_bt))))
+        self.by_ticker = df_bt.groupby('Ticker', sort=False).indices
+        self.by_branch = df_bt.groupby('Branch_Code', sort=False).indices
+        self.bt_rows = _Rows(df_bt)
+        self.bt_rate = df_bt['success_rate'].to_numpy()
+
+        df_b = pd.read_csv(self._path('branch'), dtype={'Branch_Code': str})
+        self.branch_stat = dict(zip(df_b['Branch_Code'], _records(df_b)))
+
+        df_bb = read_big_buy(self._path('big_buy'))
+        df_bb = df_bb[[c for c in BIG_BUY_COLUMNS if c in df_bb.columns]]
+        df_bb = df_bb.sort_values('Date', kind='stable').reset_index(drop=True)
+        self.bb_dates = df_bb['Date'].to_numpy()
+        self.trading_dates = np.unique(self.bb_dates)
+        # 每列 big buy 對應的組合成功率，沒有的 (例如 ETF) 是 NaN
+        rows = [self.pair_row.get(k, -1) for k in zip(df_bb['Branch_Code'].astype(str), df_bb['Ticker'].astype(str))]
+        rows = np.asarray(rows, dtype=np.int64)
+        self.bb_rate = np.where(rows >= 0, self.bt_rate[rows], np.nan)
+        df_bb['Date'] = df_bb['Date'].dt.strftime('%Y-%m-%d')
+        df_bb['success_rate'] = self.bb_rate
+        self.bb_rows = _Rows(df_bb)
+        self.bb_date_str = df_bb['Date'].to_numpy()
+        self.bb_ticker = df_bb.groupby('Ticker', sort=False, observed=True).indices
+        self.bb_pair = df_bb.groupby(['Branch_Code', 'Ticker'], sort=False, observed=True).indices
+
+        self.loaded_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.load_s = time.perf_counter() - t0
+
+    def _path(self, name):
+        return os.path.join(self.calc_dir, SOURCES[name])
+
+    # ---- queries, 都回傳 dict ----
+    def pair(self, branch, ticker, recent=10):
+        """stats of one (分點, 股票) and its latest big buys"""
+        i = self.pair_row.get((branch, ticker))
+        bb = self.bb_pair.get((branch, ticker), np.empty(0, dtype=np.int64))
+        return {'Branch_Code': branch, 'Ticker': ticker,
+                'stats': None if i is None else self.bt_rows.records([i])[0],
+                'branch_stats': self.branch_stat.get(branch),
+                'big_buys': len(bb),
+                'recent_big_buys': self.bb_rows.records(bb[::-1][:recent])}
+
+    def ticker(self, ticker, min_rate=None, limit=50):
+        """branches that traded the ticker, highest success rate first"""
+        rows = self._above(self.by_ticker.get(ticker), min_rate)
+        return {'Ticker': ticker, 'branches': len(rows), 'rows': self.bt_rows.records(rows[:limit])}
+
+    def branch(self, branch, min_rate=None, limit=50):
+        """a branch's overall stats and its tickers, highest success rate first"""
+        rows = self._above(self.by_branch.get(branch), min_rate)
+        return {'Branch_Code': branch, 'stats': self.branch_stat.get(branch), 'tickers': len(rows),
+                'rows': self.bt_rows.records(rows[:limit])}
+
+    def _above(self, rows, min_rate):
+        rows = np.empty(0, dtype=np.int64) if rows is None else rows
+        return rows if min_rate is None else rows[self.bt_rate[rows] > min_rate]
+
+    def date_range(self, start=None, end=None, days=None):
+        """(first, last) row of the big buys between start and end, days = 最後幾個交易日"""
+        if days is not None and days < 1:
+            raise ValueError(f"days must be >= 1, got {days}")
+        if days is not None and len(self.trading_dates):
+            start = self.trading_dates[max(len(self.trading_dates) - days, 0)]
+        lo = 0 if start is None else int(np.searchsorted(self.bb_dates, np.datetime64(pd.Timestamp(start)), 'left'))
+        hi = len(self.bb_dates) if end is None else \
+            int(np.searchsorted(self.bb_dates, np.datetime64(pd.Timestamp(end)), 'right'))
+        return lo, hi
+
+    def bought(self, ticker=None, start=None, end=None, days=None, min_rate=None, limit=200):
+        """big buys in a date range (optionally one ticker), 附上組合的成功率，新的在前"""
+        lo, hi = self.date_range(start, end, days)
+        if ticker is not None:
+            rows = self.bb_ticker.get(ticker, np.empty(0, dtype=np.int64))
+            rows = rows[(rows >= lo) & (rows < hi)]
+        else:
+            rows = np.arange(lo, hi)
+        if min_rate is not None:
+            rows = rows[self.bb_rate[rows] > min_rate]
+        rows = rows[::-1]
+        return {'Ticker': ticker, 'start': None if lo >= hi else self.bb_date_str[lo],
+                'end': None if lo >= hi else self.bb_date_str[hi - 1],
+                'big_buys': len(rows), 'rows': self.bb_rows.records(rows[:limit])}
+
+    def date(self, date, min_rate=None, limit=200):
+        return self.bought(start=date, end=date, min_rate=min_rate, limit=limit)
+
+    def keys(self, n=100, seed=None):
+        """random sample of known keys (給 load test 用)"""
+        rng = random.Random(seed)
+        pairs = rng.sample(list(self.pair_row), min(n, len(self.pair_row)))
+        dates = [pd.Timestamp(d).strftime('%Y-%m-%d') for d in self.trading_dates]
+        return {'pairs': [list(p) for p in pairs], 'dates': rng.sample(dates, min(n, len(dates)))}
+
+    def info(self):
+        return {'calc_dir': self.calc_dir, 'loaded_at': self.loaded_at, 'load_s': round(self.load_s, 3),
+                'pairs': len(self.pair_row), 'tickers': len(self.by_ticker), 'branches': len(self.by_branch),
+                'big_buys': len(self.bb_rows),
+                'last_date': self.bb_date_str[-1] if len(self.bb_date_str) else None}
+
+
+def source_signature(calc_dir):
+    """(mtime, size) of the source files, 用來判斷要不要 reload"""
+    sig = []
+    for f in SOURCES.values():
+        try:
+            st = os.stat(os.path.join(calc_dir, f))
+            sig.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+
+# -------------------------------------------------------------------
+# Hot reload
+#   背景 thread 每 check_s 秒看一次 source 檔案的 (mtime, size)
+#   改變後要連續兩次一樣才 reload (broker_analyze 可能還在寫)，讀檔失敗就保留舊的 index 下次再試
+# -------------------------------------------------------------------
+class QueryService:
+    def __init__(self, calc_dir=CALC_DIR, check_s=5.0, store_dir=ticker_index.STORE_DIR,
+                 index_dir=ticker_index.INDEX_DIR):
+        self.calc_dir = os.path.expanduser(calc_dir)
+        self.check_s = check_s
+        self.index = StatsIndex(self.calc_dir)
+        self.version = 1
+        self.store_dir, self.index_dir = store_dir, index_dir
+        self._local = threading.local()     # sqlite connection 不能跨 thread 共用
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        pending = None
+        while not self._stop.wait(self.check_s):
+            sig = source_signature(self.calc_dir)
+            if sig == self.index.signature or None in sig:
+                pending = None
+                continue
+            if sig != pending:
+                pending = sig
+                continue
+            try:
+                index = StatsIndex(self.calc_dir)
+            except (OSError, ValueError, KeyError, pd.errors.ParserError) as e:
+                print(f"Reload failed, keeping the old index: {e}", flush=True)
+                continue
+            self.index, self.version, pending = index, self.version + 1, None
+            print(f"Reloaded {self.calc_dir} in {index.load_s:.2f}s (version {self.version})", flush=True)
+
+    def trades(self, ticker, start=None, end=None, limit=200):
+        """
+        raw rows of a ticker from the branch files, 用 ticker_index 只讀相關的 rows，新的在前
+        只讀 index，不在 request 裡 update (要拿 lock、寫 DB)，index 由 pipeline 的 ticker_index stage 更新
+        """
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = ticker_index.connect(self.index_dir)
+        stats = {}
+        df = ticker_index.read_rows(self._local.conn, ticker, start, end, self.store_dir, refresh=False, stats=stats)
+        return {'Ticker': ticker, 'rows_total': len(df), 'branches': int(df['Branch_Code'].nunique()),
+                'bytes_read': stats['bytes'], 'stale_branches': stats['stale'],
+                'rows': _records(df.iloc[::-1].head(limit))}
+
+    def query(self, path, params):
+        """path: pair / ticker / branch / bought / date / trades / keys / info"""
+        index = self.index
+        get = params.get
+        min_rate = None if get('min_rate') is None else float(get('min_rate'))
+        limit = int(get('limit', 50))
+        if path == 'pair':
+            return index.pair(get('branch'), get('ticker'), int(get('recent', 10)))
+        if path == 'ticker':
+            return index.ticker(get('ticker'), min_rate, limit)
+        if path == 'branch':
+            return index.branch(get('branch'), min_rate, limit)
+        if path == 'bought':
+            return index.bought(get('ticker'), get('start'), get('end'),
+                                None if get('days') is None else int(get('days')), min_rate, int(get('limit', 200)))
+        if path == 'date':
+            return index.date(get('date'), min_rate, int(get('limit', 200)))
+        if path == 'trades':
+            return self.trades(get('ticker'), get('start'), get('end'), int(get('limit', 200)))
+        if path == 'keys':
+            return index.keys(int(get('n', 100)))
+        if path == 'info':
+            return {**index.info(), 'version': self.version}
+        raise KeyError(path)
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'   # keep-alive，load test 才不會量到連線時間
+        disable_nagle_algorithm = True  # header 和 body 分兩次寫，不關的話每個 response 會卡 ~40ms
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            t0 = time.perf_counter()
+            try:
+                status, result = 200, service.query(url.path.strip('/'), params)
+            except KeyError:
+                status, result = 404, {'error': f'unknown query {url.path}'}
+            except (TypeError, ValueError) as e:
+                status, result = 400, {'error': str(e)}
+            except Exception as e:
+                # 回一個 500，不要讓 handler 丟例外把 keep-alive 連線斷掉
+                status, result = 500, {'error': f'{type(e).__name__}: {e}'}
+            body = json.dumps(result, ensure_ascii=False, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Query-Ms', f'{(time.perf_counter() - t0) * 1000:.3f}')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(calc_dir=CALC_DIR, port=PORT, check_s=5.0, store_dir=ticker_index.STORE_DIR,
+          index_dir=ticker_index.INDEX_DIR):
+    service = QueryService(calc_dir, check_s, store_dir, index_dir)
+    service.start()
+    print(f"Loaded {service.index.info()}")
+    print(f"Serving http://127.0.0.1:{port}/  (pair, ticker, branch, bought, date, trades, info)", flush=True)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(service))
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query branch / ticker statistics from calc_result')
+    parser.add_argument('--calc-dir', type=str, default=CALC_DIR)
+    parser.add_argument('--store-dir', type=str, default=ticker_index.STORE_DIR,
+                        help='branch files for the trades query')
+    parser.add_argument('--index-dir', type=str, default=ticker_index.INDEX_DIR)
+    parser.add_argument('--url', type=str, default=None,
+                        help='ask a running server (e.g. http://127.0.0.1:8766) instead of loading the files')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    p = sub.add_parser('serve', help='run the HTTP server')
+    p.add_argument('--port', type=int, default=PORT)
+    p.add_argument('--check', type=float, default=5.0, help='seconds between checks for new analysis outputs')
+
+    p = sub.add_parser('pair', help="a branch's record on one ticker")
+    p.add_argument('branch')
+    p.add_argument('ticker')
+    p.add_argument('--recent', type=int, default=10)
+
+    for name, key in (('ticker', 'ticker'), ('branch', 'branch')):
+        p = sub.add_parser(name, help=f'success rates by {key}')
+        p.add_argument(key)
+        p.add_argument('--min-rate', type=float, default=None)
+        p.add_argument('--limit', type=int, default=50)
+
+    p = sub.add_parser('bought', help='big buys in a date range, e.g. --ticker 2330 --days 5 --min-rate 0.49')
+    p.add_argument('--ticker', type=str, default=None)
+    p.add_argument('--start', type=str, default=None)
+    p.add_argument('--end', type=str, default=None)
+    p.add_argument('--days', type=int, default=None, help='last N trading days')
+    p.add_argument('--min-rate', type=float, default=None)
+    p.add_argument('--limit', type=int, default=200)
+
+    p = sub.add_parser('date', help='big buys on one day')
+    p.add_argument('date')
+    p.add_argument('--min-rate', type=float, default=None)
+    p.add_argument('--limit', type=int, default=200)
+
+    p = sub.add_parser('trades', help="a ticker's rows in the branch files (through ticker_index)")
+    p.add_argument('ticker')
+    p.add_argument('--start', type=str, default=None)
+    p.add_argument('--end', type=str, default=None)
+    p.add_argument('--limit', type=int, default=200)
+
+    sub.add_parser('info', help='what is loaded')
+    args = parser.parse_args()
+
+    if args.cmd == 'serve':
+        serve(args.calc_dir, args.port, args.check, args.store_dir, args.index_dir)
+        sys.exit(0)
+
+    params = {k: str(v) for k, v in vars(args).items()
+              if k not in ('calc_dir', 'store_dir', 'index_dir', 'url', 'cmd') and v is not None}
+    if args.url:
+        url = f"{args.url.rstrip('/')}/{args.cmd}?{urllib.parse.urlencode(params)}"
+        with urllib.request.urlopen(url) as resp:
+            result = json.loads(resp.read())
+    else:
+        result = QueryService(args.calc_dir, None, args.store_dir, args.index_dir).query(args.cmd, params)
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
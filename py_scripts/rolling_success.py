@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+DATA_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data'
+CALC_DIR = f'{DATA_DIR}/calc_result'
+STATE_DIR = f'{DATA_DIR}/rolling_success'
+WINDOWS = (60, 120, 250)     # 交易日
+HALF_LIVES = (20, 60)        # 交易日
+TRADINGDATE_FILE = f'{DATA_DIR}/Tradingdate.csv'
+RELABEL_DAYS = 10            # 最近幾天的 signal 還可能變 (未來 7 日均線還沒算完)，每次重新對一次
+
+
+# -------------------------------------------------------------------
+# Rolling-window / time-decayed success rates (和 cheating_rate 一樣用 (Ticker, Date) 對 signal)
+#   每個 (分點, 股票) 一個 id，counter 都是以 id 為 index 的 numpy array
+#   window w:  最近 w 個交易日 (T-w, T] 的 big buy 次數 / 成功次數
+#              新的一天加進來時把當天的事件加上去，再把 T-w 那天的事件扣掉，
+#              所以要留最後 max(WINDOWS) 天每天的事件 (day_events)
+#   half life h: 事件權重 0.5 ** (經過的交易日 / h)
+#              每個 id 記錄上次更新的日子 dec_ord，要更新時才把舊的值衰減到今天，
+#              不用每天把所有組合都乘一次
+#   最近 RELABEL_DAYS 天的事件每天用新的 signal 重新判斷成功與否，差值補進 counter
+#   加一天的計算量只和當天 (加上重新判斷的幾天) 的事件數有關，不需要重新 groupby 整個 df_big_buy
+#   日子用 Tradingdate.csv 的交易日 (沒有 big buy 的交易日也要加，window 才是真的 w 個交易日)
+#   state 記每天的 big buy 數 (day_counts)，已經加過的日子事後多了資料 (backfill、重抓的缺口) 就整個重建
+# -------------------------------------------------------------------
+class RollingSuccess:
+    def __init__(self, windows=WINDOWS, half_lives=HALF_LIVES, relabel_days=RELABEL_DAYS):
+        self.windows = tuple(sorted(int(w) for w in windows))
+        self.half_lives = tuple(float(h) for h in half_lives)
+        self.relabel_days = int(relabel_days)
+        self.days = []                  # 已加入的交易日 'YYYY-MM-DD'，ord = index
+        self.day_counts = []            # 每個交易日加入時的 big buy 數
+        self.pair_id = {}               # (Branch_Code, Ticker) -> id
+        self.branch_codes, self.tickers = [], []
+        self.win_events = np.zeros((len(self.windows), 0), dtype=np.int64)
+        self.win_success = np.zeros((len(self.windows), 0), dtype=np.int64)
+        self.dec_events = np.zeros((len(self.half_lives), 0))
+        self.dec_success = np.zeros((len(self.half_lives), 0))
+        self.dec_ord = np.zeros(0, dtype=np.int64)
+        self.day_events = {}            # ord -> (ids, success, tickers)
+
+    @property
+    def last_date(self):
+        return self.days[-1] if self.days else None
+
+    def _ids(self, branch_codes, tickers):
+        ids = np.empty(len(branch_codes), dtype=np.int64)
+        for i, key in enumerate(zip(branch_codes, tickers)):
+            pid = self.pair_id.get(key)
+            if pid is None:
+                pid = self.pair_id[key] = len(self.branch_codes)
+                self.branch_codes.append(key[0])
+                self.tickers.append(key[1])
+            ids[i] = pid
+        n = len(self.branch_codes)
+        if n > len(self.dec_ord):
+            # 容量加倍，攤提下來 append 是 O(1)
+            cap = max(n, 2 * len(self.dec_ord), 1024)
+            grow = lambda a: np.concatenate([a, np.zeros(a.shape[:-1] + (cap - a.shape[-1],), dtype=a.dtype)],
+                                            axis=-1)
+            self.win_events, self.win_success = grow(self.win_events), grow(self.win_success)
+            self.dec_events, self.dec_success = grow(self.dec_events), grow(self.dec_success)
+            self.dec_ord = grow(self.dec_ord)
+        return ids
+
+    @staticmethod
+    def _label(tickers, date, signals):
+        """success of the events: (Ticker, date) 有 signal"""
+        signalled = signals.get(date)
+        if signalled is None or len(tickers) == 0:
+            return np.zeros(len(tickers), dtype=np.int64)
+        return np.isin(tickers, signalled).astype(np.int64)
+
+    def _add_success(self, ids, d, delta):
+        """success 改變的事件 (day d) 補進 window 和 decay counter"""
+        T = len(self.days) - 1
+        for k, w in enumerate(self.windows):
+            # 還沒扣掉今天離開 window 的那天，所以 T-w 也還在裡面
+            if d >= T - w:
+                np.add.at(self.win_success[k], ids, delta)
+        for k, h in enumerate(self.half_lives):
+            np.add.at(self.dec_success[k], ids, delta * 0.5 ** ((self.dec_ord[ids] - d) / h))
+
+    def add_day(self, date, branch_codes, tickers, signals):
+        """
+        add one trading day (要依序，每個交易日都要加，沒有 big buy 的日子也一樣)
+        branch_codes / tickers: 當天的 big buy rows
+        signals: {'YYYY-MM-DD': array of tickers with a signal}，至少要有今天和前 relabel_days 天
+        """
+        if self.days and date <= self.days[-1]:
+            raise ValueError(f"{date} is not after the last added day {self.days[-1]}")
+        self.days.append(date)
+        T = len(self.days) - 1
+        tickers = np.asarray(tickers, dtype=object)
+        ids = self._ids(list(branch_codes), tickers)
+        success = self._label(tickers, date, signals)
+
+        # 之前幾天的 signal 可能變了
+        for d in range(max(0, T - self.relabel_days), T):
+            if d not in self.day_events:
+                continue
+            d_ids, d_success, d_tickers = self.day_events[d]
+            new = self._label(d_tickers, self.days[d], signals)
+            changed = new != d_success
+            if changed.any():
+                self._add_success(d_ids[changed], d, new[changed] - d_success[changed])
+                self.day_events[d] = (d_ids, new, d_tickers)
+
+        # window: 加今天，扣掉剛離開 window 的那天
+        for k, w in enumerate(self.windows):
+            np.add.at(self.win_events[k], ids, 1)
+            np.add.at(self.win_success[k], ids, success)
+            if T - w in self.day_events:
+                old_ids, old_success, _ = self.day_events[T - w]
+                np.subtract.at(self.win_events[k], old_ids, 1)
+                np.subtract.at(self.win_success[k], old_ids, old_success)
+
+        # decay: 先把今天有事件的組合衰減到今天
+        touched = np.unique(ids)
+        for k, h in enumerate(self.half_lives):
+            factor = 0.5 ** ((T - self.dec_ord[touched]) / h)
+            self.dec_events[k, touched] *= factor
+            self.dec_success[k, touched] *= factor
+            np.add.at(self.dec_events[k], ids, 1.0)
+            np.add.at(self.dec_success[k], ids, success.astype(float))
+        self.dec_ord[touched] = T
+
+        self.day_events[T] = (ids, success, tickers)
+        self.day_events.pop(T - max(max(self.windows), self.relabel_days), None)
+        self.day_counts.append(len(ids))
+        return len(ids)
+
+    def table(self):
+        """
+        success rates per (Branch_Code, Ticker) as of the last day
+        只列出最長的 window 裡有 big buy 的組合
+        """
+        n = len(self.branch_codes)
+        T = len(self.days) - 1
+        df = pd.DataFrame({'Branch_Code': self.branch_codes, 'Ticker': self.tickers})
+        for k, w in enumerate(self.windows):
+            df[f'total_count_{w}d'] = self.win_events[k, :n]
+            df[f'success_count_{w}d'] = self.win_success[k, :n]
+            df[f'success_rate_{w}d'] = _rate(self.win_success[k, :n], self.win_events[k, :n])
+        for k, h in enumerate(self.half_lives):
+            factor = 0.5 ** ((T - self.dec_ord[:n]) / h)
+            name = f'hl{h:g}d'
+            df[f'decayed_count_{name}'] = self.dec_events[k, :n] * factor
+            df[f'decayed_success_{name}'] = self.dec_success[k, :n] * factor
+            df[f'success_rate_{name}'] = _rate(self.dec_success[k, :n], self.dec_events[k, :n])
+        return df[df[f'total_count_{self.windows[-1]}d'] > 0].reset_index(drop=True)
+
+    def branch_table(self, df=None):
+        """per branch: 同一分點所有股票的 counter 加總"""
+        df = self.table() if df is None else df
+        counts = [c for c in df.columns if c.startswith(('total_count', 'success_count', 'decayed'))]
+        df_b = df.groupby('Branch_Code', as_index=False)[counts].sum()
+        for w in self.windows:
+            df_b[f'success_rate_{w}d'] = _rate(df_b[f'success_count_{w}d'], df_b[f'total_count_{w}d'])
+        for h in self.half_lives:
+            name = f'hl{h:g}d'
+            df_b[f'success_rate_{name}'] = _rate(df_b[f'decayed_success_{name}'], df_b[f'decayed_count_{name}'])
+        return df_b
+
+    # ---- state ----
+    def save(self, state_dir=STATE_DIR):
+        state_dir = os.path.expanduser(state_dir)
+        os.makedirs(state_dir, exist_ok=True)
+        n = len(self.branch_codes)
+        kept = sorted(self.day_events)
+        ev_ids = [self.day_events[d][0] for d in kept]
+        np.savez(os.path.join(state_dir, 'state.tmp.npz'),
+                 branch_codes=np.asarray(self.branch_codes, dtype=str), tickers=np.asarray(self.tickers, dtype=str),
+                 win_events=self.win_events[:, :n], win_success=self.win_success[:, :n],
+                 dec_events=self.dec_events[:, :n], dec_success=self.dec_success[:, :n], dec_ord=self.dec_ord[:n],
+                 ev_ord=np.repeat(np.asarray(kept, dtype=np.int64), [len(i) for i in ev_ids]),
+                 ev_ids=np.concatenate(ev_ids) if ev_ids else np.zeros(0, dtype=np.int64),
+                 ev_success=np.concatenate([self.day_events[d][1] for d in kept]) if kept
+                 else np.zeros(0, dtype=np.int64))
+        with open(os.path.join(state_dir, 'meta.tmp.json'), 'w') as f:
+            json.dump({'windows': self.windows, 'half_lives': self.half_lives, 'relabel_days': self.relabel_days,
+                       'days': self.days, 'day_counts': self.day_counts}, f)
+        os.replace(os.path.join(state_dir, 'state.tmp.npz'), os.path.join(state_dir, 'state.npz'))
+        os.replace(os.path.join(state_dir, 'meta.tmp.json'), os.path.join(state_dir, 'meta.json'))
+
+    @classmethod
+    def load(cls, state_dir=STATE_DIR):
+        """saved state, 沒有的話 (或是沒有 day_counts 的舊格式) 回傳 None"""
+        state_dir = os.path.expanduser(state_dir)
+        if not os.path.isfile(os.path.join(state_dir, 'meta.json')):
+            return None
+        with open(os.path.join(state_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if 'day_counts' not in meta:
+            return None
+        tracker = cls(meta['windows'], meta['half_lives'], meta['relabel_days'])
+        tracker.days, tracker.day_counts = meta['days'], meta['day_counts']
+        with np.load(os.path.join(state_dir, 'state.npz')) as z:
+            tracker.branch_codes, tracker.tickers = z['branch_codes'].tolist(), z['tickers'].tolist()
+            tracker.pair_id = {k: i for i, k in enumerate(zip(tracker.branch_codes, tracker.tickers))}
+            tracker.win_events, tracker.win_success = z['win_events'], z['win_success']
+            tracker.dec_events, tracker.dec_success, tracker.dec_ord = z['dec_events'], z['dec_success'], z['dec_ord']
+            ev_ord, ev_ids, ev_success = z['ev_ord'], z['ev_ids'], z['ev_success']
+        for d in np.unique(ev_ord):
+            sel = ev_ord == d
+            tracker.day_events[int(d)] = (ev_ids[sel], ev_success[sel],
+                                          np.asarray([tracker.tickers[i] for i in ev_ids[sel]], dtype=object))
+        return tracker
+
+
+def _rate(success, total):
+    success, total = np.asarray(success, dtype=float), np.asarray(total, dtype=float)
+    return np.divide(success, total, out=np.zeros(len(total)), where=total > 0)
+
+
+def signals_by_date(df_signals, since=None):
+    """{'YYYY-MM-DD': array of tickers} from big_gain_signals (只取 since 之後的)"""
+    dates = pd.to_datetime(df_signals['Date']).dt.strftime('%Y-%m-%d')
+    keep = dates >= since if since is not None else np.ones(len(dates), dtype=bool)
+    df = pd.DataFrame({'Date': dates[keep], 'Ticker': df_signals.loc[keep, 'Ticker'].astype(str)})
+    return {d: g.to_numpy() for d, g in df.groupby('Date')['Ticker']}
+
+
+def trading_days(df_big_buy, tradingdate_path=TRADINGDATE_FILE):
+    """
+    trading days from the first to the last big buy: Tradingdate.csv 的交易日加上 big buy 的日期
+    (Tradingdate.csv 從 2023 開始，backfill 補進來更早的歷史只能用有 big buy 的日子)
+    """
+    dates = set(df_big_buy['Date'].unique())
+    if not dates:
+        return []
+    tradingdate_path = os.path.expanduser(tradingdate_path)
+    if os.path.isfile(tradingdate_path):
+        first, last = min(dates), max(dates)
+        calendar = pd.read_csv(tradingdate_path, usecols=['str_date'], dtype=str)['str_date']
+        dates.update(calendar[(calendar >= first) & (calendar <= last)])
+    return sorted(dates)
+
+
+def _stale_reason(tracker, days, counts):
+    """
+    why the saved state no longer matches broker_big_buy.csv, None if it can be extended
+    """
+    n = len(tracker.days)
+    if tracker.days != days[:n]:
+        return 'the trading days changed'
+    late = [d for d, c in zip(tracker.days, tracker.day_counts) if counts.get(d, 0) != c]
+    if late:
+        return f"big buys changed on {len(late)} days already added ({late[0]} ~ {late[-1]})"
+    return None
+
+
+def update(calc_dir=CALC_DIR, state_dir=STATE_DIR, rebuild=False, windows=WINDOWS, half_lives=HALF_LIVES,
+           save_outputs=True, tradingdate_path=TRADINGDATE_FILE):
+    """
+    add the trading days after the saved state, then write
+    calc_result/rolling_success_rate.csv (分點, 股票) and rolling_branch_success_rate.csv (分點)
+    已經加過的日子 big buy 數不一樣 (事後補進來的資料) 時整個重建
+    """
+    calc_dir = os.path.expanduser(calc_dir)
+    tracker = None if rebuild else RollingSuccess.load(state_dir)
+
+    t0 = time.perf_counter()
+    df_big_buy = pd.read_csv(os.path.join(calc_dir, 'broker_big_buy.csv'),
+                             usecols=['Branch_Code', 'Ticker', 'Date'], dtype=str)
+    df_signals = pd.read_csv(os.path.join(calc_dir, 'big_gain_signals.csv'), usecols=['Ticker', 'Date'], dtype=str)
+    days = trading_days(df_big_buy, tradingdate_path)
+    counts = df_big_buy['Date'].value_counts().to_dict()
+    if tracker is not None:
+        reason = _stale_reason(tracker, days, counts)
+        if reason is not None:
+            print(f"Rolling success: {reason}, rebuilding")
+            # 重建時沿用 state 的參數
+            windows, half_lives = tracker.windows, tracker.half_lives
+            tracker = None
+    if tracker is None:
+        tracker = RollingSuccess(windows, half_lives)
+    new_days = days[len(tracker.days):]
+    # relabel 要用到已經加過的最後幾天
+    since = tracker.days[-tracker.relabel_days] if len(tracker.days) >= tracker.relabel_days else None
+    signals = signals_by_date(df_signals, since)
+    t_read = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    n_events = 0
+    df_new = df_big_buy[df_big_buy['Date'] > tracker.last_date] if tracker.last_date is not None else df_big_buy
+    groups = {date: g for date, g in df_new.groupby('Date')}
+    empty = np.zeros(0, dtype=object)
+    for date in new_days:
+        g = groups.get(date)
+        n_events += tracker.add_day(date, empty if g is None else g['Branch_Code'].to_numpy(),
+                                    empty if g is None else g['Ticker'].to_numpy(), signals)
+    t_add = time.perf_counter() - t0
+    print(f"Rolling success: added {len(new_days)} days ({n_events} big buys) in {t_add:.2f}s "
+          f"(reading {t_read:.1f}s), last day {tracker.last_date}")
+
+    tracker.save(state_dir)
+    if save_outputs:
+        df_bt = tracker.table()
+        df_bt.to_csv(os.path.join(calc_dir, 'rolling_success_rate.csv'), index=False)
+        tracker.branch_table(df_bt).to_csv(os.path.join(calc_dir, 'rolling_branch_success_rate.csv'), index=False)
+    return tracker
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rolling-window and time-decayed branch success rates')
+    parser.add_argument('--calc-dir', type=str, default=CALC_DIR)
+    parser.add_argument('--state-dir', type=str, default=STATE_DIR)
+    parser.add_argument('--rebuild', action='store_true', help='start over from the first big buy')
+    parser.add_argument('--windows', type=str, default=','.join(map(str, WINDOWS)),
+                        help='trading days, only used when the state is (re)built')
+    parser.add_argument('--half-lives', type=str, default=','.join(map(str, HALF_LIVES)),
+                        help='trading days, only used when the state is (re)built')
+    args = parser.parse_args()
+
+    update(args.calc_dir, args.state_dir, args.rebuild,
+           [int(w) for w in args.windows.split(',')], [float(h) for h in args.half_lives.split(',')])
@@ -28,27 +28,9 @@ cd "$PY_FOLDER" || {
     exit 1
 }
 
-# List of Python files to execute
-python_files=(
-    "trading_date.py"
-    "async_download_stock.py"
-    "daily_asyc_brokerdata.py"
-    "split_brokerdata.py"
-    "broker_analyze.py"
-    "send_email.py"
-)
-
-# Run each Python file and append stdout to the log file
-for file in "${python_files[@]}"; do
-    echo "Running $file..." >> $OUTPUT_FILE
-    python3 "$file" >> $OUTPUT_FILE 2>&1
-    if [ $? -ne 0 ]; then
-        echo "Error encountered while running $file. Check the log for details." >> $OUTPUT_FILE
-        break
-    fi
-    echo "Finished $file." >> $OUTPUT_FILE
-    echo "--------------------------" >> $OUTPUT_FILE
-done
+# Run the pipeline (stages and their dependencies are declared in pipeline.py,
+# independent stages run concurrently and stages with unchanged inputs are skipped)
+python3 pipeline.py >> $OUTPUT_FILE 2>&1 || echo "Pipeline finished with errors. Check the log for details." >> $OUTPUT_FILE
 
 # Deactivate Conda environment
 deactivate
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextvars
+from collections import Counter, defaultdict
+
+# 每次 pipeline 跑完一個 stage 就 append 一列，不改舊的列
+RUNS_FILE = 'pipeline_runs.csv'
+RUN_COLUMNS = ['run_id', 'stage', 'mode', 'status', 'start_s', 'wall_s', 'cpu_s', 'peak_rss_mb',
+               'read_mb', 'write_mb', 'requests', 'requests_detail', 'overlap']
+
+# -------------------------------------------------------------------
+# Network request counters
+#   stage 裡呼叫 count('broker_http') 之類的，依目前的 stage 分開累加
+#   current_stage 是 ContextVar，asyncio task / to_thread 都會帶過去
+#   subprocess 模式下由環境變數 PIPELINE_STAGE / PIPELINE_STATS_FILE 決定，結束時寫到檔案
+# -------------------------------------------------------------------
+current_stage = contextvars.ContextVar('current_stage', default=None)
+_counters = defaultdict(Counter)
+_lock = threading.Lock()
+
+
+def count(key, n=1):
+    stage = current_stage.get() or os.environ.get('PIPELINE_STAGE', '_')
+    with _lock:
+        _counters[stage][key] += n
+
+
+def take_counts(stage):
+    """
+    counters of one stage, 取出後清掉
+    """
+    with _lock:
+        return dict(_counters.pop(stage, {}))
+
+
+def _dump_counts():
+    with _lock:
+        counts = Counter()
+        for c in _counters.values():
+            counts.update(c)
+    with open(os.environ['PIPELINE_STATS_FILE'], 'w') as f:
+        json.dump(dict(counts), f)
+
+
+if os.environ.get('PIPELINE_STATS_FILE'):
+    atexit.register(_dump_counts)
+
+
+# -------------------------------------------------------------------
+# Process resources
+# -------------------------------------------------------------------
+def maxrss_mb(ru_maxrss):
+    # Linux 是 KB，macOS 是 bytes
+    return ru_maxrss / 2**20 if sys.platform == 'darwin' else ru_maxrss / 2**10
+
+
+def proc_io(pid='self'):
+    """
+    bytes passed through read / write syscalls (/proc/<pid>/io 的 rchar / wchar)
+    macOS 沒有 /proc，回傳 None
+    """
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            fields = dict(line.split(':') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def current_rss_mb():
+    """
+    current RSS of this process (/proc/self/statm)，macOS 沒有 /proc，回傳 None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StageMeter:
+    """
+    measure one in-process stage: wall / process CPU / peak RSS / IO 的前後差
+    ru_maxrss 是整個 process 從開始到現在的最高值 (前面的 stage 也算進去)，
+    所以 peak RSS 是 stage 期間背景 thread 每 interval 秒讀一次目前 RSS 的最大值，
+    讀不到 (沒有 /proc) 時留空
+    同時有其他 stage 在跑時 CPU、IO 和 RSS 是整個 process 的，會被標成 overlap
+    """
+    def __init__(self, interval=0.2):
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.io0 = proc_io()
+        self.peak_rss = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak_rss is not None:
+            self._thread = threading.Thread(target=self._sample, args=(interval,), name='stage-rss', daemon=True)
+            self._thread.start()
+
+    def _sample(self, interval):
+        while not self._stop.wait(interval):
+            rss = current_rss_mb()
+            if rss is not None and rss > self.peak_rss:
+                self.peak_rss = rss
+
+    def stop(self):
+        stats = {'wall_s': time.perf_counter() - self.wall0, 'cpu_s': time.process_time() - self.cpu0,
+                 'peak_rss_mb': None, 'read_mb': None, 'write_mb': None}
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            stats['peak_rss_mb'] = max(self.peak_rss, current_rss_mb() or 0)
+        io1 = proc_io()
+        if self.io0 is not None and io1 is not None:
+            stats['read_mb'] = (io1[0] - self.io0[0]) / 2**20
+            stats['write_mb'] = (io1[1] - self.io0[1]) / 2**20
+        return stats
+
+
+# -------------------------------------------------------------------
+# Runs table
+# -------------------------------------------------------------------
+def append_run(log_dir, row):
+    """
+    append one stage record to the runs table
+    """
+    import csv
+    path = os.path.join(os.path.expanduser(log_dir), RUNS_FILE)
+    is_new = not os.path.isfile(path)
+    row = dict(row)
+    detail = row.get('requests_detail') or {}
+    row['requests'] = sum(detail.values())
+    row['requests_detail'] = ';'.join(f'{k}={v}' for k, v in sorted(detail.items()))
+    for k, v in row.items():
+        if isinstance(v, float):
+            row[k] = round(v, 3)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RUN_COLUMNS, extrasaction='ignore')
+        if is_new:
+            writer.writeheader()
+        writer.writerow({k: ('' if row.get(k) is None else row.get(k)) for k in RUN_COLUMNS})
+
+
+def timing_summary(log_dir, run_id=None, window=10, factor=1.5, min_wall=5.0):
+    """
+    per-stage table of one run (預設最新一次) compared with the trailing median of
+    the previous `window` successful runs; wall 超過 median * factor (且多於 min_wall 秒) 標成 REGRESSION
+    """
+    import pandas as pd
+
+    path = os.path.join(os.path.expanduser(log_dir), RUNS_FILE)
+    if not os.path.isfile(path):
+        return ''
+    df = pd.read_csv(path, dtype={'run_id': str})
+    if df.empty:
+        return ''
+    run_id = run_id or df['run_id'].iloc[-1]
+    df_run = df[df['run_id'] == run_id]
+    df_hist = df[(df['run_id'] < run_id) & (df['status'] == 'ok')]
+
+    lines = [f"Run {run_id}",
+             f"{'stage':<16}{'status':<9}{'wall(s)':>9}{'median':>9}{'cpu(s)':>9}{'rss(MB)':>9}"
+             f"{'read(MB)':>10}{'write(MB)':>10}{'requests':>10}"]
+    for _, r in df_run.iterrows():
+        hist = df_hist[df_hist['stage'] == r['stage']].tail(window)['wall_s']
+        median = hist.median() if len(hist) else float('nan')
+        flag = ''
+        if r['status'] == 'ok' and len(hist) and r['wall_s'] > max(median * factor, min_wall):
+            flag = '  REGRESSION'
+        cells = [f"{r['stage']:<16}{r['status']:<9}{r['wall_s']:>9.1f}{median:>9.1f}"]
+        for col, width in [('cpu_s', 9), ('peak_rss_mb', 9), ('read_mb', 10), ('write_mb', 10)]:
+            cells.append(f"{r[col]:>{width}.1f}" if pd.notna(r[col]) else f"{'-':>{width}}")
+        cells.append(f"{int(r['requests']) if pd.notna(r['requests']) else 0:>10}")
+        lines.append(''.join(cells) + flag)
+    return '\n'.join(lines)
@@ -16,10 +16,7 @@ smtp_password = "rspm npap pznj nxcs"              # SMTP 密碼或 App 密碼
 
 import os
 import glob
-from collections import deque
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+
 
 def get_latest_csv(directory):
     """
@@ -35,40 +32,75 @@ def get_latest_csv(directory):
 
 # === 設定參數 ===
 csv_directory = '~/Documents/Dev/Cheater_finder/Stock_project/py_scripts/sh_logs'   # CSV 檔案所在的資料夾
-try:
-    latest_csv = get_latest_csv(csv_directory)
-    print(f"找到最新的 CSV 檔案：{latest_csv}")
-except Exception as e:
-    print(f"錯誤：{e}")
-    exit(1)
-
-
-# === 讀取 CSV 檔最後 10 行 ===
-try:
-    with open(latest_csv, 'r') as f:
-        # 利用 deque 儲存最後 10 行
-        last10 = deque(f, 10)
-except Exception as e:
-    print(f"讀取 CSV 檔案失敗: {e}")
-    exit(1)
-
-body = "".join(last10)
-
-# === 建立郵件內容 ===
-msg = MIMEMultipart()
-msg['From'] = sender
-msg['To'] = recipient
-msg['Subject'] = "Cheater finding result from mac"
-
-msg.attach(MIMEText(body, 'plain'))
-
-# === 透過 SMTP 發送郵件 ===
-try:
-    server = smtplib.SMTP_SSL(smtp_server, port=smtp_port)
-    # server.starttls()  # 如果 SMTP 伺服器支援 TLS
-    server.login(smtp_user, smtp_password)
-    server.send_message(msg)
-    server.quit()
-    print("郵件已成功發送！")
-except Exception as e:
-    print(f"發送郵件失敗: {e}")
\ No newline at end of file
+calc_directory = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result'
+
+
+def cheater_table(calc_dir=calc_directory):
+    """
+    text of calc_result/cheater_today_bought.csv (analyze 的主要結果)
+    analyze 沒有 cheater 時不會寫這個檔，所以比 broker_success_rate.csv 舊的檔案是之前留下來的，不算
+    """
+    calc_dir = os.path.expanduser(calc_dir)
+    cheater_path = os.path.join(calc_dir, 'cheater_today_bought.csv')
+    rate_path = os.path.join(calc_dir, 'broker_success_rate.csv')
+    if not os.path.isfile(cheater_path) or \
+            (os.path.isfile(rate_path) and os.path.getmtime(cheater_path) < os.path.getmtime(rate_path) - 60):
+        return "No cheater bought previous ticker today"
+
+    import pandas as pd
+    df = pd.read_csv(cheater_path, dtype={'Ticker': str, 'Branch_Code': str})
+    cols = [c for c in ['Branch', 'Ticker', 'Date', 'diff', 'Volume', 'success_rate'] if c in df.columns]
+    return "Cheaters bought:\n" + df[cols].to_string(index=False)
+
+
+def send_latest_log(directory=csv_directory, n_lines=10, calc_dir=calc_directory):
+    """
+    mail today's cheater table and the last n_lines of the latest log in directory, 成功回傳 True
+    cheater 表直接從 calc_dir 讀，不靠 log 尾巴 (後面的 stage 會把它擠掉)
+    """
+    try:
+        latest_csv = get_latest_csv(directory)
+        print(f"找到最新的 CSV 檔案：{latest_csv}")
+    except Exception as e:
+        print(f"錯誤：{e}")
+        return False
+
+    # === 讀取 CSV 檔最後 10 行 ===
+    try:
+        with open(latest_csv, 'r') as f:
+            # 利用 deque 儲存最後 10 行
+            last10 = deque(f, n_lines)
+    except Exception as e:
+        print(f"讀取 CSV 檔案失敗: {e}")
+        return False
+
+    # 每個 stage 的時間 / 資源表 (和過去幾次的 median 比較) 放在前面
+    from run_stats import timing_summary
+    summary = timing_summary(directory)
+    body = cheater_table(calc_dir) + "\n\n" + (summary + "\n\n" if summary else "") + "".join(last10)
+
+    # === 建立郵件內容 ===
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = recipient
+    msg['Subject'] = "Cheater finding result from mac"
+
+    msg.attach(MIMEText(body, 'plain'))
+
+    # === 透過 SMTP 發送郵件 ===
+    try:
+        server = smtplib.SMTP_SSL(smtp_server, port=smtp_port)
+        # server.starttls()  # 如果 SMTP 伺服器支援 TLS
+        server.login(smtp_user, smtp_password)
+        server.send_message(msg)
+        server.quit()
+        print("郵件已成功發送！")
+        return True
+    except Exception as e:
+        print(f"發送郵件失敗: {e}")
+        return False
+
+
+if __name__ == '__main__':
+    if not send_latest_log():
+        exit(1)
@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import asyncio
+import argparse
+import subprocess
+
+import pandas as pd
+
+import daily_asyc_brokerdata as crawler
+from branch_store import BRANCH_COLUMNS, branch_path, last_dates, merge_branch_rows
+
+DATA_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data'
+SHARD_DIR = f'{DATA_DIR}/crawl_shards'
+DB_FILE = 'leases.db'
+LEASE_SECONDS = 120
+SHARD_SIZE = 20      # 一個 shard 幾個分點
+SHARD_RETRIES = 2    # shard 抓完後，失敗的 (分點, 日期) 在同一個 lease 裡再抓幾輪
+MAX_ATTEMPTS = 3     # 還有失敗的日期時 shard 放回 pending，被 claim 這麼多次還失敗就標成 failed
+
+# -------------------------------------------------------------------
+# Sharded crawl
+#   init:   把 big_branch_list 切成 shard 寫進 SQLite lease table，每個分點要抓的起點 (after)
+#           也先算好存進去，worker 不用看得到主要的分點資料夾 (可以在別台機器)
+#   worker: 拿一個 pending 或 lease 過期的 shard，抓的時候每 LEASE_SECONDS/4 續 lease (heartbeat)
+#           worker 掛掉後 lease 過期，別的 worker 會接手重抓
+#           每個 worker 寫自己的 segments/<worker_id>/<分點>.csv，不會有兩個 process 寫同一個檔
+#           抓不到的 (分點, 日期) 記在 failures table，shard 放回 pending，下一次只重抓這些日期
+#   merge:  把 segment 去重複後合併進 small_broker_trading 的分點檔 (整檔重寫，舊的日期也保留)
+#           全部 shard 都 merge 過才會記 merged，沒 merge 的 segment 不會被下一次 init 刪掉
+# SQLite 檔案放在本機或共用磁碟，多台機器時 shard_dir 要是大家都看得到的路徑
+# -------------------------------------------------------------------
+def connect(shard_dir=SHARD_DIR):
+    shard_dir = os.path.expanduser(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(shard_dir, DB_FILE), timeout=60, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS shards (
+                        shard_id INTEGER PRIMARY KEY,
+                        branches TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        owner TEXT,
+                        lease_until REAL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        finished_at REAL)""")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS failures (
+                        shard_id INTEGER NOT NULL,
+                        branch_code TEXT NOT NULL,
+                        str_date TEXT NOT NULL,
+                        PRIMARY KEY (shard_id, branch_code, str_date))""")
+    return conn
+
+
+def init_shards(Tradingdatefile_path, Brokerlist_path, Saved_dir, shard_dir=SHARD_DIR,
+                shard_size=SHARD_SIZE, reset=False):
+    """
+    create the lease table, 每個分點只抓 Saved_dir 裡最後一天之後的日期
+    還有沒做完的 shard，或上一輪還沒 merge 時要 reset=True 才會重建 (沒 merge 的資料會丟掉)
+    """
+    conn = connect(shard_dir)
+    n_shards, unfinished = conn.execute("SELECT COUNT(*), COALESCE(SUM(status != 'done'), 0) FROM shards").fetchone()
+    merged = conn.execute("SELECT value FROM meta WHERE key = 'merged'").fetchone()
+    if unfinished and not reset:
+        conn.close()
+        raise RuntimeError(f"{unfinished} shards are not done yet, use reset to start over")
+    if n_shards and merged is None and not reset:
+        conn.close()
+        raise RuntimeError("The last sharded crawl has not been merged, run merge first or use reset to drop it")
+
+    df_dates = pd.read_csv(os.path.expanduser(Tradingdatefile_path))
+    Brockerlist = pd.read_csv(os.path.expanduser(Brokerlist_path), dtype=str)
+    saved = last_dates(Saved_dir).set_index('Branch_Code')['Date'].dt.strftime('%Y-%m-%d')
+
+    branches = [{'Broker_Code': row['Broker_Code'], 'Branch_Name': row['Branch_Name'],
+                 'Branch_Code': row['Branch_Code'], 'after': saved.get(row['Branch_Code'])}
+                for _, row in Brockerlist.iterrows()]
+
+    # 上一輪的 segment 不能混進這一輪的 merge
+    shutil.rmtree(os.path.join(os.path.expanduser(shard_dir), 'segments'), ignore_errors=True)
+
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('DELETE FROM shards')
+    conn.execute('DELETE FROM meta')
+    conn.execute('DELETE FROM failures')
+    conn.execute("INSERT INTO meta VALUES ('trading_dates', ?)", (json.dumps(df_dates['str_date'].tolist()),))
+    conn.executemany('INSERT INTO shards (branches) VALUES (?)',
+                     [(json.dumps(branches[i:i + shard_size], ensure_ascii=False),)
+                      for i in range(0, len(branches), shard_size)])
+    conn.execute('COMMIT')
+    n_shards = conn.execute('SELECT COUNT(*) FROM shards').fetchone()[0]
+    conn.close()
+    print(f"{len(branches)} branches in {n_shards} shards")
+    return n_shards
+
+
+def claim_shard(conn, worker_id, lease_s=LEASE_SECONDS):
+    """
+    lease a pending shard, 或是 lease 已經過期 (worker 掛掉) 的 shard
+    return (shard_id, branches) or None
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute("""SELECT shard_id, branches, owner, status FROM shards
+                              WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?)
+                              ORDER BY status DESC, shard_id LIMIT 1""", (now,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("""UPDATE shards SET status = 'leased', owner = ?, lease_until = ?,
+                        attempts = attempts + 1 WHERE shard_id = ?""", (worker_id, now + lease_s, row[0]))
+    finally:
+        conn.execute('COMMIT')
+    if row[3] == 'leased':
+        print(f"{worker_id}: taking over shard {row[0]} from {row[2]} (lease expired)")
+    return row[0], json.loads(row[1])
+
+
+def heartbeat(conn, shard_id, worker_id, lease_s=LEASE_SECONDS):
+    """
+    extend the lease, 回傳 False 代表 lease 已經被別人拿走，要停止這個 shard
+    """
+    cur = conn.execute("""UPDATE shards SET lease_until = ?
+                          WHERE shard_id = ? AND owner = ? AND status = 'leased'""",
+                       (time.time() + lease_s, shard_id, worker_id))
+    return cur.rowcount == 1
+
+
+def complete_shard(conn, shard_id, worker_id, failed=(), max_attempts=MAX_ATTEMPTS):
+    """
+    finish a leased shard, failed 是還沒抓到的 [(分點, 日期)]
+    沒有失敗 -> done；有失敗 -> 記進 failures 放回 pending (claim 次數到 max_attempts 就是 failed)
+    return the new status, None if the lease was lost
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute("SELECT attempts FROM shards WHERE shard_id = ? AND owner = ? AND status = 'leased'",
+                           (shard_id, worker_id)).fetchone()
+        if row is None:
+            return None
+        if failed:
+            status = 'failed' if row[0] >= max_attempts else 'pending'
+        else:
+            status = 'done'
+        conn.execute('DELETE FROM failures WHERE shard_id = ?', (shard_id,))
+        conn.executemany('INSERT OR IGNORE INTO failures VALUES (?, ?, ?)',
+                         [(shard_id, code, date) for code, date in failed])
+        conn.execute("UPDATE shards SET status = ?, lease_until = NULL, finished_at = ? WHERE shard_id = ?",
+                     (status, time.time(), shard_id))
+    finally:
+        conn.execute('COMMIT')
+    if failed:
+        print(f"{worker_id}: shard {shard_id} has {len(failed)} failed (branch, date), now {status}")
+    return status
+
+
+def shard_failures(conn, shard_id=None):
+    """
+    {branch_code: [dates]} still missing (shard_id None 時是全部 shard)
+    """
+    sql = 'SELECT branch_code, str_date FROM failures'
+    rows = conn.execute(sql + ' WHERE shard_id = ? ORDER BY 1, 2', (shard_id,)) if shard_id is not None \
+        else conn.execute(sql + ' ORDER BY 1, 2')
+    failures = {}
+    for code, date in rows:
+        failures.setdefault(code, []).append(date)
+    return failures
+
+
+def retry_failed(conn):
+    """
+    put failed shards back to pending (例如 server 恢復之後)
+    """
+    cur = conn.execute("UPDATE shards SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+    return cur.rowcount
+
+
+def shard_status(conn):
+    """
+    {status: count}, 過期的 lease 算成 expired
+    """
+    rows = conn.execute("""SELECT CASE WHEN status = 'leased' AND lease_until < ? THEN 'expired'
+                                       ELSE status END, COUNT(*)
+                           FROM shards GROUP BY 1""", (time.time(),)).fetchall()
+    return dict(rows)
+
+
+async def crawl_shard(conn, shard_id, branches, worker_id, trading_dates, segment_dir, lease_s,
+                      retries=SHARD_RETRIES):
+    """
+    crawl every branch of a shard into segment_dir, 期間定時 heartbeat
+    之前的 attempt 留下 failures 時只重抓那些日期 (其他日期已經在之前 worker 的 segment 裡)
+    抓完後失敗的日期再重抓 retries 輪，剩下的交給 complete_shard 記下來
+    return the shard status after this attempt, lease 被拿走時取消抓取，回傳 None
+    """
+    import aiohttp
+
+    df_dates = pd.DataFrame({'str_date': trading_dates})
+    df_dates['str_date_dt'] = pd.to_datetime(df_dates['str_date'], format='%Y-%m-%d')
+    todo = shard_failures(conn, shard_id)
+    if not todo:
+        todo = {b['Branch_Code']: df_dates['str_date'].tolist() if b['after'] is None else
+                df_dates.loc[df_dates['str_date'] > b['after'], 'str_date'].tolist() for b in branches}
+
+    async with aiohttp.ClientSession() as session:
+        semaphore = asyncio.Semaphore(crawler.BROKER_CONCURRENCY)
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(crawler.RETRY_DELAY)
+                print(f"{worker_id}: shard {shard_id} retry {attempt}, "
+                      f"{sum(map(len, todo.values()))} (branch, date) left")
+            failed = []
+            tasks = []
+            for b in branches:
+                dates = todo.get(b['Branch_Code'])
+                if not dates:
+                    continue
+                tasks.append(crawler.run_with_semaphore(session, semaphore, b['Broker_Code'], b['Branch_Name'],
+                                                        b['Branch_Code'], df_dates[df_dates['str_date'].isin(dates)],
+                                                        segment_dir, failed=failed))
+            crawl = asyncio.ensure_future(asyncio.gather(*tasks))
+
+            while not crawl.done():
+                await asyncio.wait({crawl}, timeout=lease_s / 4)
+                if not crawl.done() and not heartbeat(conn, shard_id, worker_id, lease_s):
+                    crawl.cancel()
+                    print(f"{worker_id}: lost the lease of shard {shard_id}, stop")
+                    return None
+            crawl.result()
+
+            todo = {}
+            for code, date in failed:
+                todo.setdefault(code, []).append(date)
+            if not todo:
+                break
+    return complete_shard(conn, shard_id, worker_id,
+                          [(code, date) for code, dates in todo.items() for date in dates])
+
+
+def run_worker(worker_id=None, shard_dir=SHARD_DIR, lease_s=LEASE_SECONDS, poll_s=10, base_url=None):
+    """
+    claim and crawl shards until every shard is done
+    別的 worker 還拿著 lease 時每 poll_s 秒再看一次，它掛掉的話就接手
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    if base_url:
+        crawler.BASE_URL = base_url
+    segment_dir = os.path.join(os.path.expanduser(shard_dir), 'segments', worker_id)
+    os.makedirs(segment_dir, exist_ok=True)
+
+    conn = connect(shard_dir)
+    trading_dates = json.loads(conn.execute("SELECT value FROM meta WHERE key = 'trading_dates'").fetchone()[0])
+    n_done = 0
+    while True:
+        shard = claim_shard(conn, worker_id, lease_s)
+        if shard is None:
+            status = shard_status(conn)
+            if set(status) <= {'done', 'failed'}:
+                break
+            time.sleep(poll_s)
+            continue
+        shard_id, branches = shard
+        print(f"{worker_id}: shard {shard_id} ({len(branches)} branches)")
+        status = asyncio.run(crawl_shard(conn, shard_id, branches, worker_id, trading_dates, segment_dir, lease_s))
+        if status == 'done':
+            n_done += 1
+    conn.close()
+    print(f"{worker_id}: finished {n_done} shards")
+    return n_done
+
+
+def read_segment(path):
+    # worker 被砍掉時最後一行可能只寫了一半，欄位不齊的列丟掉
+    df = pd.read_csv(path, dtype=str, keep_default_na=False, on_bad_lines='skip')
+    return df[(df['Date'] != '') & (df['Branch_Code'] != '')]
+
+
+def merge_segments(Saved_dir, shard_dir=SHARD_DIR):
+    """
+    merge the crawled rows of finished shards into Saved_dir
+    同一個 (分點, 日期) 可能被好幾個 worker 抓過 (lease 過期重抓)，只用一個 segment 的資料，
+    優先用把 shard 做完的 worker；已經在分點檔裡的日期不會重複加，
+    shard 開始後 daily crawl 先加了今天的資料也一樣，比較舊的日期照樣合併進去 (merge_branch_rows)
+    merge 可以重跑，全部 shard 都 done 時才記 merged
+    return number of rows merged
+    """
+    shard_dir = os.path.expanduser(shard_dir)
+    conn = connect(shard_dir)
+    done = conn.execute("SELECT branches, owner FROM shards WHERE status = 'done'").fetchall()
+    status = shard_status(conn)
+    if set(status) - {'done'}:
+        print(f"Not every shard is done {status}, merging the finished ones")
+    if status.get('failed'):
+        for code, dates in shard_failures(conn).items():
+            print(f"  {code}: {len(dates)} dates still failing ({dates[0]} ~ {dates[-1]})")
+
+    segments_root = os.path.join(shard_dir, 'segments')
+    workers = sorted(os.listdir(segments_root)) if os.path.isdir(segments_root) else []
+
+    n_rows = 0
+    for branches_json, owner in done:
+        for b in json.loads(branches_json):
+            code = b['Branch_Code']
+            frames = []
+            # owner 排第一個，之後用 drop_duplicates 保留第一個 segment 的日期
+            for rank, worker in enumerate(sorted(workers, key=lambda w: w != owner)):
+                path = branch_path(os.path.join(segments_root, worker), code)
+                if os.path.isfile(path):
+                    frames.append(read_segment(path).assign(_rank=rank))
+            if not frames:
+                continue
+            df = pd.concat(frames, ignore_index=True)
+            keep = df[['Date', '_rank']].drop_duplicates('Date', keep='first')
+            df = df.merge(keep, on=['Date', '_rank'])[BRANCH_COLUMNS].drop_duplicates()
+            n_rows += merge_branch_rows(Saved_dir, code, df)
+
+    if status and set(status) <= {'done'}:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('merged', ?)", (time.strftime('%Y-%m-%d %H:%M:%S'),))
+    conn.close()
+    print(f"{n_rows} rows merged into {Saved_dir}")
+    return n_rows
+
+
+def run_local(n_workers, shard_dir=SHARD_DIR, lease_s=LEASE_SECONDS, poll_s=10, base_url=None):
+    """
+    start n_workers worker processes on this machine and wait for them
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--shard-dir', shard_dir, 'worker',
+           '--lease', str(lease_s), '--poll', str(poll_s)]
+    if base_url:
+        cmd += ['--base-url', base_url]
+    procs = [subprocess.Popen(cmd + ['--id', f'{socket.gethostname()}-w{i}']) for i in range(n_workers)]
+    return [p.wait() for p in procs]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl branches with several workers sharing a lease table')
+    parser.add_argument('--shard-dir', type=str, default=SHARD_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_init = sub.add_parser('init', help='split big_branch_list into shards')
+    p_init.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    p_init.add_argument('--reset', action='store_true', help='drop unfinished shards')
+
+    for name in ('worker', 'local'):
+        p = sub.add_parser(name, help='run one worker' if name == 'worker' else 'run N workers on this machine')
+        p.add_argument('--lease', type=float, default=LEASE_SECONDS, help='lease length in seconds')
+        p.add_argument('--poll', type=float, default=10, help='seconds between claims when all shards are leased')
+        p.add_argument('--base-url', type=str, default=None, help='e.g. the mock_fubon.py address')
+    sub.choices['worker'].add_argument('--id', type=str, default=None)
+    sub.choices['local'].add_argument('-n', '--workers', type=int, default=4)
+
+    sub.add_parser('merge', help='merge finished shards into small_broker_trading')
+    sub.add_parser('retry', help='put failed shards back to pending')
+    sub.add_parser('status')
+    args = parser.parse_args()
+
+    Tradingdatefile_path = f'{DATA_DIR}/Tradingdate.csv'
+    Brokerlist_path = f'{DATA_DIR}/big_branch_list.csv'
+    Saved_dir = f'{DATA_DIR}/small_broker_trading'
+
+    if args.command == 'init':
+        init_shards(Tradingdatefile_path, Brokerlist_path, Saved_dir, args.shard_dir, args.shard_size, args.reset)
+    elif args.command == 'worker':
+        run_worker(args.id, args.shard_dir, args.lease, args.poll, args.base_url)
+    elif args.command == 'local':
+        run_local(args.workers, args.shard_dir, args.lease, args.poll, args.base_url)
+    elif args.command == 'merge':
+        merge_segments(Saved_dir, args.shard_dir)
+    elif args.command == 'retry':
+        conn = connect(args.shard_dir)
+        print(f"{retry_failed(conn)} failed shards back to pending")
+        conn.close()
+    else:
+        conn = connect(args.shard_dir)
+        print(shard_status(conn))
+        conn.close()
@@ -1,57 +1,297 @@
-import pandas as pd
+import io
 import os
+import argparse
+import json
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from broker_analyze import BROKER_DTYPES
+
+# 記錄上次切到哪裡 (byte offset) 的檔案，放在 output_dir 裡
+STATE_FILE = '.split_state.json'
+FINGERPRINT_BYTES = 65536
+
+
+class _LimitedReader(io.RawIOBase):
+    """
+    raw reader that stops at byte `end` (不讀到還沒寫完的最後一行)
+    """
+    def __init__(self, f, end):
+        self._f = f
+        self._remaining = end - f.tell()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._remaining <= 0:
+            return 0
+        n = self._f.readinto(memoryview(b)[:min(len(b), self._remaining)])
+        self._remaining -= n
+        return n
+
+
+def _hash_range(f, start, end):
+    f.seek(start)
+    return hashlib.sha1(f.read(max(0, end - start))).hexdigest()
+
+
+def file_fingerprint(path, offset):
+    """
+    fingerprint of the source up to offset: 開頭一段和 offset 前一段的 hash
+    只是往後 append 時不會變，整個檔案被重寫時會變
+    """
+    with open(path, 'rb') as f:
+        return {
+            'head': _hash_range(f, 0, min(offset, FINGERPRINT_BYTES)),
+            'tail': _hash_range(f, max(0, offset - FINGERPRINT_BYTES), offset),
+        }
+
 
-def split_csv_by_branch(input_path, output_dir, chunksize=1000000):
+def complete_lines_end(path):
     """
-    Read the large CSV in chunks and write rows to separate CSVs by Brocker_id.
+    byte offset right after the last newline, 最後一行沒寫完就不處理
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        pos = size
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            block = f.read(step)
+            idx = block.rfind(b'\n')
+            if idx >= 0:
+                return pos - step + idx + 1
+            pos -= step
+    return 0
+
+
+def load_state(output_dir):
+    state_path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(output_dir, state):
+    state_path = os.path.join(output_dir, STATE_FILE)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def can_append(input_path, output_dir, state):
+    """
+    True if the source only grew since the last split (同一個檔案，只往後 append)
+    """
+    if state is None or state.get('source') != input_path:
+        return False
+    offset = state['offset']
+    if os.path.getsize(input_path) < offset:
+        return False
+    if file_fingerprint(input_path, offset) != state['fingerprint']:
+        return False
+    # 分點檔被刪掉的話也要重建
+    return all(os.path.isfile(os.path.join(output_dir, f"{b}.csv")) for b in state['branches'])
+
+
+def header_end(path):
+    """
+    (columns, byte offset right after the header line)
+    """
+    with open(path, 'rb') as f:
+        line = f.readline()
+    columns = list(pd.read_csv(io.BytesIO(line), nrows=0).columns)
+    return columns, len(line)
+
+
+def byte_ranges(path, start, end, range_bytes):
+    """
+    split [start, end) into ranges of about range_bytes, 每段都切在換行之後
+    """
+    bounds = [start]
+    with open(path, 'rb') as f:
+        pos = start + range_bytes
+        while pos < end:
+            f.seek(pos)
+            f.readline()          # 跳到下一個換行
+            pos = f.tell()
+            if pos >= end:
+                break
+            bounds.append(pos)
+            pos += range_bytes
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _format_range(path, start, end, columns):
+    """
+    worker: parse one byte range and format the rows of every branch as csv text
+    return [(Branch_Code, bytes)] ，在 worker 裡 parse + to_csv，主 process 只負責寫檔
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        df = pd.read_csv(io.BufferedReader(_LimitedReader(f, end)), header=None, names=columns,
+                         thousands=',', dtype=BROKER_DTYPES)
+    return [(Branch_Code, gdf.to_csv(index=False, header=False).encode())
+            for Branch_Code, gdf in df.groupby('Branch_Code')]
+
+
+def default_max_open():
+    """
+    how many branch files to keep open, 留一些 fd 給其他用途
+    """
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError):
+        soft = 512
+    return max(8, min(1024, soft - 64))
+
+
+class BranchWriter:
+    """
+    LRU cache of open buffered branch files
+    每個分點檔在這次 split 第一次寫入時決定要覆寫 (含 header) 還是接在後面，
+    之後被擠出 cache 再打開一律用 append
+    """
+    def __init__(self, output_dir, columns, append_existing, max_open=None):
+        self.output_dir = output_dir
+        self.header = (','.join(columns) + '\n').encode()
+        self.append_existing = append_existing
+        self.max_open = max_open or default_max_open()
+        self.handles = OrderedDict()
+        self.written = set()
+
+    def _handle(self, Branch_Code):
+        f = self.handles.get(Branch_Code)
+        if f is not None:
+            self.handles.move_to_end(Branch_Code)
+            return f
+
+        if len(self.handles) >= self.max_open:
+            _, old = self.handles.popitem(last=False)
+            old.close()
+
+        broker_file = os.path.join(self.output_dir, f"{Branch_Code}.csv")
+        if Branch_Code in self.written:
+            f = open(broker_file, 'ab')
+        elif self.append_existing and os.path.isfile(broker_file):
+            # incremental: 已經有的分點檔直接接在後面
+            f = open(broker_file, 'ab')
+        else:
+            # If first time writing this file, include headers
+            f = open(broker_file, 'wb')
+            f.write(self.header)
+        self.written.add(Branch_Code)
+        self.handles[Branch_Code] = f
+        return f
+
+    def write(self, Branch_Code, data):
+        self._handle(Branch_Code).write(data)
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles.clear()
+
+
+def split_ranges(input_path, start, end, columns, writer, workers=None, range_bytes=64 * 2**20):
+    """
+    parse newline-aligned byte ranges in parallel, write the results in file order
+    來源檔是依日期 append 的，照 range 順序寫入所以每個分點檔仍然依日期排序
+    """
+    ranges = byte_ranges(input_path, start, end, range_bytes)
+    workers = min(workers or os.cpu_count(), len(ranges))
+    if workers <= 1:
+        for s, e in ranges:
+            for Branch_Code, data in _format_range(input_path, s, e, columns):
+                writer.write(Branch_Code, data)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # 依 ranges 順序取結果寫檔，最多只預先送出 2*workers 段，避免結果堆在記憶體裡
+        futures = []
+        for s, e in ranges:
+            futures.append(executor.submit(_format_range, input_path, s, e, columns))
+            if len(futures) > 2 * workers:
+                for Branch_Code, data in futures.pop(0).result():
+                    writer.write(Branch_Code, data)
+        for fut in futures:
+            for Branch_Code, data in fut.result():
+                writer.write(Branch_Code, data)
+
+
+def split_csv_by_branch(input_path, output_dir, incremental=True, workers=None,
+                        range_bytes=64 * 2**20, max_open=None):
+    """
+    Read the large CSV in byte ranges and write rows to separate CSVs by Brocker_id.
+    incremental=True 時從上次的 byte offset 繼續，只把新的列 append 到各分點檔；
+    來源檔被重寫 (fingerprint 不同) 或沒有紀錄時才整個重建
     """
     input_path = os.path.expanduser(input_path)
     output_dir = os.path.expanduser(output_dir)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    
-    # Dictionary to track if we've already written headers to broker-specific files
-    brokers_written = {}
-
-    #files_list
-    files_list = []
-    
-    # Read the large CSV in chunks
-    for chunk in pd.read_csv(input_path, chunksize=chunksize, 
-                            thousands=',',
-                            dtype={"Ticker":"string",
-                                    "Name":"string",
-                                    "buy":int,
-                                    "sell":int,
-                                    "diff":int,
-                                    "Branch":"string",
-                                    "Date":"string",
-                                    "Branch_Code":"string"}):
-        
-        # Group by Brocker_id in this chunk
-        groups = chunk.groupby('Branch_Code')
-        
-        for Branch_Code, gdf in groups:
-            # Determine output file name for this broker
-            broker_file = os.path.join(output_dir, f"{Branch_Code}.csv")
-            
-            # If first time writing this file, include headers
-            if Branch_Code not in brokers_written:
-                gdf.to_csv(broker_file, index=False, mode='w')
-                brokers_written[Branch_Code] = True
-                files_list.append(Branch_Code)
-            else:
-                # Append to existing file, no header
-                gdf.to_csv(broker_file, index=False, mode='a', header=False)
+
+    end = complete_lines_end(input_path)
+    state = load_state(output_dir)
+    append = incremental and can_append(input_path, output_dir, state)
+
+    if append:
+        print(f"Incremental split from byte {state['offset']} to {end}")
+        columns = state['columns']
+        start = state['offset']
+        branches = set(state['branches'])
+    else:
+        print("Full split of", input_path)
+        columns, start = header_end(input_path)
+        branches = set()
+
+    writer = BranchWriter(output_dir, columns, append_existing=append, max_open=max_open)
+    try:
+        if end > start:
+            split_ranges(input_path, start, end, columns, writer, workers, range_bytes)
+    finally:
+        writer.close()
+
+    if not append:
+        # 重建時把上次有、這次沒有的分點檔刪掉，避免留下舊資料
+        for b in (state or {}).get('branches', []):
+            if b not in writer.written:
+                stale = os.path.join(output_dir, f"{b}.csv")
+                if os.path.isfile(stale):
+                    os.remove(stale)
+
+    branches.update(writer.written)
+    save_state(output_dir, {
+        'source': input_path,
+        'offset': end,
+        'fingerprint': file_fingerprint(input_path, end),
+        'columns': columns,
+        'branches': sorted(branches),
+    })
 
     print("Splitting completed. Each Branch CSV is in:", output_dir)
-    return files_list
+    return sorted(branches)
 
+
+# daily_asyc_brokerdata.py 已經直接寫分點檔，這裡只用來把舊的 broker_trading_list.csv 轉成分點檔
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split broker_trading_list.csv by Branch_Code')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of parse processes (default all cores)')
+    parser.add_argument('--full', action='store_true', help='ignore the watermark and rebuild every branch file')
+    args = parser.parse_args()
+
     input_csv = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/broker_trading_list.csv'
     output_dir = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/small_broker_trading'
     files_list_csv = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/small_broker_trading_list.csv'
-    files_list = split_csv_by_branch(input_csv, output_dir)
+    files_list = split_csv_by_branch(input_csv, output_dir, incremental=not args.full, workers=args.workers)
     df = pd.DataFrame(files_list)
     df.to_csv(files_list_csv, index=False, mode='w')
@@ -0,0 +1,251 @@
+import os
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+
+from broker_analyze import list_csv_files
+from branch_store import branch_path
+from calendar_rolling import to_ordinals
+
+ALERT_FILE = 'live_alerts.csv'
+ALERT_COLUMNS = ['alert_time', 'Date', 'Branch_Code', 'Branch', 'Ticker', 'Name', 'diff', 'Volume',
+                 'diff_7days_avg', 'is_big_buy_c1', 'is_big_buy_c2', 'success_rate']
+
+
+# -------------------------------------------------------------------
+# Streaming alerts
+#   crawl 還在跑的時候，每個分點今天的資料一 parse 完就檢查 big buy 條件 (同 big_buy_calc)，
+#   (分點, 股票) 在上一次 broker_analyze 的成功率 > success_threshold 就馬上發 alert
+#   開始前先載入：高成功率的 (分點, 股票)、這些組合前 avg_window 個交易日的 diff 合計
+#   今天的成交量要等 download_stock 寫進 AllStockHist (和 crawl 同時跑，一開始常常還沒有)，
+#   背景 thread 每 volume_refresh_s 秒讀有更新的價格檔，evaluate 只查記憶體，不在 crawler 的 event loop 上讀檔
+#   還沒有成交量、cond2 也不成立的列先放在 pending，讀到成交量時再檢查 cond1，
+#   crawl 結束時 finish() 等 download_stock 做完 (ready) 再全部檢查一次
+#   最後的 cheater_today_bought.csv 還是以 broker_analyze 完整重算的結果為準
+# -------------------------------------------------------------------
+class StreamingAlerts:
+    def __init__(self, df_high_sr, trading_dates, today, price_dir, out_dir=None,
+                 vol_ratio=0.18, avg_mult=2, avg_window=7, volume_refresh_s=10):
+        self.today = pd.Timestamp(today)
+        self.today_str = self.today.strftime('%Y-%m-%d')
+        self.trading_dates = np.sort(pd.to_datetime(np.asarray(trading_dates)).to_numpy())
+        self.today_ord = int(to_ordinals([self.today], self.trading_dates)[0])
+        self.success_rate = {(b, t): r for b, t, r in df_high_sr[['Branch_Code', 'Ticker', 'success_rate']]
+                             .itertuples(index=False)}
+        self.price_dir = os.path.expanduser(price_dir)
+        self.out_path = None if out_dir is None else os.path.join(os.path.expanduser(out_dir), ALERT_FILE)
+        self.vol_ratio, self.avg_mult, self.avg_window = vol_ratio, avg_mult, avg_window
+        self.volume_refresh_s = volume_refresh_s
+
+        self.window_sum = {}      # (分點, 股票) -> 前 avg_window 個交易日 diff 合計
+        self.first_ord = {}       # (分點, 股票) -> 第一筆交易的 ordinal
+        self.volume = {}          # Ticker -> 今天成交量 (張)
+        self._volume_read = {}    # price file -> mtime
+        self.pending = {}         # (分點, 股票) -> 還在等成交量的列
+        self.alerts = []
+        self._emitted = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def load(cls, success_path, Saved_dir, trading_dates, price_dir, out_dir=None, success_threshold=0.49,
+             today=None, **params):
+        """
+        build the evaluator from the last broker_branch_ticker_success_rate.csv and the branch files
+        today 預設是 trading_dates 的最後一天
+        """
+        df_stat_bt = pd.read_csv(os.path.expanduser(success_path), dtype={'Branch_Code': str, 'Ticker': str})
+        df_high_sr = df_stat_bt[df_stat_bt['success_rate'] > success_threshold]
+        today = pd.to_datetime(trading_dates).max() if today is None else today
+        alerts = cls(df_high_sr, trading_dates, today, price_dir, out_dir, **params)
+        alerts.load_history(Saved_dir)
+        print(f"Streaming alerts: {len(alerts.success_rate)} (branch, ticker) pairs above {success_threshold}")
+        return alerts
+
+    def load_history(self, Saved_dir):
+        """
+        rolling state of the watched pairs from the branch files (只讀有被關注的分點，今天以前的資料)
+        """
+        pairs = pd.DataFrame(list(self.success_rate), columns=['Branch_Code', 'Ticker'])
+        for code, df_pairs in pairs.groupby('Branch_Code'):
+            path = branch_path(Saved_dir, code)
+            if not os.path.isfile(path):
+                continue
+            df_b = pd.read_csv(path, usecols=['Ticker', 'diff', 'Date'], dtype={'Ticker': str}, thousands=',')
+            df_b = df_b[df_b['Ticker'].isin(df_pairs['Ticker'])]
+            df_b['ord'] = to_ordinals(df_b['Date'], self.trading_dates)
+            df_b = df_b[df_b['ord'] < self.today_ord]
+            if df_b.empty:
+                continue
+            in_window = df_b['ord'] >= self.today_ord - self.avg_window
+            sums = df_b[in_window].groupby('Ticker')['diff'].sum()
+            firsts = df_b.groupby('Ticker')['ord'].min()
+            for ticker, first in firsts.items():
+                self.first_ord[(code, ticker)] = int(first)
+                self.window_sum[(code, ticker)] = int(sums.get(ticker, 0))
+
+    def _read_volumes(self, path):
+        df = pd.read_csv(path, usecols=['Date', 'Volume', 'Ticker'])
+        df = df[df['Date'] == self.today_str]
+        tickers = df['Ticker'].astype(str).str.replace(r'\.TWO|\.TW', '', regex=True)
+        return dict(zip(tickers, df['Volume'] / 1000))
+
+    def load_volumes(self):
+        """
+        read the price files changed since the last call (在背景 thread 或 finish 裡呼叫)
+        return number of files read
+        """
+        volume, n_files = {}, 0
+        for path in list_csv_files(self.price_dir) if os.path.isdir(self.price_dir) else []:
+            try:
+                mtime = os.path.getmtime(path)
+                if self._volume_read.get(path) == mtime:
+                    continue
+                volume.update(self._read_volumes(path))
+            except (OSError, ValueError, pd.errors.ParserError):
+                # download_stock 可能正在寫 (或刪掉) 這個檔案，下一輪再讀
+                continue
+            self._volume_read[path] = mtime
+            n_files += 1
+        if volume:
+            with self._lock:
+                self.volume.update(volume)
+        return n_files
+
+    def get_volume(self, ticker):
+        """
+        today's volume in 張, 還沒讀到時回傳 None (只查記憶體)
+        """
+        return self.volume.get(ticker)
+
+    def start(self):
+        """
+        start the background volume loader, crawl 開始前呼叫
+        """
+        self._thread = threading.Thread(target=self._volume_loop, name='alert-volumes', daemon=True)
+        self._thread.start()
+        return self
+
+    def _volume_loop(self):
+        self.load_volumes()
+        while not self._stop.wait(self.volume_refresh_s):
+            if self.pending:
+                self.load_volumes()
+                self.recheck()
+
+    def recheck(self, final=False):
+        """
+        check pending rows whose volume is known now
+        final=True 時還是沒有成交量的當作 0 (和 big_buy_calc 的 fillna(0) 一樣，cond1 不成立) 並清掉
+        return the new alerts as a DataFrame
+        """
+        new = []
+        with self._lock:
+            for key, row in list(self.pending.items()):
+                volume = self.get_volume(key[1])
+                if volume is None and not final:
+                    continue
+                del self.pending[key]
+                if volume and row['diff'] >= self.vol_ratio * volume:
+                    self._emitted.add(key)
+                    new.append({**row, 'alert_time': time.strftime('%Y-%m-%d %H:%M:%S'), 'Volume': volume,
+                                'is_big_buy_c1': True})
+            if new:
+                self.alerts.extend(new)
+                self._emit(pd.DataFrame(new, columns=ALERT_COLUMNS))
+        return pd.DataFrame(new, columns=ALERT_COLUMNS)
+
+    def finish(self, ready=None, timeout_s=1800):
+        """
+        end of the crawl: 有 pending 時等 ready (threading.Event, download_stock 做完時 set) 或 timeout_s，
+        再讀一次價格檔把 pending 全部檢查完
+        return summary()
+        """
+        deadline = time.time() + timeout_s
+        if ready is not None:
+            while self.pending and time.time() < deadline and not ready.wait(self.volume_refresh_s):
+                pass
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.load_volumes()
+        n_pending = len(self.pending)
+        n_new = len(self.recheck(final=True))
+        if n_pending:
+            print(f"Streaming alerts: {n_pending} rows waited for today's volume, {n_new} alerts")
+        return self.summary()
+
+    def evaluate(self, df_rows):
+        """
+        check crawled rows (process_broker 的 data_table), 只看今天的資料
+        return the new alerts as a DataFrame
+        """
+        df_today = df_rows[df_rows['Date'] == self.today_str]
+        new = []
+        with self._lock:
+            for row in df_today.itertuples(index=False):
+                key = (str(row.Branch_Code), str(row.Ticker))
+                if key not in self.success_rate or key in self._emitted or key[1].startswith('0'):
+                    continue
+                diff = int(str(row.diff).replace(',', ''))
+                volume = self.get_volume(key[1])
+                first = self.first_ord.get(key)
+                avg = self.window_sum.get(key, 0) / self.avg_window \
+                    if first is not None and first <= self.today_ord - self.avg_window else np.nan
+                cond1 = bool(volume) and diff >= self.vol_ratio * volume
+                cond2 = diff >= self.avg_mult * avg
+                alert = {'Date': self.today_str, 'Branch_Code': key[0], 'Branch': row.Branch, 'Ticker': key[1],
+                         'Name': row.Name, 'diff': diff, 'Volume': volume, 'diff_7days_avg': avg,
+                         'is_big_buy_c1': bool(cond1), 'is_big_buy_c2': bool(cond2),
+                         'success_rate': self.success_rate[key]}
+                if not (cond1 or cond2):
+                    # 成交量還沒讀到，之後 recheck 再看 cond1 (同一組合留 diff 最大的一列)
+                    if volume is None and diff > self.pending.get(key, {}).get('diff', -np.inf):
+                        self.pending[key] = alert
+                    continue
+                self.pending.pop(key, None)
+                self._emitted.add(key)
+                new.append({'alert_time': time.strftime('%Y-%m-%d %H:%M:%S'), **alert})
+            if new:
+                self.alerts.extend(new)
+                self._emit(pd.DataFrame(new, columns=ALERT_COLUMNS))
+        return pd.DataFrame(new, columns=ALERT_COLUMNS)
+
+    def _emit(self, df_new):
+        for r in df_new.itertuples(index=False):
+            volume = 'n/a' if pd.isna(r.Volume) else f"{r.Volume:.0f}"
+            print(f"ALERT {r.alert_time} {r.Branch}({r.Branch_Code}) bought {r.Ticker} {r.Name} "
+                  f"diff={r.diff} volume={volume} success_rate={r.success_rate:.2f}", flush=True)
+        if self.out_path is not None:
+            # 檔案只留今天的 alert，同一天重跑就接在後面
+            is_new = True
+            if os.path.isfile(self.out_path):
+                dates = pd.read_csv(self.out_path, usecols=['Date'], nrows=1)['Date']
+                is_new = dates.empty or dates.iloc[0] != self.today_str
+            df_new.to_csv(self.out_path, mode='w' if is_new else 'a', header=is_new, index=False)
+
+    def summary(self):
+        return pd.DataFrame(self.alerts, columns=ALERT_COLUMNS)
+
+
+def for_crawl(data_dir, Ori_Tradingdate=None, success_threshold=0.49):
+    """
+    evaluator for the daily crawl with the usual TW_stock_data layout, 背景讀成交量的 thread 已經啟動
+    還沒有 broker_analyze 的結果 (第一次跑) 時回傳 None
+    """
+    success_path = os.path.join(os.path.expanduser(data_dir), 'calc_result',
+                                'broker_branch_ticker_success_rate.csv')
+    if not os.path.isfile(success_path):
+        print(f"No {success_path}, streaming alerts are off")
+        return None
+    if Ori_Tradingdate is None:
+        Ori_Tradingdate = pd.read_csv(os.path.join(os.path.expanduser(data_dir), 'Tradingdate.csv'))
+    trading_dates = pd.to_datetime(Ori_Tradingdate['str_date'], format='%Y-%m-%d')
+    alerts = StreamingAlerts.load(success_path, os.path.join(data_dir, 'small_broker_trading'), trading_dates,
+                                  os.path.join(data_dir, 'AllStockHist'), os.path.join(data_dir, 'calc_result'),
+                                  success_threshold)
+    # crawl 結束後要呼叫 alerts.finish()
+    return alerts.start()
@@ -0,0 +1,143 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+def make_trading_dates(n_days, start='2015-01-05'):
+    return pd.bdate_range(start, periods=n_days)
+
+
+def make_tickers(n_tickers, n_etf=None):
+    """
+    4 碼上市股票 + 少量 0 開頭 ETF (例如 00632R)，ETF 在 big_buy_calc 會被排除
+    """
+    n_etf = max(1, n_tickers // 50) if n_etf is None else n_etf
+    stocks = [str(1101 + i) for i in range(n_tickers - n_etf)]
+    etfs = [f"00{630 + i}R" if i % 2 else f"00{630 + i}" for i in range(n_etf)]
+    return stocks + etfs
+
+
+def make_price_frame(tickers, dates, rng, rally_rate=0.01):
+    """
+    AllStockHist schema (twstock 下載後的欄位)
+    價格是 random walk，加上偶爾的連續上漲 (rally) 讓 big gain signal 會出現
+    """
+    n_days = len(dates)
+    frames = []
+    for ticker in tickers:
+        ret = rng.normal(0.0003, 0.02, n_days)
+        # rally: 幾天內每天漲 3~7%
+        starts = np.flatnonzero(rng.random(n_days) < rally_rate)
+        for s in starts:
+            length = rng.integers(4, 9)
+            ret[s:s + length] += rng.uniform(0.03, 0.07)
+        close = np.round(rng.uniform(15, 600) * np.exp(np.cumsum(ret)), 2)
+        open_ = np.round(close * (1 + rng.normal(0, 0.005, n_days)), 2)
+        high = np.round(np.maximum(open_, close) * (1 + rng.uniform(0, 0.02, n_days)), 2)
+        low = np.round(np.minimum(open_, close) * (1 - rng.uniform(0, 0.02, n_days)), 2)
+        volume = (rng.lognormal(14, 1.0, n_days)).astype(np.int64)
+        frames.append(pd.DataFrame({
+            'index': np.arange(n_days),
+            'Date': dates.strftime('%Y-%m-%d'),
+            'Volume': volume,
+            'turnover': (volume * close).astype(np.int64),
+            'Open': open_,
+            'High': high,
+            'Low': low,
+            'Close': close,
+            'change': np.round(np.diff(close, prepend=close[0]), 2),
+            'transaction': (volume // 2000 + 1).astype(np.int64),
+            'Ticker': ticker + '.TW',
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_branch_frame(branch_code, tickers, dates, df_volume, rng, trades_per_day=5.0,
+                      favorites=30, big_buy_rate=0.02):
+    """
+    small_broker_trading schema, 依日期排序
+    每個分點只常交易少數股票 (favorites)，每天成交筆數 ~ Poisson(trades_per_day)
+    偶爾一筆 big buy (成交量的 20~40%)
+    """
+    fav = rng.choice(len(tickers), size=min(favorites, len(tickers)), replace=False)
+    n_per_day = rng.poisson(trades_per_day, len(dates))
+    n_per_day = np.minimum(n_per_day, len(fav))
+    day_idx = np.repeat(np.arange(len(dates)), n_per_day)
+    # 同一天同一檔只會有一列
+    tick_idx = np.concatenate([rng.choice(fav, size=n, replace=False) for n in n_per_day]) \
+        if len(day_idx) else np.zeros(0, dtype=int)
+
+    n = len(day_idx)
+    buy = rng.geometric(0.05, n)
+    sell = rng.geometric(0.05, n)
+    big = rng.random(n) < big_buy_rate
+    vol_lots = df_volume[tick_idx, day_idx] / 1000
+    buy = np.where(big, (vol_lots * rng.uniform(0.2, 0.4, n)).astype(np.int64) + 1, buy)
+
+    ticker_arr = np.asarray(tickers)[tick_idx]
+    return pd.DataFrame({
+        'Ticker': ticker_arr,
+        'Name': np.char.add('名稱', ticker_arr),
+        'buy': buy,
+        'sell': sell,
+        'diff': buy - sell,
+        'Branch': f'分點{branch_code}',
+        'Date': dates[day_idx].strftime('%Y-%m-%d'),
+        'Branch_Code': branch_code,
+    })
+
+
+def generate(out_dir, n_tickers=200, n_branches=50, n_days=500, trades_per_day=5.0,
+             favorites=30, seed=0):
+    """
+    write AllStockHist/, small_broker_trading/ and Tradingdate.csv under out_dir
+    同樣的參數和 seed 會產生一模一樣的檔案
+    return dict of paths and row counts
+    """
+    out_dir = os.path.expanduser(out_dir)
+    price_dir = os.path.join(out_dir, 'AllStockHist')
+    branch_dir = os.path.join(out_dir, 'small_broker_trading')
+    os.makedirs(price_dir, exist_ok=True)
+    os.makedirs(branch_dir, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    dates = make_trading_dates(n_days)
+    tickers = make_tickers(n_tickers)
+
+    df_price = make_price_frame(tickers, dates, rng)
+    # 和 async_download_stock.py 一樣依代號第 4 碼分檔
+    for key, df in df_price.groupby(df_price['Ticker'].str[3]):
+        df.to_csv(os.path.join(price_dir, f"{key}-TaiwanStocksHistData.csv"), index=False)
+
+    volume = df_price['Volume'].to_numpy().reshape(len(tickers), len(dates))
+    broker_rows = 0
+    for b in range(n_branches):
+        code = f"{9100 + b}"
+        df_b = make_branch_frame(code, tickers, dates, volume, rng, trades_per_day, favorites)
+        df_b.to_csv(os.path.join(branch_dir, f"{code}.csv"), index=False)
+        broker_rows += len(df_b)
+
+    pd.DataFrame({'Date': dates, 'str_date': dates.strftime('%Y-%m-%d')}) \
+      .to_csv(os.path.join(out_dir, 'Tradingdate.csv'), index=False)
+
+    return {'price_dir': price_dir, 'branch_dir': branch_dir,
+            'price_rows': len(df_price), 'broker_rows': broker_rows,
+            'start_date': dates[0].strftime('%Y-%m-%d')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic price / branch trade files')
+    parser.add_argument('out_dir')
+    parser.add_argument('--tickers', type=int, default=200)
+    parser.add_argument('--branches', type=int, default=50)
+    parser.add_argument('--days', type=int, default=500)
+    parser.add_argument('--trades-per-day', type=float, default=5.0, help='average rows per branch per day')
+    parser.add_argument('--favorites', type=int, default=30, help='tickers each branch trades')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    info = generate(args.out_dir, args.tickers, args.branches, args.days, args.trades_per_day,
+                    args.favorites, args.seed)
+    print(f"{info['price_rows']} price rows, {info['broker_rows']} branch rows written to {args.out_dir}")
@@ -0,0 +1,308 @@
+import io
+import os
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from broker_analyze import BROKER_DTYPES
+from branch_store import BRANCH_COLUMNS, branch_lock, branch_path, first_line
+
+DATA_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data'
+STORE_DIR = f'{DATA_DIR}/small_broker_trading'
+INDEX_DIR = f'{DATA_DIR}/ticker_index'
+DB_FILE = 'index.db'
+
+
+# -------------------------------------------------------------------
+# Ticker -> branch index over small_broker_trading (SQLite)
+#   分點檔依日期排序，同一個月的資料在檔案裡是連續的一段 bytes
+#   blocks:   (分點, 月) -> [offset, end) 這個月在分點檔裡的 byte range
+#   postings: (股票, 月, 分點) -> 這個月第一次 / 最後一次交易的日期和筆數
+#   查 "X 在 A ~ B 之間有哪些分點交易" 只要查 postings；要 rows 的話只讀對應的 blocks
+#   files:    每個分點檔 index 到哪個 byte (indexed)，和第一行 / 最後一個 index 過的行
+#             新的資料 append 在後面時只 index 新的 bytes；第一行或最後一行變了
+#             (backfill 的 prepend 或重寫) 就整個分點重建
+# -------------------------------------------------------------------
+def connect(index_dir=INDEX_DIR):
+    index_dir = os.path.expanduser(index_dir)
+    os.makedirs(index_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(index_dir, DB_FILE), timeout=60, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                        branch_code TEXT PRIMARY KEY,
+                        indexed INTEGER NOT NULL,
+                        head BLOB NOT NULL,
+                        tail BLOB NOT NULL,
+                        rows INTEGER NOT NULL,
+                        updated_at REAL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS blocks (
+                        branch_code TEXT NOT NULL,
+                        month TEXT NOT NULL,
+                        offset INTEGER NOT NULL,
+                        end INTEGER NOT NULL,
+                        PRIMARY KEY (branch_code, month)) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS postings (
+                        ticker TEXT NOT NULL,
+                        month TEXT NOT NULL,
+                        branch_code TEXT NOT NULL,
+                        first_date TEXT NOT NULL,
+                        last_date TEXT NOT NULL,
+                        rows INTEGER NOT NULL,
+                        PRIMARY KEY (ticker, month, branch_code)) WITHOUT ROWID""")
+    return conn
+
+
+def _drop_branch(conn, code):
+    for table in ('files', 'blocks', 'postings'):
+        conn.execute(f'DELETE FROM {table} WHERE branch_code = ?', (code,))
+
+
+def _is_current(conn, path, code):
+    """
+    return (indexed byte, rows) if the indexed part of the file is unchanged, else None
+    """
+    row = conn.execute('SELECT indexed, head, tail, rows FROM files WHERE branch_code = ?', (code,)).fetchone()
+    if row is None:
+        return None
+    indexed, head, tail, rows = row
+    if os.path.getsize(path) < indexed or first_line(path) != head:
+        return None
+    with open(path, 'rb') as f:
+        f.seek(indexed - len(tail) - 1)
+        if f.read(len(tail) + 1) != tail + b'\n':
+            return None
+    return indexed, rows
+
+
+def scan_lines(header, data, base):
+    """
+    Ticker / Date / byte range of every line in data (完整的幾行 csv)
+    base 是 data 在檔案裡的 offset
+    """
+    ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')) + 1
+    starts = np.concatenate([[0], ends[:-1]])
+    df = pd.read_csv(io.BytesIO(header + data), usecols=['Ticker', 'Date'], dtype=str, keep_default_na=False)
+    if len(df) != len(ends):
+        raise ValueError(f"{len(df)} csv rows but {len(ends)} lines")
+    df['start'] = starts + base
+    df['end'] = ends + base
+    df['month'] = df['Date'].str[:7]
+    return df
+
+
+def update_branch(conn, store_dir, code):
+    """
+    index the new bytes of one branch file, return number of new rows
+    """
+    path = branch_path(store_dir, code)
+    if not os.path.isfile(path):
+        if conn.execute('SELECT 1 FROM files WHERE branch_code = ?', (code,)).fetchone():
+            conn.execute('BEGIN IMMEDIATE')
+            _drop_branch(conn, code)
+            conn.execute('COMMIT')
+        return 0
+
+    with branch_lock(store_dir, code):
+        current = _is_current(conn, path, code)
+        with open(path, 'rb') as f:
+            header = f.readline()
+            start = len(header) if current is None else current[0]
+            f.seek(start)
+            data = f.read()
+        head = first_line(path)
+    # 最後一行可能還沒寫完 (沒有拿 lock 的寫入)，只 index 到最後一個換行
+    data = data[:data.rfind(b'\n') + 1]
+    if current is not None and not data:
+        return 0
+
+    df = scan_lines(header, data, start) if data else None
+    conn.execute('BEGIN IMMEDIATE')
+    if current is None:
+        _drop_branch(conn, code)
+    if df is not None and len(df):
+        blocks = df.groupby('month').agg(offset=('start', 'min'), end=('end', 'max')).reset_index()
+        conn.executemany("""INSERT INTO blocks VALUES (?, ?, ?, ?)
+                            ON CONFLICT (branch_code, month) DO UPDATE SET
+                                offset = min(offset, excluded.offset), end = max(end, excluded.end)""",
+                         [(code, m, int(o), int(e)) for m, o, e in blocks.itertuples(index=False)])
+        postings = df.groupby(['Ticker', 'month']).agg(first_date=('Date', 'min'), last_date=('Date', 'max'),
+                                                       rows=('Date', 'size')).reset_index()
+        conn.executemany("""INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (ticker, month, branch_code) DO UPDATE SET
+                                first_date = min(first_date, excluded.first_date),
+                                last_date = max(last_date, excluded.last_date),
+                                rows = rows + excluded.rows""",
+                         [(t, m, code, f, l, int(n)) for t, m, f, l, n in postings.itertuples(index=False)])
+    new_rows = 0 if df is None else len(df)
+    indexed = start + len(data)
+    tail = data.rstrip(b'\n').rsplit(b'\n', 1)[-1] if data else b''
+    conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                 (code, indexed, head, tail, (0 if current is None else current[1]) + new_rows, time.time()))
+    conn.execute('COMMIT')
+    return new_rows
+
+
+def update(conn, store_dir=STORE_DIR, branch_codes=None, verbose=True):
+    """
+    bring the index up to date with every branch file (沒變的檔案只看大小和頭尾兩行)
+    """
+    store_dir = os.path.expanduser(store_dir)
+    if branch_codes is None:
+        branch_codes = sorted(f[:-4] for f in os.listdir(store_dir) if f.endswith('.csv'))
+        # 分點檔被刪掉的也要清掉
+        known = set(branch_codes)
+        branch_codes += [r[0] for r in conn.execute('SELECT branch_code FROM files') if r[0] not in known]
+    t0 = time.perf_counter()
+    new_rows, changed = 0, 0
+    for code in branch_codes:
+        n = update_branch(conn, store_dir, code)
+        new_rows += n
+        changed += n > 0
+    if verbose:
+        print(f"Ticker index: {new_rows} new rows from {changed} of {len(branch_codes)} branch files "
+              f"in {time.perf_counter() - t0:.1f}s")
+    return new_rows
+
+
+def _months(start, end):
+    return (None if start is None else pd.Timestamp(start).strftime('%Y-%m'),
+            None if end is None else pd.Timestamp(end).strftime('%Y-%m'))
+
+
+def _postings(conn, ticker, start, end, columns):
+    m_start, m_end = _months(start, end)
+    sql = f'SELECT {columns} FROM postings p WHERE p.ticker = ?'
+    args = [ticker]
+    if start is not None:
+        sql += ' AND p.month >= ? AND p.last_date >= ?'
+        args += [m_start, pd.Timestamp(start).strftime('%Y-%m-%d')]
+    if end is not None:
+        sql += ' AND p.month <= ? AND p.first_date <= ?'
+        args += [m_end, pd.Timestamp(end).strftime('%Y-%m-%d')]
+    return sql, args
+
+
+def branches_for(conn, ticker, start=None, end=None):
+    """
+    branches that traded the ticker between start and end, 只用 index 不讀分點檔
+    rows 是有重疊的月份裡的筆數 (月份的頭尾可能超出 start / end)，要先 update 才包含新 append 的資料
+    return DataFrame [Branch_Code, first_date, last_date, rows]
+    """
+    sql, args = _postings(conn, ticker, start, end, 'p.branch_code, p.first_date, p.last_date, p.rows')
+    df = pd.DataFrame(conn.execute(sql, args).fetchall(),
+                      columns=['Branch_Code', 'first_date', 'last_date', 'rows'])
+    return df.groupby('Branch_Code', as_index=False).agg(first_date=('first_date', 'min'),
+                                                         last_date=('last_date', 'max'), rows=('rows', 'sum'))
+
+
+def _ranges(conn, ticker, start, end, branch_codes):
+    """{分點: [(offset, end), ...]}, 相鄰的月份合成一段"""
+    sql, args = _postings(conn, ticker, start, end, 'b.branch_code, b.offset, b.end')
+    sql = sql.replace('FROM postings p', 'FROM postings p JOIN blocks b '
+                                         'ON b.branch_code = p.branch_code AND b.month = p.month')
+    ranges = {}
+    for code, offset, end_ in sorted(conn.execute(sql, args).fetchall()):
+        if branch_codes is not None and code not in branch_codes:
+            continue
+        r = ranges.setdefault(code, [])
+        if r and offset <= r[-1][1]:
+            r[-1] = (r[-1][0], max(r[-1][1], end_))
+        else:
+            r.append((offset, end_))
+    return ranges
+
+
+def read_rows(conn, ticker, start=None, end=None, store_dir=STORE_DIR, branch_codes=None, refresh=True,
+              stats=None):
+    """
+    every row of the ticker between start and end from all branch files, 只讀 index 指到的 bytes
+    refresh=True 時先 update (沒變的分點檔只看大小和頭尾兩行)，backfill 重寫過的分點會先重建
+    refresh=False 時不寫 index (例如 query_service)，還沒 index 的新 rows 不會出現，
+    index 之後被重寫過的分點檔 (offset 已經不對) 直接跳過
+    stats (dict) 會記錄讀了幾個檔案、幾個 bytes、跳過幾個 stale 的分點檔
+    return DataFrame with BRANCH_COLUMNS, sorted by Date, Branch_Code
+    """
+    if refresh:
+        update(conn, store_dir, None if branch_codes is None else list(branch_codes), verbose=False)
+    branch_codes = None if branch_codes is None else set(branch_codes)
+    ranges = _ranges(conn, ticker, start, end, branch_codes)
+
+    frames, n_bytes, stale = [], 0, 0
+    for code, spans in ranges.items():
+        path = branch_path(store_dir, code)
+        if not refresh and (not os.path.isfile(path) or _is_current(conn, path, code) is None):
+            stale += 1
+            continue
+        with open(path, 'rb') as f:
+            header = f.readline()
+            chunks = []
+            for offset, end_ in spans:
+                f.seek(offset)
+                chunks.append(f.read(end_ - offset))
+        data = b''.join(chunks)
+        n_bytes += len(data)
+        frames.append(pd.read_csv(io.BytesIO(header + data), dtype=BROKER_DTYPES, thousands=','))
+
+    if stats is not None:
+        stats.update(files=len(frames), bytes=n_bytes, stale=stale)
+    if not frames:
+        return pd.DataFrame({c: pd.Series(dtype=BROKER_DTYPES[c]) for c in BRANCH_COLUMNS})
+    df = pd.concat(frames, ignore_index=True)
+    keep = df['Ticker'] == ticker
+    if start is not None:
+        keep &= df['Date'] >= pd.Timestamp(start).strftime('%Y-%m-%d')
+    if end is not None:
+        keep &= df['Date'] <= pd.Timestamp(end).strftime('%Y-%m-%d')
+    return df[keep].sort_values(['Date', 'Branch_Code'], kind='stable').reset_index(drop=True)
+
+
+def status(conn):
+    files, rows = conn.execute('SELECT count(*), coalesce(sum(rows), 0) FROM files').fetchone()
+    n_postings, tickers = conn.execute('SELECT count(*), count(DISTINCT ticker) FROM postings').fetchone()
+    n_blocks = conn.execute('SELECT count(*) FROM blocks').fetchone()[0]
+    return {'files': files, 'rows': rows, 'tickers': tickers, 'postings': n_postings, 'blocks': n_blocks}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ticker -> branch index over small_broker_trading')
+    parser.add_argument('--store-dir', type=str, default=STORE_DIR)
+    parser.add_argument('--index-dir', type=str, default=INDEX_DIR)
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    p = sub.add_parser('update', help='index new rows of the branch files')
+    p.add_argument('--rebuild', action='store_true', help='drop the index first')
+    for name, desc in (('branches', 'branches that traded a ticker'), ('rows', 'rows of a ticker')):
+        p = sub.add_parser(name, help=desc)
+        p.add_argument('ticker')
+        p.add_argument('--start', type=str, default=None)
+        p.add_argument('--end', type=str, default=None)
+    sub.choices['rows'].add_argument('-o', '--output', type=str, default=None, help='save the rows to this csv')
+    sub.add_parser('status', help='size of the index')
+    args = parser.parse_args()
+
+    if args.cmd == 'update' and args.rebuild:
+        db = os.path.join(os.path.expanduser(args.index_dir), DB_FILE)
+        if os.path.isfile(db):
+            os.remove(db)
+    conn = connect(args.index_dir)
+
+    if args.cmd == 'update':
+        update(conn, args.store_dir)
+    elif args.cmd == 'branches':
+        update(conn, args.store_dir, verbose=False)
+        print(branches_for(conn, args.ticker, args.start, args.end).to_string(index=False))
+    elif args.cmd == 'rows':
+        t0 = time.perf_counter()
+        stats = {}
+        df = read_rows(conn, args.ticker, args.start, args.end, args.store_dir, stats=stats)
+        print(f"{len(df)} rows from {stats['files']} branch files, read {stats['bytes'] / 1024:.0f} KB "
+              f"in {time.perf_counter() - t0:.2f}s")
+        if args.output:
+            df.to_csv(os.path.expanduser(args.output), index=False)
+        else:
+            print(df.to_string(index=False, max_rows=40))
+    else:
+        print(status(conn))
+    conn.close()
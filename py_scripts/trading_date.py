@@ -1,16 +1,20 @@
 import os
-import yfinance as yf
-import pandas as pd
 from datetime import datetime, timedelta
 
+from run_stats import count
+
 def generate_trading_date():
     #generate trading day by extract info from 2330
+    # yfinance import 很慢，只在真的要下載時才 import
+    import yfinance as yf
+
     today = datetime.today()
     # yesterday = today - timedelta(days=1)
     # yesterday_str = yesterday.strftime('%Y-%m-%d')
     today_str = today.strftime('%Y-%m-%d')
 
     # TW2330 = yf.download('2330.TW', start='2023-01-01',end='2024-12-20')
+    count('yfinance')
     TW2330 = yf.download('2330.TW', start='2023-01-01', end=today_str) #end is not included
     # TW2330 = yf.download('2330.TW')
 
@@ -24,6 +28,7 @@ def generate_trading_date():
     save_dir = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data'
     Tradingdate_csv_path = os.path.join(save_dir, 'Tradingdate.csv')
     Tradingdate.to_csv(Tradingdate_csv_path, index = False)
+    return Tradingdate
 
 if __name__ == '__main__':
     generate_trading_date()
\ No newline at end of file
@@ -0,0 +1,125 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from backtest import label_events, walk_forward_counts
+from calendar_rolling import to_ordinals
+
+CALC_DIR = '~/Documents/Dev/Cheater_finder/Stock_project/TW_stock_data/calc_result'
+THRESHOLDS = (0.2, 0.3, 0.4, 0.49, 0.6)
+SUMMARY_COLUMNS = ['mode', 'by', 'threshold', 'min_events', 'picked', 'hits', 'precision', 'base_rate', 'lift',
+                   'recall', 'keys']
+
+
+# -------------------------------------------------------------------
+# Walk-forward evaluation of the success_threshold rule
+#   cheating_rate 用全部歷史算成功率，再拿同一段歷史判斷誰是 cheater (in-sample，有 lookahead)
+#   這裡每一筆 big buy 只用當天已經知道結果的事件 (backtest.walk_forward_counts，
+#   事件 label_lag 個交易日後才知道成功與否) 算成功率，超過 threshold 就算「挑中」，
+#   再看這筆 big buy 之後是不是真的有 signal
+#   所有事件依時間排序一次，用累加和算每個 cutoff 的 counter，不需要每天重跑 cheating_rate
+#   by='pair' 是 (分點, 股票) 的成功率 (find_today_cheaters 用的)，by='branch' 是分點整體的成功率
+# -------------------------------------------------------------------
+def walk_forward(df_big_buy, df_signals, by='pair', label_lag=8, trading_dates=None):
+    """
+    one row per big buy with success (真的對到 signal) and the walk-forward known_count / known_rate
+    """
+    df = df_big_buy[['Branch_Code', 'Ticker', 'Date']].reset_index(drop=True)
+    df['success'] = label_events(df, df_signals).astype(np.int64)
+    if trading_dates is None:
+        trading_dates = np.unique(pd.to_datetime(df['Date']).to_numpy())
+    df['ord'] = to_ordinals(df['Date'], trading_dates)
+
+    keys = ['Branch_Code', 'Ticker'] if by == 'pair' else ['Branch_Code']
+    key_id = df.groupby(keys, sort=False, observed=True).ngroup().to_numpy()
+    known_count, known_success = walk_forward_counts(key_id, df['ord'].to_numpy(), df['success'].to_numpy(),
+                                                     label_lag)
+    df['key'] = key_id
+    df['known_count'] = known_count
+    df['known_success'] = known_success
+    df['known_rate'] = np.divide(known_success, known_count, out=np.zeros(len(df)), where=known_count > 0)
+    return df
+
+
+def in_sample_rate(df_wf):
+    """full-history rate of each key (cheating_rate 的算法，包含事件本身和之後的結果)"""
+    total = np.bincount(df_wf['key'])
+    success = np.bincount(df_wf['key'], weights=df_wf['success'])
+    return success[df_wf['key']] / total[df_wf['key']], total[df_wf['key']]
+
+
+def _score(picked, success, keys, mode, by, threshold, min_events):
+    hits = int(success[picked].sum())
+    base_rate = success.mean() if len(success) else np.nan
+    precision = hits / picked.sum() if picked.any() else np.nan
+    return {'mode': mode, 'by': by, 'threshold': threshold, 'min_events': min_events,
+            'picked': int(picked.sum()), 'hits': hits, 'precision': precision, 'base_rate': base_rate,
+            'lift': precision / base_rate if base_rate else np.nan,
+            'recall': hits / success.sum() if success.sum() else np.nan,
+            'keys': int(len(np.unique(keys[picked])))}
+
+
+def evaluate(df_wf, by='pair', thresholds=THRESHOLDS, min_events=2, start=None):
+    """
+    precision of the picked big buys for every threshold, walk-forward vs in-sample
+    start: 只評估這天以後的 big buy (前面當作暖身，counter 還是從頭累加)
+    """
+    rate_is, total_is = in_sample_rate(df_wf)
+    keep = np.ones(len(df_wf), dtype=bool) if start is None else \
+        (pd.to_datetime(df_wf['Date']) >= pd.Timestamp(start)).to_numpy()
+    success, keys = df_wf['success'].to_numpy()[keep], df_wf['key'].to_numpy()[keep]
+    known_count, known_rate = df_wf['known_count'].to_numpy()[keep], df_wf['known_rate'].to_numpy()[keep]
+    rate_is, total_is = rate_is[keep], total_is[keep]
+
+    rows = []
+    for th in thresholds:
+        rows.append(_score((known_count >= min_events) & (known_rate > th), success, keys,
+                           'walk_forward', by, th, min_events))
+        rows.append(_score((total_is >= min_events) & (rate_is > th), success, keys, 'in_sample', by, th,
+                           min_events))
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+def by_period(df_wf, threshold=0.49, min_events=2, freq='M'):
+    """walk-forward precision per month (freq='M') or year ('Y')"""
+    df = df_wf.assign(picked=(df_wf['known_count'] >= min_events) & (df_wf['known_rate'] > threshold))
+    df['hit'] = df['picked'] & (df['success'] == 1)
+    period = pd.to_datetime(df['Date']).dt.to_period(freq).astype(str)
+    df_p = df.groupby(period).agg(big_buys=('success', 'size'), base_rate=('success', 'mean'),
+                                  picked=('picked', 'sum'), hits=('hit', 'sum'))
+    df_p['precision'] = np.divide(df_p['hits'], df_p['picked'], out=np.full(len(df_p), np.nan),
+                                  where=df_p['picked'] > 0)
+    df_p['lift'] = df_p['precision'] / df_p['base_rate']
+    return df_p.rename_axis('period').reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward check of how well past success rates pick cheaters')
+    parser.add_argument('--calc-dir', type=str, default=CALC_DIR)
+    parser.add_argument('--by', choices=['pair', 'branch'], default='pair')
+    parser.add_argument('--thresholds', type=str, default=','.join(map(str, THRESHOLDS)))
+    parser.add_argument('--min-events', type=int, default=2, help='min known big buys of the pair / branch')
+    parser.add_argument('--label-lag', type=int, default=8,
+                        help='trading days until a big buy result is known (未來 7 日均線 + 1)')
+    parser.add_argument('--start', type=str, default=None, help='only score big buys from this date')
+    parser.add_argument('--period', type=str, default='M', help='M or Y for the per period table')
+    args = parser.parse_args()
+
+    calc_dir = os.path.expanduser(args.calc_dir)
+    df_big_buy = pd.read_csv(os.path.join(calc_dir, 'broker_big_buy.csv'),
+                             usecols=['Branch_Code', 'Ticker', 'Date'], dtype=str)
+    df_signals = pd.read_csv(os.path.join(calc_dir, 'big_gain_signals.csv'), usecols=['Ticker', 'Date'], dtype=str)
+    thresholds = [float(t) for t in args.thresholds.split(',')]
+
+    df_wf = walk_forward(df_big_buy, df_signals, args.by, args.label_lag)
+    df_summary = evaluate(df_wf, args.by, thresholds, args.min_events, args.start)
+    main_threshold = 0.49 if 0.49 in thresholds else thresholds[0]
+    df_period = by_period(df_wf, main_threshold, args.min_events, args.period)
+
+    df_summary.to_csv(os.path.join(calc_dir, f'walk_forward_summary_{args.by}.csv'), index=False)
+    df_period.to_csv(os.path.join(calc_dir, f'walk_forward_{args.by}_by_period.csv'), index=False)
+    print(df_summary.to_string(index=False))
+    print(f"\nthreshold {main_threshold}, per period:")
+    print(df_period.tail(24).to_string(index=False))